@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+"""
+benchmarks
+~~~~~~~~~~
+
+Provides benchmarks of ckanny commands (run `python -m benchmarks.suite`)
+"""
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" A micro-benchmark of hdx field matching on a wide 3w header """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import random
+
+from functools import partial
+from timeit import timeit
+
+from tabutils import process as tup
+from ckanny import hdx
+
+NUM_FIELDS = 500
+NUM_ORGS = 50
+LOOPS = 20
+
+
+def make_header(num_fields, seed=0):
+    random.seed(seed)
+    words = ['activity', 'beneficiaries', 'date', 'status', 'donor', 'notes']
+    fields = [
+        '%s %i' % (random.choice(words).title(), i) for i in range(num_fields)]
+
+    # put the 3w columns near the end so every lookup scans most of the row
+    fields[-3:] = ['Partner Name', 'Cluster', 'Township PCode']
+    return fields
+
+
+def legacy(fields):
+    for ftype in ['who', 'what', 'where']:
+        field = tup.find(fields, hdx.possibilities[ftype], method='fuzzy')
+        {f.lower(): f for f in fields if f}[field.lower()]
+
+
+def indexed(fields):
+    for ftype in ['who', 'what', 'where']:
+        hdx.deref_field(fields, hdx.find_field(fields, ftype))
+
+
+def cold(fields):
+    hdx.field_indexes.clear()
+    indexed(fields)
+
+
+def run(func, fields):
+    for _ in range(NUM_ORGS):
+        func(fields)
+
+
+def main():
+    fields = make_header(NUM_FIELDS)
+    results = []
+
+    funcs = [('legacy', legacy), ('cold', cold), ('indexed', indexed)]
+
+    for name, func in funcs:
+        hdx.field_indexes.clear()
+        stmt = partial(run, func, fields)
+        results.append((name, timeit(stmt, number=LOOPS) / LOOPS))
+
+    print('%i columns, %i organizations per run' % (NUM_FIELDS, NUM_ORGS))
+
+    for name, elapsed in results:
+        print('%-10s %8.3f ms' % (name, elapsed * 1000))
+
+    for name, elapsed in results[1:]:
+        print('%s speedup %6.1fx' % (name, results[0][1] / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Throughput and peak memory benchmarks of ckanny commands """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import sys
+import json
+import shutil
+import platform
+
+from argparse import ArgumentParser
+from datetime import datetime as dt
+from glob import glob
+from os import environ, makedirs, wait4, path as p
+from subprocess import Popen
+from tempfile import TemporaryFile, gettempdir, mkdtemp
+from time import time
+
+from ckanny import __version__
+from tests import fakeckan
+
+parent_dir = p.dirname(p.dirname(p.abspath(__file__)))
+BIN = p.join(parent_dir, 'bin', 'ckanny')
+RESULTS_DIR = p.join(parent_dir, 'benchmarks', 'results')
+DATA_DIR = p.join(gettempdir(), 'ckanny-benchmarks')
+COMMANDS = [
+    'ds.update', 'ds.upload', 'fs.fetch', 'fs.migrate', 'fs.upload',
+    'fs.upload-parts', 'pk.create']
+DEF_SIZES = '1MB,10MB,100MB'
+UNITS = {'KB': 2 ** 10, 'MB': 2 ** 20, 'GB': 2 ** 30}
+MB = 2 ** 20
+PART_SIZE = 8 * MB
+
+# commands whose cost doesn't depend on the file size only run once
+FIXED = {'pk.create'}
+
+
+def parse_size(size):
+    """Converts a size like `10MB` to bytes
+
+    >>> parse_size('10MB')
+    10485760
+    """
+    size = size.strip().upper()
+    unit = size[-2:] if size[-2:] in UNITS else 'B'
+    number = size[:-len(unit)] if unit in UNITS else size.rstrip('B')
+    return int(float(number) * UNITS.get(unit, 1))
+
+
+def make_csv(size, data_dir=DATA_DIR):
+    """Creates (or reuses) a synthetic csv file of at least `size` bytes"""
+    filepath = p.join(data_dir, 'synthetic-%i.csv' % size)
+
+    if p.exists(filepath) and p.getsize(filepath) >= size:
+        return filepath
+
+    if not p.isdir(data_dir):
+        makedirs(data_dir)
+
+    row = '%i,name %i,%i.%02i,2015-%02i-%02i,%s\n'
+    notes = 'Lorem ipsum dolor sit amet'
+    written, num = 0, 0
+
+    with open(filepath, 'wb') as f:
+        header = b'id,name,value,date,notes\n'
+        f.write(header)
+        written += len(header)
+
+        while written < size:
+            lines = []
+
+            for i in xrange(num, num + 1000):
+                values = (
+                    i, i, i % 997, i % 100, i % 12 + 1, i % 28 + 1, notes)
+
+                lines.append(row % values)
+
+            num += 1000
+            chunk = ''.join(lines).encode('utf-8')
+            f.write(chunk)
+            written += len(chunk)
+
+    return filepath
+
+
+def execute(args, env):
+    """Runs a ckanny command in a fresh interpreter. Returns its exit code,
+    wall time, and peak memory (in bytes)."""
+    with TemporaryFile() as stderr, open('/dev/null', 'wb') as stdout:
+        start = time()
+        proc = Popen([sys.executable, BIN] + args, stdout=stdout,
+            stderr=stderr, env=env)
+
+        # unlike `Popen.wait`, `wait4` reports the child's resource usage
+        status, rusage = wait4(proc.pid, 0)[1:]
+        elapsed = time() - start
+        proc.returncode = status >> 8
+
+        if proc.returncode:
+            stderr.seek(0)
+            print(stderr.read().decode('utf-8', 'replace'), file=sys.stderr)
+
+    # linux reports kilobytes, mac bytes
+    factor = 1 if sys.platform == 'darwin' else 1024
+    return proc.returncode, elapsed, rusage.ru_maxrss * factor
+
+
+def get_args(command, filepath, store, work_dir):
+    """The cli args that benchmark `command` on a file"""
+    remote = store.address
+    common = ['--remote', remote, '--api-key', 'benchmark', '--quiet']
+
+    if command == 'pk.create':
+        return [command, 'hdx', '--title', 'Benchmark'] + common
+
+    rid = store.add_file(filepath)['id']
+
+    if command == 'ds.update':
+        return [command, rid, '--force'] + common
+    elif command == 'ds.upload':
+        return [command, filepath, '--resource-id', rid] + common
+    elif command == 'fs.fetch':
+        return [command, rid, '--destination', work_dir] + common
+    elif command == 'fs.upload':
+        return [command, filepath, '--resource-id', rid] + common
+    elif command == 'fs.upload-parts':
+        # the same upload sent in parallel parts (multipart api)
+        part_size = str(PART_SIZE)
+        return [
+            'fs.upload', filepath, '--resource-id', rid, '--part-size',
+            part_size] + common
+    elif command == 'fs.migrate':
+        # fs.migrate refuses to copy a resource onto the same remote
+        dest = remote.replace('127.0.0.1', 'localhost')
+        return [
+            command, rid, '--src-remote', remote, '--dest-remote', dest,
+            '--api-key', 'benchmark', '--quiet']
+
+
+def bench(commands, sizes, data_dir=DATA_DIR):
+    """Runs each command on a file of each size against a fake CKAN site"""
+    server = fakeckan.start()
+    work_dir = mkdtemp()
+    env = dict(environ)
+    env.update({
+        'CKANNY_CACHE_DIR': work_dir,
+        'CKANNY_SOCKET': p.join(work_dir, 'no.sock'),
+        'no_proxy': '127.0.0.1,localhost'})
+
+    try:
+        for command in commands:
+            for size in ([0] if command in FIXED else sizes):
+                filepath = make_csv(size, data_dir) if size else None
+                args = get_args(command, filepath, server.store, work_dir)
+                code, elapsed, peak = execute(args, env)
+
+                yield {
+                    'command': command,
+                    'size': size,
+                    'seconds': round(elapsed, 3),
+                    'mb_per_sec': round(size / MB / elapsed, 3),
+                    'peak_mb': round(peak / MB, 1),
+                    'exit': code}
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def key(result):
+    return result['command'], result['size']
+
+
+def compare(results, baseline):
+    """Prints the relative change of each result from the baseline"""
+    old = {key(r): r for r in baseline['results']}
+    print('\nchange from v%s:' % baseline['version'])
+
+    for result in results:
+        before = old.get(key(result))
+
+        if not before:
+            continue
+
+        seconds = 100 * (result['seconds'] / before['seconds'] - 1)
+        peak = 100 * (result['peak_mb'] / before['peak_mb'] - 1)
+        values = (result['command'], result['size'] / MB, seconds, peak)
+        print('%-12s %10.1f MB  time %+7.1f%%  memory %+7.1f%%' % values)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '-s', '--sizes', default=DEF_SIZES,
+        help='comma separated file sizes (default: %s)' % DEF_SIZES)
+
+    parser.add_argument(
+        '-c', '--commands', default=','.join(COMMANDS),
+        help='comma separated commands (default: all)')
+
+    parser.add_argument(
+        '-o', '--output', help='the results file (default: %s)' %
+        p.join(RESULTS_DIR, '<version>.json'))
+
+    parser.add_argument(
+        '-b', '--baseline', help=(
+            'the results file to compare against (default: the latest other'
+            ' file in %s)' % RESULTS_DIR))
+
+    parser.add_argument(
+        '-d', '--data-dir', default=DATA_DIR,
+        help='where to keep the synthetic files (default: %s)' % DATA_DIR)
+
+    args = parser.parse_args()
+    sizes = sorted(map(parse_size, args.sizes.split(',')))
+    commands = args.commands.split(',')
+    output = args.output or p.join(RESULTS_DIR, '%s.json' % __version__)
+    results = []
+    row = '%-12s %10.1f MB %9.3f s %9.3f MB/s %9.1f MB peak %s'
+
+    for result in bench(commands, sizes, args.data_dir):
+        values = [result[k] for k in ['command', 'size', 'seconds']]
+        values[1] /= MB
+        values += [result['mb_per_sec'], result['peak_mb']]
+        values.append('FAILED' if result['exit'] else '')
+        print(row % tuple(values))
+        results.append(result)
+
+    content = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': dt.utcnow().isoformat(),
+        'results': results}
+
+    if not p.isdir(p.dirname(output)):
+        makedirs(p.dirname(output))
+
+    with open(output, 'w') as f:
+        json.dump(content, f, indent=2, sort_keys=True)
+
+    print('\nresults saved to %s' % output)
+    others = sorted(
+        glob(p.join(RESULTS_DIR, '*.json')), key=p.getmtime, reverse=True)
+
+    baseline = args.baseline or next(
+        (f for f in others if p.abspath(f) != p.abspath(output)), None)
+
+    if baseline:
+        with open(baseline) as f:
+            compare(results, json.load(f))
+
+    sys.exit(any(r['exit'] for r in results))
+
+
+if __name__ == '__main__':
+    main()
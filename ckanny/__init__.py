@@ -20,8 +20,15 @@ from __future__ import (
     absolute_import, division, print_function, with_statement,
     unicode_literals)
 
+import sys
+import ast
+
+from importlib import import_module
+from os import path as p
+
 from manager import Manager
-from . import datastorer, filestorer, package, hdx
+
+from . import governor, stats
 
 __version__ = '0.17.2'
 
@@ -32,11 +39,86 @@ __email__ = 'reubano@gmail.com'
 __license__ = 'MIT'
 __copyright__ = 'Copyright 2015 Reuben Cummings'
 
-manager = Manager()
-manager.merge(datastorer.manager, namespace='ds')
-manager.merge(filestorer.manager, namespace='fs')
-manager.merge(hdx.manager, namespace='hdx')
-manager.merge(package.manager, namespace='pk')
+
+class LazyCommand(object):
+    """A stand-in used to list a command without importing its module"""
+    def __init__(self, name, namespace, description=None):
+        self.name = name
+        self.namespace = namespace
+        self.description = description or 'no description'
+        self.path = '%s.%s' % (namespace, name)
+
+
+class LazyManager(Manager):
+    """A manager that only imports a namespace's module (and its heavy
+    dependencies) once one of its commands is run"""
+    def __init__(self, *args, **kwargs):
+        super(LazyManager, self).__init__(*args, **kwargs)
+        self.modules = {}
+
+    def lazy_merge(self, module, namespace):
+        self.modules[namespace] = module
+
+    def load(self, namespace):
+        module = import_module('.%s' % self.modules.pop(namespace), __name__)
+        self.merge(module.manager, namespace=namespace)
+
+    def scan(self, namespace):
+        """Finds a namespace's commands by parsing (not importing) its module"""
+        filename = '%s.py' % self.modules[namespace]
+        filepath = p.join(p.dirname(__file__), filename)
+
+        with open(filepath) as f:
+            tree = ast.parse(f.read(), filepath)
+
+        for node in tree.body:
+            if not isinstance(node, ast.FunctionDef):
+                continue
+
+            for decorator in node.decorator_list:
+                call = isinstance(decorator, ast.Call)
+                func = decorator.func if call else decorator
+
+                if getattr(func, 'attr', None) != 'command':
+                    continue
+
+                keywords = decorator.keywords if call else []
+                kwargs = {k.arg: k.value for k in keywords}
+                name = getattr(kwargs.get('name'), 's', node.name)
+                description = ast.get_docstring(node)
+                yield LazyCommand(name, namespace, description)
+
+    def usage(self):
+        for namespace in self.modules:
+            for command in self.scan(namespace):
+                self.commands.setdefault(command.path, command)
+
+        return super(LazyManager, self).usage()
+
+    def main(self, args=None):
+        args = sys.argv[1:] if args is None else args
+
+        # `--stats`, `--stats-json`, and `--profile` work with every command
+        if any(a.split('=')[0] in stats.FLAGS for a in args):
+            flags, args = stats.extract_flags(args)
+            return stats.run(lambda: self.main(args), flags)
+
+        # `--rate` and `--max-in-flight` limit the requests to each remote
+        flags, args = stats.extract_flags(args, governor.FLAGS)
+        governor.configure(flags.get('--rate'), flags.get('--max-in-flight'))
+        namespace = args[0].split('.')[0] if args else None
+
+        if namespace in self.modules:
+            self.load(namespace)
+
+        return super(LazyManager, self).main(args)
+
+
+manager = LazyManager()
+manager.lazy_merge('datastorer', namespace='ds')
+manager.lazy_merge('filestorer', namespace='fs')
+manager.lazy_merge('hdx', namespace='hdx')
+manager.lazy_merge('package', namespace='pk')
 
 
 @manager.command
@@ -44,5 +126,23 @@ def ver():
     """Show ckanny version"""
     print('v%s' % __version__)
 
+
+@manager.arg(
+    'socket', 's', help=(
+        'the socket path (uses `CKANNY_SOCKET` ENV if available, default:'
+        ' ~/.ckanny/ckanny.sock)'))
+@manager.arg(
+    'quiet', 'q', help='suppress debug statements', type=bool, default=False)
+@manager.command
+def serve(socket=None, quiet=False):
+    """Serves commands sent by other ckanny processes over a Unix socket"""
+    # each command runs in a forked child, reusing this process's imports.
+    # Argument defaults come from this process's environment, so commands
+    # from callers with different `CKAN*` ENVs are refused (and run locally).
+    from . import server
+
+    server.serve(socket or server.DEF_SOCKET, not quiet)
+
+
 if __name__ == '__main__':
     manager.main()
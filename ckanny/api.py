@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" A Python api for running ckanny operations in process """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import ckanapi
+import ckanutils
+import requests
+
+from collections import namedtuple
+from contextlib import contextmanager
+from threading import Lock
+
+from . import (
+    blobs, compression, datastorer as ds, filestorer as fs, hashing,
+    package as pk, transfer, utils)
+
+# the `ds.update` and `pk.create` defaults (that the helpers don't apply)
+UPDATE_DEFAULTS = {
+    'hash_group': 'HDX',
+    'chunksize_rows': ckanutils.CHUNKSIZE_ROWS,
+    'chunksize_bytes': ckanutils.CHUNKSIZE_BYTES,
+    'retries': utils.DEF_RETRIES,
+    'quiet': True,
+}
+
+PACKAGE_DEFAULTS = {
+    'license_id': 'cc-by-igo',
+    'source': 'Multiple sources',
+    'files': '',
+    'names': '',
+    'methodology': 'observed',
+    'tags': '',
+    'type': 'dataset',
+    'location': 'world',
+    'private': False,
+    'quiet': True,
+}
+
+Updated = namedtuple('Updated', ['resource_id', 'status'])
+Fetched = namedtuple('Fetched', ['resource_id', 'filepath', 'encoding'])
+Migrated = namedtuple('Migrated', ['resource_id', 'resource'])
+Created = namedtuple('Created', ['package_id', 'package'])
+
+# what the batch functions yield for each item. `result` is one of the above
+# (or `None` if `error` is set).
+Outcome = namedtuple('Outcome', ['id', 'result', 'error'])
+
+# the clients (and so sessions) of this api, by their kwargs
+clients = {}
+clients_lock = Lock()
+
+
+class Error(Exception):
+    """The base class of the errors raised by this api"""
+    pass
+
+
+class NotFound(Error):
+    pass
+
+
+class NotAuthorized(Error):
+    pass
+
+
+class InvalidArgument(Error, ValueError):
+    pass
+
+
+class Failed(Error):
+    """The operation ran, but ckan didn't accept its result"""
+    pass
+
+
+class Unavailable(Error):
+    """The ckan instance couldn't be reached (or didn't answer in time)"""
+    pass
+
+
+@contextmanager
+def translate():
+    """Re-raises the errors of `ckanapi` (and `ckanutils`) and `requests` as
+    api errors"""
+    try:
+        yield
+    except ckanapi.NotFound as err:
+        raise NotFound(*err.args)
+    except ckanapi.NotAuthorized as err:
+        raise NotAuthorized(*err.args)
+    except ckanapi.ValidationError as err:
+        raise InvalidArgument(*err.args)
+    except ckanapi.CKANAPIError as err:
+        # e.g., a search error, or a 5xx that ckanapi couldn't parse
+        raise Failed(*err.args)
+    except (requests.ConnectionError, requests.Timeout) as err:
+        raise Unavailable(str(err))
+    except requests.RequestException as err:
+        raise Failed(str(err))
+
+
+def capture(func, key=None):
+    """Wraps `func` so that it returns an `Outcome` instead of raising"""
+    def wrapper(item):
+        _id = key(item) if key else item
+
+        try:
+            return Outcome(_id, func(item), None)
+        except Exception as err:
+            return Outcome(_id, None, err)
+
+    return wrapper
+
+
+def get_ckan(ckan=None, **kwargs):
+    """Returns `ckan` if given. Otherwise returns a client for the `remote`,
+    `api_key`, and `ua` kwargs that's reused by every call with the same
+    ones (so they share a session)."""
+    if ckan is not None:
+        return ckan
+
+    ckan_kwargs = {k: v for k, v in kwargs.items() if k in ckanutils.CKAN_KEYS}
+    ckan_kwargs.setdefault('quiet', True)
+    key = tuple(sorted(ckan_kwargs.items()))
+
+    with clients_lock:
+        if key not in clients:
+            with translate():
+                clients[key] = utils.get_ckan(**ckan_kwargs)
+
+        return clients[key]
+
+
+def get_ckans(src_ckan=None, dest_ckan=None, **kwargs):
+    """Returns the source and destination clients of a migration (from the
+    `src_remote` and `dest_remote` kwargs unless given)"""
+    ckan_kwargs = {k: v for k, v in kwargs.items() if k != 'remote'}
+    src_ckan = get_ckan(
+        src_ckan, remote=kwargs.get('src_remote'), **ckan_kwargs)
+    dest_ckan = get_ckan(
+        dest_ckan, remote=kwargs.get('dest_remote'), **ckan_kwargs)
+
+    return src_ckan, dest_ckan
+
+
+def get_engine(**kwargs):
+    store = blobs.get_store(kwargs.get('blob_dir'))
+    workers = kwargs.get('workers') or utils.DEF_WORKERS
+    host_limit = kwargs.get('host_limit') or transfer.DEF_HOST_LIMIT
+    return transfer.Engine(
+        workers, host_limit, kwargs.get('chunksize_bytes'), store)
+
+
+def update_datastore(resource_id, ckan=None, force=False, **kwargs):
+    """Updates a datastore table from its filestore resource if the resource
+    changed (or `force` is set). Takes the same options as `ds.update`.
+    Returns an `Updated` with a status of `updated` or `unchanged`."""
+    try:
+        hashing.get_algo(kwargs.get('hash_algo'))
+    except ValueError as err:
+        raise InvalidArgument(str(err))
+
+    ckan = get_ckan(ckan, **kwargs)
+    options = dict(UPDATE_DEFAULTS, hash_table=ckan.hash_table)
+    options.update(kwargs)
+
+    gzipped = compression.gzip_requests(ckan.address, options.get('gzip'))
+
+    with gzipped, translate():
+        status = ds.update_resource(ckan, resource_id, force, **options)
+
+    if status == 'failed':
+        raise Failed('Resource %s not updated.' % resource_id)
+
+    return Updated(resource_id, status)
+
+
+def update_datastore_many(resource_ids, ckan=None, force=False, **kwargs):
+    """Like `update_datastore`, but updates `workers` tables at a time.
+    Yields an `Outcome` for each resource as it completes."""
+    ckan = get_ckan(ckan, **kwargs)
+    engine = transfer.Engine(kwargs.get('workers') or utils.DEF_WORKERS)
+
+    def func(resource_id):
+        return update_datastore(resource_id, ckan, force, **kwargs)
+
+    return engine.map(capture(func), resource_ids)
+
+
+def fetch(resource_id, destination='.', ckan=None, engine=None, **kwargs):
+    """Downloads a filestore resource (and saves its encoding to the file's
+    extended attributes). Takes the same options as `fs.fetch`. Returns a
+    `Fetched`."""
+    ckan = get_ckan(ckan, **kwargs)
+    engine = engine or get_engine(**kwargs)
+    dkwargs = {'name_from_id': kwargs.get('name_from_id')}
+
+    with translate():
+        filepath, encoding = engine.download(
+            ckan, resource_id, destination, **dkwargs)
+
+    fs.save_encoding(filepath, encoding)
+    return Fetched(resource_id, filepath, encoding)
+
+
+def fetch_many(resource_ids, destination='.', ckan=None, **kwargs):
+    """Like `fetch`, but downloads `workers` resources at a time (at most
+    `host_limit` per host). Yields an `Outcome` for each resource as it
+    completes."""
+    ckan = get_ckan(ckan, **kwargs)
+    engine = get_engine(**kwargs)
+
+    def func(resource_id):
+        return fetch(resource_id, destination, ckan, engine, **kwargs)
+
+    return engine.map(capture(func), resource_ids)
+
+
+def migrate(resource_id, src_ckan=None, dest_ckan=None, engine=None,
+        **kwargs):
+    """Copies a filestore resource from one ckan instance (`src_ckan` or the
+    `src_remote` kwarg) to another (`dest_ckan` or `dest_remote`). Takes the
+    same options as `fs.migrate`. Returns a `Migrated`."""
+    src_ckan, dest_ckan = get_ckans(src_ckan, dest_ckan, **kwargs)
+
+    if src_ckan.address == dest_ckan.address:
+        raise InvalidArgument(
+            'The source and destination remotes (%s) must be different.' %
+            src_ckan.address)
+
+    engine = engine or get_engine(**kwargs)
+    args = (engine, src_ckan, dest_ckan, resource_id)
+    kwargs.setdefault('quiet', True)
+
+    with translate():
+        resource = fs.migrate_resource(*args, **kwargs)
+
+    if not resource:
+        raise Failed('Resource %s not uploaded.' % resource_id)
+
+    return Migrated(resource_id, resource)
+
+
+def migrate_many(resource_ids, src_ckan=None, dest_ckan=None, **kwargs):
+    """Like `migrate`, but copies `workers` resources at a time. Yields an
+    `Outcome` for each resource as it completes."""
+    src_ckan, dest_ckan = get_ckans(src_ckan, dest_ckan, **kwargs)
+    engine = get_engine(**kwargs)
+    args = (src_ckan, dest_ckan, engine)
+
+    def func(resource_id):
+        return migrate(resource_id, *args, **kwargs)
+
+    return engine.map(capture(func), resource_ids)
+
+
+def create_package(org_id, ckan=None, **kwargs):
+    """Creates a package (aka dataset) in the organization `org_id`. Takes the
+    same options as `pk.create`. Returns a `Created`."""
+    ckan = get_ckan(ckan, **kwargs)
+    options = dict(PACKAGE_DEFAULTS, **kwargs)
+
+    try:
+        with translate():
+            package = pk.create_package(ckan, org_id, **options)
+    except InvalidArgument:
+        raise
+    except ValueError as err:
+        # an unknown organization, license, or group
+        raise InvalidArgument(str(err))
+
+    return Created(package['id'], package)
+
+
+def create_package_many(packages, ckan=None, **kwargs):
+    """Like `create_package`, but creates `workers` packages at a time. Each
+    package is a dict of `create_package` kwargs (including `org_id`). Yields
+    an `Outcome` (with the package's `name` or `title` as its id) for each
+    package as it completes."""
+    ckan = get_ckan(ckan, **kwargs)
+    engine = transfer.Engine(kwargs.get('workers') or utils.DEF_WORKERS)
+
+    def key(package):
+        return package.get('name') or package.get('title')
+
+    def func(package):
+        options = dict(kwargs, **package)
+        return create_package(options.pop('org_id'), ckan, **options)
+
+    return engine.map(capture(func, key), packages)
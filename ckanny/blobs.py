@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" A content addressed cache of downloaded resources """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import json
+import fcntl
+import shutil
+
+from errno import EEXIST
+from hashlib import sha1
+from os import (
+    chmod, environ, link, makedirs, remove, rename, stat, utime, walk,
+    path as p)
+
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+from . import utils
+
+BLOB_DIR_ENV = 'CKANNY_BLOB_DIR'
+BLOB_SIZE_ENV = 'CKANNY_BLOB_SIZE'
+DEF_BLOB_SIZE = 10 * 2 ** 30
+CHUNKSIZE = 2 ** 16
+
+# the resource metadata that changes whenever its file does. The revision is
+# left out since updating the resource's datastore table bumps it.
+REF_KEYS = ['id', 'url', 'last_modified', 'size', 'hash']
+HEADER_KEYS = ['content-disposition', 'content-type']
+
+# blobs are read only so that they aren't changed by accident. Files go into
+# the store as copies, so a user's file is never made read only.
+READ_ONLY = 0o444
+
+# the linux ioctl that clones a file (copy on write) on btrfs, xfs, etc.
+FICLONE = 0x40049409
+
+lock = Lock()
+
+
+def get_ref(resource):
+    """The cache key of a resource's current file. Returns `None` for
+    resources without a modification date (whose file may change without
+    anything to tell)."""
+    if not resource.get('last_modified'):
+        return None
+
+    values = [resource.get(k) for k in REF_KEYS]
+    return sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def get_store(blob_dir=None):
+    """Returns the blob store in `blob_dir`, or `None` if caching is off"""
+    blob_dir = blob_dir or environ.get(BLOB_DIR_ENV)
+    max_size = int(environ.get(BLOB_SIZE_ENV) or DEF_BLOB_SIZE)
+    return BlobStore(blob_dir, max_size) if blob_dir else None
+
+
+def reflink(source, destination):
+    """Clones a file without copying its data. Raises an `IOError` if the
+    filesystem can't."""
+    with open(source, 'rb') as sf, open(destination, 'wb') as df:
+        fcntl.ioctl(df.fileno(), FICLONE, sf.fileno())
+
+
+def place(source, destination):
+    """Puts a blob at `destination` without copying its data if possible: as
+    a (writable) copy on write clone, or else a hardlink (which shares the
+    blob's read only mode, so the blob can't be changed through it). Falls
+    back to a copy."""
+    if p.exists(destination):
+        remove(destination)
+
+    try:
+        return reflink(source, destination)
+    except (IOError, OSError):
+        if p.exists(destination):
+            remove(destination)
+
+    try:
+        return link(source, destination)
+    except OSError:
+        # e.g., the store is on another filesystem
+        shutil.copyfile(source, destination)
+
+
+class BlobStore(object):
+    """Files named by the hash of their content (`objects/`) plus refs that
+    map a resource's current file to its hash (`refs/`). Once the objects
+    take up more than `max_size` bytes, the least recently used ones are
+    evicted.
+    """
+    def __init__(self, root, max_size=DEF_BLOB_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.objects = p.join(root, 'objects')
+        self.refs = p.join(root, 'refs')
+        self.tmp = p.join(root, 'tmp')
+
+        for dirpath in [self.objects, self.refs, self.tmp]:
+            try:
+                makedirs(dirpath)
+            except OSError as err:
+                if err.errno != EEXIST:
+                    raise
+
+    def path(self, digest):
+        return p.join(self.objects, digest)
+
+    def lookup(self, resource):
+        """Finds the cached copy of a resource's current file. Returns the
+        ref (with the blob `path`) or `None`."""
+        ref_id, ttl = get_ref(resource), float('inf')
+        name = '%s.json' % ref_id
+        ref = utils.read_cache(name, ttl, self.refs) if ref_id else None
+        filepath = self.path(ref['hash']) if ref else None
+
+        if filepath and p.exists(filepath):
+            # mark as recently used
+            utime(filepath, None)
+            return dict(ref, path=filepath)
+
+    def open(self, resource):
+        """Opens the cached copy of a resource's current file (if any)"""
+        ref = self.lookup(resource)
+        return open(ref['path'], 'rb') if ref else None
+
+    def put(self, source, digest, resource=None, **kwargs):
+        """Adds a file (path or file object) to the store. `headers` and
+        `encoding` of the response it came from are kept in the resource's
+        ref. Returns the blob path."""
+        filepath = self.path(digest)
+
+        if not p.exists(filepath):
+            with NamedTemporaryFile(dir=self.tmp, delete=False) as f:
+                if hasattr(source, 'read'):
+                    source.seek(0)
+                    shutil.copyfileobj(source, f, CHUNKSIZE)
+                    source.seek(0)
+                else:
+                    with open(source, 'rb') as sf:
+                        shutil.copyfileobj(sf, f, CHUNKSIZE)
+
+            chmod(f.name, READ_ONLY)
+            rename(f.name, filepath)
+
+        ref_id = get_ref(resource) if resource else None
+
+        if ref_id:
+            headers = kwargs.get('headers') or {}
+            headers = {k: headers[k] for k in HEADER_KEYS if k in headers}
+            encoding = kwargs.get('encoding')
+            ref = {'hash': digest, 'headers': headers, 'encoding': encoding}
+
+            utils.write_cache('%s.json' % ref_id, ref, self.refs)
+
+        self.evict()
+        return filepath
+
+    def evict(self):
+        """Removes the least recently used blobs until the store fits"""
+        with lock:
+            blobs = []
+
+            for dirpath, _, filenames in walk(self.objects):
+                for filename in filenames:
+                    info = stat(p.join(dirpath, filename))
+                    blobs.append((info.st_mtime, info.st_size, filename))
+
+            total = sum(b[1] for b in blobs)
+
+            for _, size, filename in sorted(blobs):
+                if total <= self.max_size:
+                    break
+
+                remove(p.join(self.objects, filename))
+                total -= size
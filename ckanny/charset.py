@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Sampled file encoding detection (cached in extended attributes) """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import re
+import codecs
+import sys
+
+from os import stat
+
+from xattr import xattr
+
+from . import compression
+
+# linux only allows unprivileged attributes in the `user` namespace
+PREFIX = 'user.' if sys.platform.startswith('linux') else ''
+ENCODING_ATTR = '%scom.ckanny.encoding' % PREFIX
+STAMP_ATTR = '%scom.ckanny.encoding-stamp' % PREFIX
+HEAD_BYTES = 256 * 2 ** 10
+TAIL_BYTES = 64 * 2 ** 10
+DETECT_BYTES = 32 * 2 ** 10
+DEF_ENCODING = 'utf-8'
+NON_ASCII = re.compile(b'[\x80-\xff]')
+
+BOMS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16')]
+
+
+def get_stamp(filepath):
+    info = stat(filepath)
+    return '%i:%i' % (info.st_size, info.st_mtime)
+
+
+def read_sample(f, size=None):
+    """Reads the head of a file plus (if `size` is given and the file is
+    larger) its tail, starting at a line break"""
+    head = f.read(HEAD_BYTES)
+
+    if not size or size <= HEAD_BYTES + TAIL_BYTES:
+        return head, b''
+
+    f.seek(size - TAIL_BYTES)
+    tail = f.read(TAIL_BYTES)
+
+    # the tail may start half way through a multibyte character
+    return head, tail.partition(b'\n')[2]
+
+
+def is_utf8(content):
+    # the head may end half way through a multibyte character
+    decoder = codecs.getincrementaldecoder('utf-8')()
+
+    try:
+        decoder.decode(content, final=False)
+    except UnicodeDecodeError:
+        return False
+    else:
+        return True
+
+
+def detect(f, size=None):
+    """Detects the encoding of a file object from a sample of it
+
+    >>> from io import BytesIO
+    >>> detect(BytesIO('café,2\\n'.encode('utf-8')))
+    u'utf-8'
+    >>> detect(BytesIO(codecs.BOM_UTF8 + b'id,name\\n'))
+    u'utf-8-sig'
+    """
+    head, tail = read_sample(f, size)
+
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+
+    if is_utf8(head) and is_utf8(tail):
+        return DEF_ENCODING
+
+    from chardet.universaldetector import UniversalDetector
+
+    detector, fed = UniversalDetector(), 0
+    lines = (head + b'\n' + tail).splitlines(True)
+
+    # `chardet` is slow, so it only sees (some of) the lines that aren't ascii
+    for line in (l for l in lines if NON_ASCII.search(l)):
+        detector.feed(line)
+        fed += len(line)
+
+        if detector.done or fed > DETECT_BYTES:
+            break
+
+    detector.close()
+    encoding = detector.result.get('encoding')
+    return encoding.lower() if encoding else DEF_ENCODING
+
+
+def save(filepath, encoding):
+    """Saves a file's encoding (and the size and modification time it
+    applies to) to its extended attributes. Returns whether it could."""
+    x = xattr(filepath)
+
+    try:
+        x[ENCODING_ATTR] = encoding.encode('ascii')
+        x[STAMP_ATTR] = get_stamp(filepath).encode('ascii')
+    except (IOError, OSError):
+        return False
+    else:
+        return True
+
+
+def get_encoding(filepath):
+    """Returns a file's encoding from its extended attributes. If they are
+    missing (or the file has changed since), the encoding is detected from a
+    sample of the file and saved. Returns the encoding and whether it was
+    detected."""
+    x = xattr(filepath)
+
+    try:
+        encoding = x.get(ENCODING_ATTR).decode('ascii')
+    except (IOError, OSError):
+        encoding = None
+
+    try:
+        stamp = x.get(STAMP_ATTR).decode('ascii')
+    except (IOError, OSError):
+        # encodings saved without a stamp came from the server
+        stamp = get_stamp(filepath) if encoding else None
+
+    if encoding and stamp == get_stamp(filepath):
+        return encoding, False
+
+    if compression.split_ext(filepath)[1]:
+        # compressed files can't be cheaply read from the end
+        f, size = compression.open_source(filepath)[0], None
+    else:
+        f, size = open(filepath, 'rb'), stat(filepath).st_size
+
+    try:
+        encoding = detect(f, size)
+    finally:
+        f.close()
+
+    save(filepath, encoding)
+    return encoding, True
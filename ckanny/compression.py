@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Compressed sources and request bodies """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import bz2
+import gzip
+import zlib
+
+from contextlib import contextmanager
+from functools import wraps
+from mimetypes import guess_type
+from os import path as p
+from threading import Lock
+from urlparse import urlparse
+
+EXTENSIONS = {'.gz', '.bz2', '.xz'}
+GZIP_ACTIONS = {'datastore_create', 'datastore_upsert'}
+GZIP_LEVEL = 6
+MIN_GZIP_BYTES = 2 ** 10
+
+# the hosts to send gzipped request bodies to (and the number of active
+# `gzip_requests` blocks of each), and those that rejected them
+gzip_hosts = {}
+rejected_hosts = set()
+hosts_lock = Lock()
+
+
+def split_ext(filepath):
+    """Splits the compression extension (if any) off a file path
+
+    >>> split_ext('data.csv.gz') == ('data.csv', '.gz')
+    True
+    >>> split_ext('data.csv') == ('data.csv', '')
+    True
+    """
+    root, ext = p.splitext(filepath)
+    return (root, ext.lower()) if ext.lower() in EXTENSIONS else (filepath, '')
+
+
+def get_opener(ext):
+    if ext == '.gz':
+        return gzip.GzipFile
+    elif ext == '.bz2':
+        return bz2.BZ2File
+
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            msg = 'Reading `.xz` files requires the `backports.lzma` package.'
+            raise ValueError(msg)
+
+    return lzma.LZMAFile
+
+
+class Source(object):
+    """A decompressing file object named after the file it inflates to (so
+    that uploads and parsers see e.g. `data.csv` rather than `data.csv.gz`)
+    """
+    def __init__(self, f, name):
+        self.f = f
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self.f, attr)
+
+    def __iter__(self):
+        return iter(self.f)
+
+
+def open_source(filepath):
+    """Opens a local `.gz`, `.bz2`, or `.xz` file so that it's decompressed as
+    it's read. Returns the file object and the guessed content type of the
+    decompressed file."""
+    name, ext = split_ext(filepath)
+    f = Source(get_opener(ext)(filepath, 'rb'), p.basename(name))
+    return f, guess_type(name)[0]
+
+
+def gzip_body(content):
+    # the extra 16 makes zlib write a gzip (rather than zlib) header
+    wbits = 16 + zlib.MAX_WBITS
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, wbits)
+    return compressor.compress(content) + compressor.flush()
+
+
+@contextmanager
+def gzip_requests(address, enabled=True):
+    """Sends the json bodies of datastore requests to `address` gzipped
+    within the block (if `enabled`). If the server rejects them, the request
+    is resent as is and the host is dropped until the block ends."""
+    netloc = urlparse(address).netloc
+
+    if enabled:
+        install()
+
+        with hosts_lock:
+            gzip_hosts[netloc] = gzip_hosts.get(netloc, 0) + 1
+
+    try:
+        yield
+    finally:
+        if enabled:
+            with hosts_lock:
+                gzip_hosts[netloc] -= 1
+
+                if not gzip_hosts[netloc]:
+                    del gzip_hosts[netloc]
+                    rejected_hosts.discard(netloc)
+
+
+def install():
+    """Patches `requests` to gzip the bodies sent to `gzip_hosts`. Outside of
+    `gzip_requests` blocks, the patch passes requests through as is."""
+    import requests
+
+    send = requests.Session.send
+
+    if getattr(send, 'gzipped', False):
+        return
+
+    @wraps(send)
+    def wrapper(session, request, **kwargs):
+        url = urlparse(request.url)
+        action = url.path.rsplit('/', 1)[-1]
+        ctype = request.headers.get('Content-Type')
+        compress = url.netloc in gzip_hosts and action in GZIP_ACTIONS
+        compress = compress and url.netloc not in rejected_hosts
+        compress = compress and ctype == 'application/json'
+
+        if not (compress and len(request.body or b'') >= MIN_GZIP_BYTES):
+            return send(session, request, **kwargs)
+
+        gzipped = request.copy()
+        gzipped.body = gzip_body(request.body)
+        # httplib can't join unicode headers with a binary body
+        gzipped.headers[b'Content-Encoding'] = b'gzip'
+        gzipped.headers[b'Content-Length'] = bytes(len(gzipped.body))
+        r = send(session, gzipped, **kwargs)
+
+        if r.status_code in {400, 415}:
+            rejected_hosts.add(url.netloc)
+            r = send(session, request, **kwargs)
+
+        return r
+
+    wrapper.gzipped = True
+    requests.Session.send = wrapper
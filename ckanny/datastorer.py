@@ -8,19 +8,42 @@ from __future__ import (
     absolute_import, division, print_function, with_statement,
     unicode_literals)
 
+import csv
+import json
+import random
 import sys
+import ckanapi
+import requests
 import ckanutils as api
 
+from collections import OrderedDict
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
-from os import environ, path as p
-from tempfile import SpooledTemporaryFile
+from os import environ, stat, path as p
+from threading import Lock
+from time import sleep, time
+from urlparse import urlparse
 
 from manager import Manager
-from xattr import xattr
-from ckanutils import CKAN
 from tabutils import io as tio
 
+from . import (
+    blobs, charset, compression, hashing, journal, preflight, spool, stats,
+    utils)
+
 manager = Manager()
+hash_table_lock = Lock()
+WATCH_HEADERS = ['etag', 'last-modified', 'content-length']
+DEF_WATCH_INTERVAL = 5 * 60
+DEF_WATCH_JITTER = 0.1
+
+# seconds to wait for a resource's server to answer a watch's `HEAD` request
+WATCH_TIMEOUT = 30
+
+# updating the datastore table bumps the resource's revision, so (like the
+# blob store) the watch leaves it out
+FINGERPRINT_KEYS = blobs.REF_KEYS
 
 
 def get_message(changed, force):
@@ -35,6 +58,465 @@ def get_message(changed, force):
     return message
 
 
+def create_hash_resource(ckan, **kwargs):
+    """Creates the hash table resource (unless another process already has).
+    Processes that race to create it all settle on the first one created."""
+    table = kwargs['hash_table']
+    resources = ckan.package_show(id=table)['resources']
+
+    if not resources:
+        fileobj = StringIO('datastore_id,hash\n')
+        create_kwargs = {'fileobj': fileobj, 'name': api.DEF_HASH_RES}
+        ckan.create_resource(table, **create_kwargs)
+        resources = ckan.package_show(id=table)['resources']
+
+    return resources[0]['id']
+
+
+def get_hash(ckan, resource_id, **kwargs):
+    """Gets the hash of a datastore table, creating the hash table if it
+    doesn't exist yet"""
+    verbose = not kwargs.get('quiet')
+
+    try:
+        return ckan.get_hash(resource_id)
+    except api.NotFound as err:
+        item = err.args[0]['item']
+
+    with hash_table_lock:
+        # another thread may have created the hash table while we waited
+        if item == 'package' and not ckan.hash_table_pack:
+            orgs = ckan.organization_list(permission='admin_group')
+            owner_org = (
+                o['id'] for o in orgs
+                if o['display_name'] == kwargs['hash_group']).next()
+
+            package_kwargs = {
+                'name': kwargs['hash_table'],
+                'owner_org': owner_org,
+                'package_creator': 'Hash Table',
+                'dataset_source': 'Multiple sources',
+                'notes': 'Datastore resource hash table'
+            }
+
+            try:
+                ckan.hash_table_pack = ckan.package_create(**package_kwargs)
+            except ckanapi.ValidationError:
+                # another process created it first
+                table = kwargs['hash_table']
+                ckan.hash_table_pack = ckan.package_show(id=table)
+
+        if item in {'package', 'resource'} and not ckan.hash_table_id:
+            ckan.hash_table_id = create_hash_resource(ckan, **kwargs)
+            ckan.create_hash_table(verbose)
+        elif item == 'datastore':
+            ckan.create_hash_table(verbose)
+
+    return ckan.get_hash(resource_id)
+
+
+def update_hash(ckan, resource_id, resource_hash, **kwargs):
+    """Stores the hash of a datastore table. The hash table is keyed by
+    `datastore_id`, so this is a single row upsert that can't clobber the
+    hashes other (concurrent) updates store."""
+    if not kwargs.get('quiet'):
+        print('Updating hash table...')
+
+    record = {'datastore_id': resource_id, 'hash': resource_hash}
+    ukwargs = {'method': 'upsert', 'force': True, 'records': [record]}
+    return ckan.datastore_upsert(resource_id=ckan.hash_table_id, **ukwargs)
+
+
+def create_keys(ckan, resource_id, **deferred):
+    """Adds the deferred `primary_key` and then `indexes` to a loaded table,
+    printing each one that can't be created (e.g., a primary key over rows
+    with duplicate keys) to stderr. The table then keeps its rows (and the
+    rest) without it. Returns whether everything was created."""
+    created = True
+
+    for key in ['primary_key', 'indexes']:
+        if not deferred.get(key):
+            continue
+
+        ckwargs = {'resource_id': resource_id, 'force': True}
+        ckwargs[key] = deferred[key]
+
+        try:
+            ckan.datastore_create(**ckwargs)
+        except ckanapi.ValidationError as err:
+            created = False
+            msg = "ERROR: couldn't create the %s `%s` of resource %s: %s"
+            name = key.replace('_', ' ')
+            args = (name, deferred[key], resource_id, err)
+            print(msg % args, file=sys.stderr)
+
+    return created
+
+
+def update_datastore(ckan, resource_id, source, **kwargs):
+    """Loads a file into a datastore table. With `bulk_load`, the table is
+    recreated without its primary key or indexes, the rows are inserted
+    (rather than upserted), and then the primary key and indexes are
+    created. Returns `False` if any of them couldn't be."""
+    if not kwargs.get('bulk_load'):
+        return ckan.update_datastore(resource_id, source, **kwargs)
+
+    keys = ['primary_key', 'indexes']
+    deferred = {k: kwargs.pop(k) for k in keys if kwargs.get(k)}
+    updated = ckan.update_datastore(resource_id, source, **kwargs)
+
+    if updated and deferred:
+        with stats.timer('create indexes'):
+            updated = create_keys(ckan, resource_id, **deferred)
+
+    return updated
+
+
+def hash_ref(f, ref, algo, chunksize):
+    """Returns the hash (taken with `algo`) of a blob store hit"""
+    stats.add('blob store hit', bytes=p.getsize(ref['path']))
+
+    if hashing.parse(ref['hash'])[0] == algo:
+        return ref['hash']
+
+    with stats.timer('hash', bytes=p.getsize(ref['path'])):
+        return hashing.hash_file(f, algo, chunksize)
+
+
+def download(r, f, algo, chunksize):
+    """Writes the content of a resource's response to `f`. Returns its hash
+    (taken with `algo`)."""
+    # requests negotiates gzip/deflate and inflates the content as it's read,
+    # so `content-length` is only the file size if it wasn't encoded
+    encoded = r.headers.get('content-encoding')
+    write_kwargs = {
+        'length': None if encoded else r.headers.get('content-length'),
+        'chunksize': chunksize
+    }
+
+    try:
+        with stats.timer('download') as counts:
+            tio.write(f, r.iter_content, **write_kwargs)
+            counts['bytes'] = utils.filesize(f)
+    finally:
+        r.close()
+
+    with stats.timer('hash', bytes=counts['bytes']):
+        return hashing.hash_file(f, algo, chunksize)
+
+
+def update_resource(ckan, resource_id, force=False, **kwargs):
+    """Updates a datastore table if its filestore resource has changed.
+    Returns one of `updated`, `unchanged`, or `failed`."""
+    verbose = not kwargs.get('quiet')
+    chunk_bytes = kwargs.get('chunksize_bytes') or api.CHUNKSIZE_BYTES
+    algo = hashing.get_algo(kwargs.get('hash_algo'))
+    store = blobs.get_store(kwargs.get('blob_dir'))
+    resource = ckan.resource_show(id=resource_id) if store else {}
+    ref = store.lookup(resource) if store else None
+
+    if ref:
+        kwargs['encoding'] = ref['encoding']
+        kwargs['content_type'] = ref['headers'].get('content-type')
+        f = open(ref['path'], 'rb')
+    else:
+        r = ckan.fetch_resource(resource_id)
+        kwargs['encoding'] = r.encoding
+        kwargs['content_type'] = r.headers['content-type']
+        skwargs = {'dir': kwargs.get('tmpdir'), 'suffix': '.xlsx'}
+        max_size = kwargs.get('spool_max_bytes')
+
+        if max_size is not None:
+            skwargs['max_size'] = max_size
+
+        f = spool.Spool(mode='r+b', **skwargs)
+
+    try:
+        if ref:
+            new_hash = hash_ref(f, ref, algo, chunk_bytes)
+        else:
+            new_hash = download(r, f, algo, chunk_bytes)
+
+        if store and not ref:
+            skwargs = {'headers': r.headers, 'encoding': r.encoding}
+            store.put(f, new_hash, resource, **skwargs)
+
+        with stats.timer('hash table lookup'):
+            old_hash = get_hash(ckan, resource_id, **kwargs)
+
+        if old_hash:
+            with stats.timer('hash comparison'):
+                changed = hashing.compare(f, new_hash, old_hash)
+        else:
+            changed = True
+
+        if verbose:
+            print(get_message(changed, force))
+
+        if not (changed or force):
+            if new_hash != old_hash:
+                # store the hash taken with the current algorithm
+                with stats.timer('hash table update'):
+                    update_hash(ckan, resource_id, new_hash, **kwargs)
+
+            return 'unchanged'
+
+        with stats.timer('parse, cast, and upsert'):
+            with journal.load(ckan, resource_id, new_hash, **kwargs):
+                updated = update_datastore(ckan, resource_id, f, **kwargs)
+    finally:
+        # frees the spool's share of the memory budget
+        f.close()
+
+    if updated and verbose:
+        print('Success! Resource %s updated.' % resource_id)
+
+    if updated and changed:
+        with stats.timer('hash table update'):
+            update_hash(ckan, resource_id, new_hash, **kwargs)
+
+    return 'updated' if updated else 'failed'
+
+
+def get_fields(ckan, resource_id):
+    """Returns a datastore table's fields, or `None` if it doesn't exist"""
+    try:
+        result = ckan.datastore_search(resource_id=resource_id, limit=0)
+    except api.NotFound:
+        return None
+
+    return [f for f in result['fields'] if f['id'] != '_id']
+
+
+def check_source(ckan, resource_id, source, **kwargs):
+    """Runs the pre-flight checks on a csv file, printing each problem to
+    stderr. Rows upserted into an existing table are checked against its
+    fields. Returns the number of problems found."""
+    name, ext = compression.split_ext(source)
+
+    if p.splitext(name)[1].lower() != '.csv':
+        if not kwargs.get('quiet'):
+            print('Skipping pre-flight checks (only csv files are checked).')
+
+        return 0
+
+    upsert = kwargs.get('primary_key') and not kwargs.get('bulk_load')
+    fields = get_fields(ckan, resource_id) if upsert else None
+    f = compression.open_source(source)[0] if ext else open(source, 'rb')
+    count = 0
+
+    try:
+        for line, message in preflight.validate(f, fields=fields, **kwargs):
+            print('ERROR: line %i: %s' % (line, message), file=sys.stderr)
+            count += 1
+    finally:
+        f.close()
+
+    return count
+
+
+def run_checks(ckan, resource_id, source, **kwargs):
+    """Runs the pre-flight checks on a file. Returns an error message if they
+    fail."""
+    with stats.timer('pre-flight checks', bytes=p.getsize(source)):
+        try:
+            count = check_source(ckan, resource_id, source, **kwargs)
+        except ValueError as err:
+            return str(err)
+
+    if count:
+        msg = '%i problem(s) found. Resource %s not uploaded.'
+        return msg % (count, resource_id)
+    elif not kwargs.get('quiet'):
+        print('Pre-flight checks passed.')
+
+
+def get_encoding(source, encoding=None, verbose=True):
+    """Returns `encoding` if given, otherwise reads (or detects) the file's
+    encoding from its extended attributes"""
+    if not encoding:
+        with stats.timer('encoding detection'):
+            encoding, detected = charset.get_encoding(source)
+
+        if verbose and detected:
+            print('Detected encoding %s' % encoding)
+
+    if verbose:
+        print('Using encoding %s' % encoding)
+
+    return encoding
+
+
+def get_fingerprint(ckan, resource_id):
+    """A cheap fingerprint of a resource's file: its metadata plus the
+    `ETag`, `Last-Modified`, and `Content-Length` headers of a `HEAD` request
+    to its url (if the server answers one). Raises a `requests.Timeout` if
+    the server doesn't answer within `WATCH_TIMEOUT` seconds."""
+    resource = ckan.resource_show(id=resource_id)
+    values = [resource.get(k) for k in FINGERPRINT_KEYS]
+    url = resource.get('perma_link') or resource.get('url')
+    headers = {'User-Agent': ckan.user_agent}
+    hkwargs = {'allow_redirects': True, 'timeout': WATCH_TIMEOUT}
+
+    try:
+        r = requests.head(url, headers=headers, **hkwargs)
+    except requests.exceptions.Timeout:
+        raise
+    except (requests.exceptions.RequestException, ValueError):
+        r = None
+
+    if r is not None and r.ok:
+        values.extend(r.headers.get(k) for k in WATCH_HEADERS)
+
+    return sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def poll(ckan, resource_id, **kwargs):
+    """Updates a datastore table if its resource's fingerprint changed since
+    the last poll. Returns one of `skipped`, `updated`, `unchanged`, or
+    `failed`."""
+    name = 'watch-%s-%s.json' % (urlparse(ckan.address).netloc, resource_id)
+    last = utils.read_cache(name, float('inf')) or {}
+    fingerprint = get_fingerprint(ckan, resource_id)
+
+    if fingerprint == last.get('fingerprint'):
+        return 'skipped'
+
+    status = update_resource(ckan, resource_id, **kwargs)
+
+    if status != 'failed':
+        utils.write_cache(name, {'fingerprint': fingerprint})
+
+    return status
+
+
+def run_many(func, resource_ids, workers, verbose=True):
+    """Runs `func` (which returns an update status) on `workers` resources at
+    a time, and reports each result (errors to stderr). Returns the ids of
+    those that failed to update."""
+    def wrapper(resource_id):
+        try:
+            return resource_id, func(resource_id), None
+        except Exception as err:
+            return resource_id, 'failed', err
+
+    results = utils.pmap(wrapper, resource_ids, workers, False)
+    failed = []
+
+    for resource_id, status, err in results:
+        if status == 'failed':
+            failed.append(resource_id)
+            msg = ': %s' % err if err else ''
+            print(
+                'ERROR: resource %s not updated%s' % (resource_id, msg),
+                file=sys.stderr)
+        elif verbose:
+            print('Resource %s %s.' % (resource_id, status))
+
+    return failed
+
+
+def poll_many(ckan, resource_ids, verbose=True, **kwargs):
+    """Polls `workers` resources at a time. Returns the ids of those that
+    failed to update."""
+    def func(resource_id):
+        return poll(ckan, resource_id, **kwargs)
+
+    return run_many(func, resource_ids, kwargs['workers'], verbose)
+
+
+def quote(identifier):
+    """Quotes a postgres identifier
+
+    >>> quote('Total Pop') == '"Total Pop"'
+    True
+    """
+    return '"%s"' % identifier.replace('"', '""')
+
+
+def iter_pages(ckan, resource_id, names, page_size=api.CHUNKSIZE_ROWS):
+    """Yields the records of a datastore table a page at a time. Pages are
+    selected by `_id` (keyset pagination) so that each is as fast as the
+    first, falling back to offsets on sites that disable sql search. The next
+    page is fetched while the current one is consumed. Sites may cap pages
+    below `page_size`, so only an empty page ends the table."""
+    search_sql = utils.get_action(ckan, 'datastore_search_sql')
+    columns = ', '.join(map(quote, ['_id'] + names))
+    sql = 'SELECT %s FROM %s WHERE _id > %%i ORDER BY _id LIMIT %i' % (
+        columns, quote(resource_id), page_size)
+
+    skwargs = {'resource_id': resource_id, 'limit': page_size, 'sort': '_id'}
+
+    def by_key(page, offset):
+        after = page[-1]['_id'] if page else 0
+        return search_sql(sql=sql % after)['records']
+
+    def by_offset(page, offset):
+        return ckan.datastore_search(offset=offset, **skwargs)['records']
+
+    try:
+        fetch, page = by_key, by_key([], 0)
+    except ckanapi.CKANAPIError:
+        fetch, page = by_offset, by_offset([], 0)
+
+    pool, offset = ThreadPool(1), 0
+
+    try:
+        while page:
+            offset += len(page)
+            pending = pool.apply_async(fetch, (page, offset))
+            yield page
+            page = pending.get()
+    finally:
+        pool.terminate()
+
+
+def encode(value):
+    if value is None:
+        return b''
+    elif isinstance(value, (dict, list)):
+        return json.dumps(value)
+    else:
+        return unicode(value).encode('utf-8')
+
+
+def write_csv(f, fields, pages):
+    names = [field['id'] for field in fields]
+    writer = csv.writer(f)
+    writer.writerow(map(encode, names))
+
+    for page in pages:
+        writer.writerows([map(encode, map(r.get, names)) for r in page])
+        yield len(page)
+
+
+def write_jsonl(f, fields, pages):
+    names = [field['id'] for field in fields]
+
+    for page in pages:
+        for record in page:
+            row = OrderedDict((n, record.get(n)) for n in names)
+            f.write(json.dumps(row) + b'\n')
+
+        yield len(page)
+
+
+def write_columns(f, fields, pages):
+    """Writes the fields followed by each page as a json object that maps each
+    field to its column of values"""
+    names = [field['id'] for field in fields]
+    f.write(json.dumps({'fields': fields}) + b'\n')
+
+    for page in pages:
+        columns = OrderedDict((n, [r.get(n) for r in page]) for n in names)
+        f.write(json.dumps(columns) + b'\n')
+        yield len(page)
+
+
+# the writer of each export format
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl, 'columns': write_columns}
+
+
 @manager.arg(
     'resource_id', help='the resource id', nargs='?', default=sys.stdin)
 @manager.arg(
@@ -64,6 +546,11 @@ def get_message(changed, force):
     'first_col', 'o', help='the first row (zero indexed)',
     type=int, default=0)
 @manager.arg('primary_key', 'p', help="Unique field(s), e.g., 'field1,field2'")
+@manager.arg('indexes', 'I', help="Field(s) to index, e.g., 'field1,field2'")
+@manager.arg(
+    'bulk_load', 'B', help=('replace the table, inserting all rows before'
+    ' creating the primary key and indexes (faster for large loads)'),
+    type=bool, default=False)
 @manager.arg(
     'quiet', 'q', help='suppress debug statements', type=bool, default=False)
 @manager.arg(
@@ -71,82 +558,145 @@ def get_message(changed, force):
 @manager.arg(
     'sanitize', 's', help='underscorify and lowercase field names', type=bool,
     default=False)
+@manager.arg(
+    'gzip', 'z', help=('gzip the rows sent to the datastore (falls back to'
+    " uncompressed if the server doesn't accept it)"), type=bool,
+    default=False)
+@manager.arg(
+    'retries', 'm', help='number of times to retry a failed chunk',
+    type=int, default=utils.DEF_RETRIES)
+@manager.arg(
+    'resume', 'x', help=('skip the chunks committed by the last (failed) load'
+    ' of the same file'), type=bool, default=False)
+@manager.arg(
+    'blob_dir', 'b', help=('the blob store directory, to reuse earlier'
+    ' downloads (uses `%s` ENV if available)') % blobs.BLOB_DIR_ENV,
+    default=environ.get(blobs.BLOB_DIR_ENV))
+@manager.arg(
+    'spool_max_bytes', 'S', help=('number of bytes of the download to keep in'
+    ' memory before spilling to disk (all concurrent downloads share the'
+    ' `%s` ENV budget, default: %i)') % (
+        spool.SPOOL_BUDGET_ENV, spool.DEF_SPOOL_BUDGET),
+    type=int, default=spool.DEF_SPOOL_BYTES)
+@manager.arg(
+    'tmpdir', 'T', help=('the directory to spill downloads to (default: the'
+    ' system temp directory)'))
+@manager.arg(
+    'hash_algo', 'a', help=('the hash algorithm used to detect changes (one'
+    ' of %s, uses `%s` ENV if available)') % (
+        ', '.join(sorted(hashing.ALGOS)), hashing.HASH_ALGO_ENV),
+    default=environ.get(hashing.HASH_ALGO_ENV, hashing.DEF_ALGO))
 @manager.arg(
     'force', 'f', help="update resource even if it hasn't changed.",
     type=bool, default=False)
 @manager.command
 def update(resource_id, force=None, **kwargs):
     """Updates a datastore table based on the current filestore resource"""
-    verbose = not kwargs.get('quiet')
-    chunk_bytes = kwargs.get('chunk_bytes', api.CHUNKSIZE_BYTES)
     ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
-    hash_kwargs = {'chunksize': chunk_bytes, 'verbose': verbose}
-    ckan = CKAN(**ckan_kwargs)
 
     try:
-        r = ckan.fetch_resource(resource_id)
-    except (api.NotFound, api.NotAuthorized) as err:
-        sys.exit('ERROR: %s\n' % str(err))
-    else:
-        f = SpooledTemporaryFile(suffix='.xlsx', mode='r+b')
-        write_kwargs = {
-            'length': r.headers.get('content-length'),
-            'chunksize': chunk_bytes
-        }
+        hashing.get_algo(kwargs['hash_algo'])
+    except ValueError as err:
+        sys.exit('ERROR: %s' % err)
 
-        tio.write(f, r.iter_content, **write_kwargs)
+    ckan = utils.get_ckan(**ckan_kwargs)
 
-        try:
-            old_hash = ckan.get_hash(resource_id)
-        except api.NotFound as err:
-            item = err.args[0]['item']
-
-            if item == 'package':
-                orgs = ckan.organization_list(permission='admin_group')
-                owner_org = (
-                    o['id'] for o in orgs
-                    if o['display_name'] == kwargs['hash_group']).next()
-
-                package_kwargs = {
-                    'name': kwargs['hash_table'],
-                    'owner_org': owner_org,
-                    'package_creator': 'Hash Table',
-                    'dataset_source': 'Multiple sources',
-                    'notes': 'Datastore resource hash table'
-                }
+    try:
+        with compression.gzip_requests(ckan.address, kwargs.get('gzip')):
+            status = update_resource(ckan, resource_id, force, **kwargs)
+    except (api.NotFound, api.NotAuthorized) as err:
+        sys.exit('ERROR: %s\n' % str(err))
 
-                ckan.hash_table_pack = ckan.package_create(**package_kwargs)
+    if status == 'failed':
+        sys.exit('ERROR: resource %s not updated.' % resource_id)
 
-            if item in {'package', 'resource'}:
-                fileobj = StringIO('datastore_id,hash\n')
-                create_kwargs = {'fileobj': fileobj, 'name': api.DEF_HASH_RES}
-                table = kwargs['hash_table']
-                resource = ckan.create_resource(table, **create_kwargs)
-                ckan.hash_table_id = resource['id']
 
-            ckan.create_hash_table(verbose)
-            old_hash = ckan.get_hash(resource_id)
+@manager.arg(
+    'resource_ids', help='comma separated list of resource ids', nargs='?',
+    default=sys.stdin)
+@manager.arg(
+    'remote', 'r', help='the remote ckan url (uses `%s` ENV if available)' %
+    api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
+@manager.arg(
+    'api_key', 'k', help='the api key (uses `%s` ENV if available)' %
+    api.API_KEY_ENV, default=environ.get(api.API_KEY_ENV))
+@manager.arg(
+    'hash_table', 'H', help='the hash table package id',
+    default=api.DEF_HASH_PACK)
+@manager.arg(
+    'hash_group', 'g', help="the hash table's owning organization",
+    default='HDX')
+@manager.arg(
+    'ua', 'u', help='the user agent (uses `%s` ENV if available)' % api.UA_ENV,
+    default=environ.get(api.UA_ENV, api.DEF_USER_AGENT))
+@manager.arg(
+    'chunksize_rows', 'c', help='number of rows to write at a time',
+    type=int, default=api.CHUNKSIZE_ROWS)
+@manager.arg(
+    'chunksize_bytes', 'C', help='number of bytes to read/write at a time',
+    type=int, default=api.CHUNKSIZE_BYTES)
+@manager.arg(
+    'first_row', 'F', help='the first row (zero indexed)', type=int, default=0)
+@manager.arg(
+    'first_col', 'o', help='the first row (zero indexed)',
+    type=int, default=0)
+@manager.arg('primary_key', 'p', help="Unique field(s), e.g., 'field1,field2'")
+@manager.arg(
+    'quiet', 'q', help='suppress debug statements', type=bool, default=False)
+@manager.arg(
+    'type_cast', 't', help="type cast values", type=bool, default=False)
+@manager.arg(
+    'sanitize', 's', help='underscorify and lowercase field names', type=bool,
+    default=False)
+@manager.arg(
+    'blob_dir', 'b', help=('the blob store directory, to reuse earlier'
+    ' downloads (uses `%s` ENV if available)') % blobs.BLOB_DIR_ENV,
+    default=environ.get(blobs.BLOB_DIR_ENV))
+@manager.arg(
+    'hash_algo', 'a', help=('the hash algorithm used to detect changes (one'
+    ' of %s, uses `%s` ENV if available)') % (
+        ', '.join(sorted(hashing.ALGOS)), hashing.HASH_ALGO_ENV),
+    default=environ.get(hashing.HASH_ALGO_ENV, hashing.DEF_ALGO))
+@manager.arg(
+    'interval', 'i', help='seconds between polls', type=int,
+    default=DEF_WATCH_INTERVAL)
+@manager.arg(
+    'jitter', 'j', help=('the fraction of the interval to randomly add or'
+    ' subtract, so that many watchers spread out their polls'), type=float,
+    default=DEF_WATCH_JITTER)
+@manager.arg(
+    'workers', 'n', help='number of resources to poll at a time',
+    type=int, default=utils.DEF_WORKERS)
+@manager.arg(
+    'once', 'O', help='poll once and exit (e.g., to run from cron)',
+    type=bool, default=False)
+@manager.command
+def watch(resource_ids, **kwargs):
+    """Updates datastore tables whenever their filestore resources change"""
+    verbose = not kwargs['quiet']
+    ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
 
-        new_hash = tio.hash_file(f, **hash_kwargs)
-        changed = new_hash != old_hash if old_hash else True
+    try:
+        hashing.get_algo(kwargs['hash_algo'])
+    except ValueError as err:
+        sys.exit('ERROR: %s' % err)
 
-        if verbose:
-            print(get_message(changed, force))
+    ckan = utils.get_ckan(**ckan_kwargs)
+    resource_ids = utils.parse_ids(resource_ids)
+    interval, jitter = kwargs['interval'], kwargs['jitter']
 
-        if not (changed or force):
-            sys.exit(0)
+    while True:
+        start = time()
+        failed = poll_many(ckan, resource_ids, verbose, **kwargs)
 
-        kwargs['encoding'] = r.encoding
-        kwargs['content_type'] = r.headers['content-type']
-        updated = ckan.update_datastore(resource_id, f, **kwargs)
+        if kwargs['once']:
+            break
 
-        if updated and verbose:
-            print('Success! Resource %s updated.' % resource_id)
+        delay = interval * (1 + random.uniform(-jitter, jitter))
+        sleep(max(delay - (time() - start), 0))
 
-        if updated and changed:
-            ckan.update_hash_table(resource_id, new_hash, verbose)
-        elif not updated:
-            sys.exit('ERROR: resource %s not updated.' % resource_id)
+    if failed:
+        sys.exit('ERROR: %i resource(s) not updated.' % len(failed))
 
 
 @manager.arg(
@@ -154,9 +704,9 @@ def update(resource_id, force=None, **kwargs):
 @manager.arg(
     'resource_id', 'R', help='the resource id (default: source file name)')
 @manager.arg(
-    'encoding', 'e', help=("the file encoding (read from the file's extended "
-    'attributes if uploading a file downloaded with `fs.fetch` on Mac or'
-    ' Linux'), default='utf-8')
+    'encoding', 'e', help=("the file encoding (default: read from the file's"
+    ' extended attributes if uploading a file downloaded with `fs.fetch` on'
+    ' Mac or Linux, otherwise detected from a sample of the file)'))
 @manager.arg(
     'remote', 'r', help='the remote ckan url (uses `%s` ENV if available)' %
     api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
@@ -175,6 +725,11 @@ def update(resource_id, force=None, **kwargs):
     'first_col', 'o', help='the first row (zero indexed)',
     type=int, default=0)
 @manager.arg('primary_key', 'p', help="Unique field(s), e.g., 'field1,field2'")
+@manager.arg('indexes', 'I', help="Field(s) to index, e.g., 'field1,field2'")
+@manager.arg(
+    'bulk_load', 'B', help=('replace the table, inserting all rows before'
+    ' creating the primary key and indexes (faster for large loads)'),
+    type=bool, default=False)
 @manager.arg(
     'sanitize', 's', help='underscorify and lowercase field names', type=bool,
     default=False)
@@ -182,6 +737,23 @@ def update(resource_id, force=None, **kwargs):
     'quiet', 'q', help='suppress debug statements', type=bool, default=False)
 @manager.arg(
     'type_cast', 't', help="type cast values", type=bool, default=False)
+@manager.arg(
+    'gzip', 'z', help=('gzip the rows sent to the datastore (falls back to'
+    " uncompressed if the server doesn't accept it)"), type=bool,
+    default=False)
+@manager.arg(
+    'retries', 'm', help='number of times to retry a failed chunk',
+    type=int, default=utils.DEF_RETRIES)
+@manager.arg(
+    'resume', 'x', help=('skip the chunks committed by the last (failed) load'
+    ' of the same file'), type=bool, default=False)
+@manager.arg(
+    'validate', 'V', help=('check every row (widths, casts, and primary key'
+    ' uniqueness) before uploading anything (csv files only)'), type=bool,
+    default=False)
+@manager.arg(
+    'workers', 'w', help='number of processes to run the pre-flight checks on',
+    type=int, default=1)
 @manager.command
 def upload(source, resource_id=None, **kwargs):
     """Uploads a file to a datastore table"""
@@ -197,20 +769,36 @@ def upload(source, resource_id=None, **kwargs):
         print(
             'Uploading %s to datastore resource %s...' % (source, resource_id))
 
-    # read encoding from extended attributes
-    x = xattr(source)
+    kwargs['encoding'] = get_encoding(source, kwargs['encoding'], verbose)
+    ckan = utils.get_ckan(**ckan_kwargs)
+    info = stat(source)
+    source_id = '%s:%i:%i' % (p.abspath(source), info.st_size, info.st_mtime)
+    checked = (ckan, resource_id, source)
+    error = run_checks(*checked, **kwargs) if kwargs['validate'] else None
 
-    try:
-        kwargs['encoding'] = x.get('com.ckanny.encoding')
-    except IOError:
-        pass
+    if error:
+        sys.exit('ERROR: %s' % error)
 
-    if verbose and kwargs['encoding']:
-        print('Using encoding %s' % kwargs['encoding'])
+    if compression.split_ext(source)[1]:
+        # compressed files are inflated as they are parsed
+        try:
+            f, kwargs['content_type'] = compression.open_source(source)
+        except ValueError as err:
+            sys.exit('ERROR: %s' % err)
+    else:
+        f = None
 
-    ckan = CKAN(**ckan_kwargs)
+    gzipped = compression.gzip_requests(ckan.address, kwargs.get('gzip'))
 
-    if ckan.update_datastore(resource_id, source, **kwargs):
+    try:
+        with stats.timer('parse, cast, and upsert', bytes=info.st_size):
+            with gzipped, journal.load(ckan, resource_id, source_id, **kwargs):
+                args = (resource_id, f or source)
+                uploaded = update_datastore(ckan, *args, **kwargs)
+    finally:
+        f.close() if f else None
+
+    if uploaded:
         print('Success! Resource %s uploaded.' % resource_id)
     else:
         sys.exit('ERROR: resource %s not uploaded.' % resource_id)
@@ -234,9 +822,60 @@ def upload(source, resource_id=None, **kwargs):
 def delete(resource_id, **kwargs):
     """Deletes a datastore table"""
     ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
-    ckan = CKAN(**ckan_kwargs)
+    ckan = utils.get_ckan(**ckan_kwargs)
     ckan.delete_table(resource_id, filters=kwargs.get('filters'))
 
 
+@manager.arg(
+    'resource_id', help='the resource id', nargs='?', default=sys.stdin)
+@manager.arg(
+    'remote', 'r', help='the remote ckan url (uses `%s` ENV if available)' %
+    api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
+@manager.arg(
+    'api_key', 'k', help='the api key (uses `%s` ENV if available)' %
+    api.API_KEY_ENV, default=environ.get(api.API_KEY_ENV))
+@manager.arg(
+    'ua', 'u', help='the user agent (uses `%s` ENV if available)' % api.UA_ENV,
+    default=environ.get(api.UA_ENV))
+@manager.arg(
+    'output', 'o', help='the output file path (default: stdout)')
+@manager.arg(
+    'format', 'f', help='the output format', choices=sorted(WRITERS),
+    default='csv')
+@manager.arg(
+    'chunksize_rows', 'c', help='number of rows to read at a time',
+    type=int, default=api.CHUNKSIZE_ROWS)
+@manager.arg(
+    'quiet', 'q', help='suppress debug statements', type=bool, default=False)
+@manager.command
+def export(resource_id, **kwargs):
+    """Exports a datastore table to a csv, json lines, or columnar file"""
+    verbose = not kwargs['quiet'] and kwargs['output']
+    write = WRITERS[kwargs['format']]
+    ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
+    ckan = utils.get_ckan(**ckan_kwargs)
+
+    try:
+        result = ckan.datastore_search(resource_id=resource_id, limit=0)
+    except (api.NotFound, api.NotAuthorized) as err:
+        sys.exit('ERROR: %s\n' % str(err))
+
+    fields = [f for f in result['fields'] if f['id'] != '_id']
+    names = [field['id'] for field in fields]
+    page_size = kwargs['chunksize_rows']
+    pages = iter_pages(ckan, resource_id, names, page_size)
+    f = open(kwargs['output'], 'wb') if kwargs['output'] else sys.stdout
+
+    try:
+        with stats.timer('export') as counts:
+            counts['rows'] = sum(write(f, fields, pages))
+    finally:
+        f.close() if kwargs['output'] else None
+
+    if verbose:
+        print('Success! Exported %i rows of resource %s to %s.' % (
+            counts['rows'], resource_id, kwargs['output']))
+
+
 if __name__ == '__main__':
     manager.main()
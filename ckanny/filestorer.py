@@ -11,22 +11,30 @@ from __future__ import (
 import sys
 import ckanutils as api
 
-from os import unlink, getcwd, environ, path as p
+from os import unlink, environ, walk, path as p
 from tempfile import NamedTemporaryFile
 
 from manager import Manager
-from xattr import xattr
-from ckanutils import CKAN
-from tabutils import process as tup, io as tio
+
+from . import blobs, charset, compression, hashing, transfer, utils
 
 manager = Manager()
 
 
+def save_encoding(filepath, encoding, verbose=False):
+    """Saves a file's encoding to its extended attributes"""
+    if verbose and encoding:
+        print('saving encoding %s to extended attributes' % encoding)
+
+    if encoding:
+        charset.save(filepath, encoding)
+
+
 @manager.arg(
     'resource_id', help='the resource id', nargs='?', default=sys.stdin)
 @manager.arg(
     'destination', 'd', help='the destination folder or file path',
-    default=getcwd())
+    default='.')
 @manager.arg(
     'remote', 'r', help='the remote ckan url (uses `%s` ENV if available)' %
     api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
@@ -42,41 +50,200 @@ manager = Manager()
 @manager.arg(
     'name_from_id', 'n', help='Use resource id for filename', type=bool,
     default=False)
+@manager.arg(
+    'blob_dir', 'b', help=('the blob store directory, to reuse earlier'
+    ' downloads (uses `%s` ENV if available)') % blobs.BLOB_DIR_ENV,
+    default=environ.get(blobs.BLOB_DIR_ENV))
 @manager.arg(
     'quiet', 'q', help='suppress debug statements', type=bool, default=False)
 @manager.command
 def fetch(resource_id, **kwargs):
     """Downloads a filestore resource"""
     verbose = not kwargs['quiet']
-    filepath = kwargs['destination']
-    name_from_id = kwargs.get('name_from_id')
-    chunksize = kwargs.get('chunksize_bytes')
     ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
-    ckan = CKAN(**ckan_kwargs)
+    ckan = utils.get_ckan(**ckan_kwargs)
+    store = blobs.get_store(kwargs.get('blob_dir'))
+    engine = transfer.Engine(
+        chunksize=kwargs.get('chunksize_bytes'), store=store)
+
+    dkwargs = {'name_from_id': kwargs.get('name_from_id')}
 
     try:
-        r = ckan.fetch_resource(resource_id)
+        filepath, encoding = engine.download(
+            ckan, resource_id, kwargs['destination'], **dkwargs)
     except api.NotAuthorized as err:
         sys.exit('ERROR: %s\n' % str(err))
     else:
-        fkwargs = {
-            'headers': r.headers,
-            'name_from_id': name_from_id,
-            'resource_id': resource_id}
+        save_encoding(filepath, encoding, verbose)
+        print(filepath)
 
-        filepath = tup.make_filepath(filepath, **fkwargs)
-        tio.write(filepath, r.iter_content, chunksize=chunksize)
 
-        # save encoding to extended attributes
-        x = xattr(filepath)
+@manager.arg(
+    'resource_ids', help='comma separated list of resource ids', nargs='?',
+    default=sys.stdin)
+@manager.arg(
+    'destination', 'd', help='the destination folder', default='.')
+@manager.arg(
+    'remote', 'r', help='the remote ckan url (uses `%s` ENV if available)' %
+    api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
+@manager.arg(
+    'api_key', 'k', help='the api key (uses `%s` ENV if available)' %
+    api.API_KEY_ENV, default=environ.get(api.API_KEY_ENV))
+@manager.arg(
+    'ua', 'u', help='the user agent (uses `%s` ENV if available)' % api.UA_ENV,
+    default=environ.get(api.UA_ENV))
+@manager.arg(
+    'chunksize_bytes', 'c', help='number of bytes to read/write at a time',
+    type=int, default=api.CHUNKSIZE_BYTES)
+@manager.arg(
+    'name_from_id', 'n', help='Use resource id for filename', type=bool,
+    default=False)
+@manager.arg(
+    'workers', 'w', help='number of resources to download at a time',
+    type=int, default=utils.DEF_WORKERS)
+@manager.arg(
+    'host_limit', 'l', help='max number of downloads per host at a time',
+    type=int, default=transfer.DEF_HOST_LIMIT)
+@manager.arg(
+    'blob_dir', 'b', help=('the blob store directory, to reuse earlier'
+    ' downloads (uses `%s` ENV if available)') % blobs.BLOB_DIR_ENV,
+    default=environ.get(blobs.BLOB_DIR_ENV))
+@manager.arg(
+    'quiet', 'q', help='suppress debug statements', type=bool, default=False)
+@manager.command(name='fetch-many')
+def fetch_many(resource_ids, **kwargs):
+    """Downloads many filestore resources at once"""
+    verbose = not kwargs['quiet']
+    ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
+    ckan = utils.get_ckan(**ckan_kwargs)
+    store = blobs.get_store(kwargs.get('blob_dir'))
+    engine = transfer.Engine(
+        kwargs['workers'], kwargs['host_limit'], kwargs['chunksize_bytes'],
+        store)
 
-        if verbose and r.encoding:
-            print('saving encoding %s to extended attributes' % r.encoding)
+    dkwargs = {'name_from_id': kwargs.get('name_from_id')}
 
-        if r.encoding:
-            x['com.ckanny.encoding'] = r.encoding
+    def func(resource_id):
+        try:
+            result = engine.download(
+                ckan, resource_id, kwargs['destination'], **dkwargs)
+        except Exception as err:
+            return resource_id, None, err
+        else:
+            return resource_id, result, None
 
-        print(filepath)
+    failed = []
+    resource_ids = utils.parse_ids(resource_ids)
+
+    for resource_id, result, err in engine.map(func, resource_ids):
+        if err:
+            failed.append(resource_id)
+            print('ERROR: %s: %s' % (resource_id, err), file=sys.stderr)
+        else:
+            filepath, encoding = result
+            save_encoding(filepath, encoding, verbose)
+            print(filepath)
+
+    if failed:
+        sys.exit('ERROR: %i resource(s) not downloaded.' % len(failed))
+
+
+def iter_files(dirpath):
+    """Yields the (non hidden) files in a directory tree and their paths
+    relative to it"""
+    for root, dirnames, filenames in walk(dirpath):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+
+        for filename in sorted(filenames):
+            skip = filename.startswith('.') or filename.endswith('.part')
+
+            if not skip:
+                filepath = p.join(root, filename)
+                name = p.relpath(filepath, dirpath).replace(p.sep, '/')
+                yield filepath, name
+
+
+def sync_file(engine, ckan, package_id, filepath, name, resource=None,
+        **kwargs):
+    """Uploads a file to the resource named `name` unless the resource's
+    size and hash show that it hasn't changed. Returns one of `created`,
+    `updated`, `unchanged`, or `failed`."""
+    algo = hashing.get_algo(kwargs.get('hash_algo'))
+    size = p.getsize(filepath)
+    resource = resource or {}
+    remote_size, remote_hash = resource.get('size'), resource.get('hash')
+
+    with open(filepath, 'rb') as f:
+        new_hash = hashing.hash_file(f, algo)
+
+        if remote_size not in {None, ''} and int(remote_size) != size:
+            changed = True
+        elif remote_hash:
+            changed = hashing.compare(f, new_hash, remote_hash)
+        else:
+            changed = True
+
+    if not changed:
+        return 'unchanged'
+
+    ukwargs = {'filepath': filepath, 'name': name, 'hash': new_hash}
+
+    if resource:
+        result = engine.upload(ckan, resource['id'], **ukwargs)
+    else:
+        result = engine.upload(ckan, package_id=package_id, **ukwargs)
+
+    if not result:
+        return 'failed'
+
+    return 'updated' if resource else 'created'
+
+
+def sync_dir(engine, ckan, package, dirpath, verbose=True, **kwargs):
+    """Syncs each file in a directory tree to the package resource of the
+    same name (the first one wins), `workers` files at a time. Returns the
+    names of the files that failed to upload."""
+    resources = {r['name']: r for r in reversed(package['resources'])}
+
+    def func(item):
+        filepath, name = item
+        resource = resources.get(name)
+        args = (engine, ckan, package['id'], filepath, name, resource)
+
+        try:
+            return name, sync_file(*args, **kwargs), None
+        except Exception as err:
+            return name, 'failed', err
+
+    failed = []
+
+    for name, status, err in engine.map(func, iter_files(dirpath)):
+        if status == 'failed':
+            failed.append(name)
+            msg = ': %s' % err if err else ''
+            print('ERROR: %s not uploaded%s' % (name, msg), file=sys.stderr)
+        elif verbose:
+            print('%s %s.' % (name, status))
+
+    return failed
+
+
+def migrate_resource(engine, src_ckan, dest_ckan, resource_id, **kwargs):
+    """Copies a filestore resource from one ckan instance to another (by way
+    of a temporary file). Returns the updated resource, or `None` if the
+    upload failed."""
+    verbose = not kwargs.get('quiet')
+    filepath = NamedTemporaryFile(delete=False).name
+
+    try:
+        engine.download(src_ckan, resource_id, filepath)
+        ukwargs = {'filepath': filepath, 'part_size': kwargs.get('part_size')}
+        return engine.upload(dest_ckan, resource_id, **ukwargs)
+    finally:
+        if verbose:
+            print('Removing tempfile...')
+
+        unlink(filepath)
 
 
 @manager.arg(
@@ -96,6 +263,17 @@ def fetch(resource_id, **kwargs):
 @manager.arg(
     'chunksize_bytes', 'c', help='number of bytes to read/write at a time',
     type=int, default=api.CHUNKSIZE_BYTES)
+@manager.arg(
+    'blob_dir', 'b', help=('the blob store directory, to reuse earlier'
+    ' downloads (uses `%s` ENV if available)') % blobs.BLOB_DIR_ENV,
+    default=environ.get(blobs.BLOB_DIR_ENV))
+@manager.arg(
+    'part_size', 'P', help=('upload files larger than this many bytes in'
+    ' parts, using the multipart api of ckanext-cloudstorage (default: off)'),
+    type=int, default=0)
+@manager.arg(
+    'workers', 'w', help='number of parts to upload at a time',
+    type=int, default=utils.DEF_WORKERS)
 @manager.arg(
     'quiet', 'q', help='suppress debug statements', type=bool, default=False)
 @manager.command
@@ -114,29 +292,23 @@ def migrate(resource_id, **kwargs):
     verbose = not kwargs['quiet']
     chunksize = kwargs['chunksize_bytes']
     ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
-    src_ckan = CKAN(remote=src_remote, **ckan_kwargs)
-    dest_ckan = CKAN(remote=dest_remote, **ckan_kwargs)
+    src_ckan = utils.get_ckan(remote=src_remote, **ckan_kwargs)
+    dest_ckan = utils.get_ckan(remote=dest_remote, **ckan_kwargs)
+
+    store = blobs.get_store(kwargs.get('blob_dir'))
+    engine = transfer.Engine(
+        kwargs['workers'], chunksize=chunksize, store=store)
+    args = (engine, src_ckan, dest_ckan, resource_id)
 
     try:
-        r = src_ckan.fetch_resource(resource_id)
-        filepath = NamedTemporaryFile(delete=False).name
-    except api.NotAuthorized as err:
-        sys.exit('ERROR: %s\n' % str(err))
+        resource = migrate_resource(*args, **kwargs)
     except Exception as err:
         sys.exit('ERROR: %s\n' % str(err))
-    else:
-        tio.write(filepath, r.raw.read(), chunksize=chunksize)
-        resource = dest_ckan.update_filestore(resource_id, filepath=filepath)
 
-        if resource and verbose:
-            print('Success! Resource %s updated.' % resource_id)
-        elif not resource:
-            sys.exit('Error uploading file!')
-    finally:
-        if verbose:
-            print('Removing tempfile...')
-
-        unlink(filepath)
+    if resource and verbose:
+        print('Success! Resource %s updated.' % resource_id)
+    elif not resource:
+        sys.exit('Error uploading file!')
 
 
 @manager.arg(
@@ -157,13 +329,21 @@ def migrate(resource_id, **kwargs):
 @manager.arg(
     'ua', 'u', help='the user agent (uses `%s` ENV if available)' % api.UA_ENV,
     default=environ.get(api.UA_ENV))
+@manager.arg(
+    'part_size', 'P', help=('upload files larger than this many bytes in'
+    ' parts, using the multipart api of ckanext-cloudstorage (default: off)'),
+    type=int, default=0)
+@manager.arg(
+    'workers', 'w', help='number of parts to upload at a time',
+    type=int, default=utils.DEF_WORKERS)
 @manager.arg(
     'quiet', 'q', help='suppress debug statements', type=bool, default=False)
 @manager.command
 def upload(source, resource_id=None, package_id=None, **kwargs):
     """Updates the filestore of an existing resource or creates a new one"""
     verbose = not kwargs['quiet']
-    resource_id = resource_id or p.splitext(p.basename(source))[0]
+    name, ext = compression.split_ext(source)
+    resource_id = resource_id or p.splitext(p.basename(name))[0]
     ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
 
     if package_id and verbose:
@@ -174,17 +354,25 @@ def upload(source, resource_id=None, package_id=None, **kwargs):
         print(
             'Uploading %s to filestore resource %s...' % (source, resource_id))
 
-    ckan = CKAN(**ckan_kwargs)
+    ckan = utils.get_ckan(**ckan_kwargs)
 
     resource_kwargs = {
         'url' if 'http' in source else 'filepath': source,
-        'name': kwargs.get('name')
+        'name': kwargs.get('name'),
+        'part_size': kwargs.get('part_size')
     }
 
-    if package_id:
-        resource = ckan.create_resource(package_id, **resource_kwargs)
-    else:
-        resource = ckan.update_filestore(resource_id, **resource_kwargs)
+    if ext and 'http' not in source:
+        # compressed files are inflated as they are uploaded
+        try:
+            resource_kwargs['fileobj'] = compression.open_source(source)[0]
+        except ValueError as err:
+            sys.exit('ERROR: %s' % err)
+
+        del resource_kwargs['filepath']
+
+    engine = transfer.Engine(kwargs['workers'])
+    resource = engine.upload(ckan, resource_id, package_id, **resource_kwargs)
 
     if package_id and resource and verbose:
         infix = '%s ' % resource['id'] if resource.get('id') else ''
@@ -195,5 +383,62 @@ def upload(source, resource_id=None, package_id=None, **kwargs):
         sys.exit('Error uploading file!')
 
 
+@manager.arg(
+    'source', help='the source directory', nargs='?', default='.')
+@manager.arg(
+    'package_id', 'p', help='the package id')
+@manager.arg(
+    'remote', 'r', help='the remote ckan url (uses `%s` ENV if available)' %
+    api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
+@manager.arg(
+    'api_key', 'k', help='the api key (uses `%s` ENV if available)' %
+    api.API_KEY_ENV, default=environ.get(api.API_KEY_ENV))
+@manager.arg(
+    'ua', 'u', help='the user agent (uses `%s` ENV if available)' % api.UA_ENV,
+    default=environ.get(api.UA_ENV))
+@manager.arg(
+    'workers', 'w', help='number of files to upload at a time',
+    type=int, default=utils.DEF_WORKERS)
+@manager.arg(
+    'host_limit', 'l', help='max number of uploads per host at a time',
+    type=int, default=transfer.DEF_HOST_LIMIT)
+@manager.arg(
+    'hash_algo', 'a', help=('the hash algorithm used to detect changes (one'
+    ' of %s, uses `%s` ENV if available)') % (
+        ', '.join(sorted(hashing.ALGOS)), hashing.HASH_ALGO_ENV),
+    default=environ.get(hashing.HASH_ALGO_ENV, hashing.DEF_ALGO))
+@manager.arg(
+    'quiet', 'q', help='suppress debug statements', type=bool, default=False)
+@manager.command
+def sync(source, package_id=None, **kwargs):
+    """Uploads the new or changed files in a directory to a package"""
+    verbose = not kwargs['quiet']
+
+    if not package_id:
+        sys.exit('ERROR: `package-id` is required.')
+    elif not p.isdir(source):
+        sys.exit('ERROR: `%s` is not a directory.' % source)
+
+    try:
+        hashing.get_algo(kwargs['hash_algo'])
+    except ValueError as err:
+        sys.exit('ERROR: %s' % err)
+
+    ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
+    ckan = utils.get_ckan(**ckan_kwargs)
+
+    try:
+        package = ckan.package_show(id=package_id)
+    except (api.NotFound, api.NotAuthorized) as err:
+        sys.exit('ERROR: %s\n' % str(err))
+
+    engine = transfer.Engine(kwargs['workers'], kwargs['host_limit'])
+    skwargs = {'hash_algo': kwargs['hash_algo']}
+    failed = sync_dir(engine, ckan, package, source, verbose, **skwargs)
+
+    if failed:
+        sys.exit('ERROR: %i file(s) not uploaded.' % len(failed))
+
+
 if __name__ == '__main__':
     manager.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Rate limits and concurrency limits for the requests made to each remote """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import itertools as it
+
+from email.utils import mktime_tz, parsedate_tz
+from functools import wraps
+from os import environ
+from threading import BoundedSemaphore, Lock
+from time import sleep, time
+from urlparse import urlparse
+
+from . import stats
+
+RATE_ENV = 'CKANNY_RATE'
+MAX_IN_FLIGHT_ENV = 'CKANNY_MAX_IN_FLIGHT'
+FLAGS = {'--rate': True, '--max-in-flight': True}
+THROTTLED = {429, 503}
+DEF_RETRIES = 5
+MAX_WAIT = 5 * 60
+
+# `None` until `configure` is called (by the cli, or on the first request)
+settings = None
+governors = {}
+lock = Lock()
+
+
+class Bucket(object):
+    """A token bucket that allows `rate` requests per second (in bursts of up
+    to `rate` requests)"""
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.capacity = max(1, rate or 0)
+        self.tokens = self.capacity
+        self.updated = time()
+        self.resume_at = 0
+        self.lock = Lock()
+
+    def take(self):
+        """Blocks until a request may be made"""
+        while True:
+            with self.lock:
+                now = time()
+
+                if now < self.resume_at:
+                    wait = self.resume_at - now
+                elif not self.rate:
+                    return
+                else:
+                    elapsed = now - self.updated
+                    tokens = self.tokens + elapsed * self.rate
+                    self.tokens = min(self.capacity, tokens)
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    wait = (1 - self.tokens) / self.rate
+
+            sleep(wait)
+
+    def pause(self, seconds):
+        """Holds back every request for `seconds`"""
+        with self.lock:
+            self.resume_at = max(self.resume_at, time() + seconds)
+
+
+class Governor(object):
+    """Limits the rate and number of in flight requests to one remote"""
+    def __init__(self, rate=None, max_in_flight=None):
+        self.bucket = Bucket(rate)
+        limited = max_in_flight and max_in_flight > 0
+        self.semaphore = BoundedSemaphore(max_in_flight) if limited else None
+
+    def acquire(self):
+        if self.semaphore:
+            self.semaphore.acquire()
+
+        self.bucket.take()
+
+    def release(self):
+        if self.semaphore:
+            self.semaphore.release()
+
+
+def get_settings(rate=None, max_in_flight=None):
+    rate = rate or environ.get(RATE_ENV)
+    max_in_flight = max_in_flight or environ.get(MAX_IN_FLIGHT_ENV)
+
+    return {
+        'rate': float(rate) if rate else None,
+        'max_in_flight': int(max_in_flight or 0) or None}
+
+
+def configure(rate=None, max_in_flight=None):
+    """Sets the limits (falling back to the ENV) for every remote"""
+    global settings
+
+    with lock:
+        settings = get_settings(rate, max_in_flight)
+        governors.clear()
+
+
+def get(host):
+    global settings
+
+    with lock:
+        if settings is None:
+            # e.g., when used as a library rather than from the cli
+            settings = get_settings()
+
+        if host not in governors:
+            governors[host] = Governor(**settings)
+
+        return governors[host]
+
+
+def get_retry_after(response, attempt=0):
+    """The seconds to wait before retrying a throttled request. Falls back
+    to exponential backoff if the server doesn't say.
+
+    >>> class Response(object):
+    ...     status_code = 429
+    ...     headers = {'retry-after': '3'}
+    >>> get_retry_after(Response())
+    3.0
+    """
+    value = response.headers.get('retry-after')
+
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        parsed = parsedate_tz(value) if value else None
+        seconds = mktime_tz(parsed) - time() if parsed else None
+
+    if seconds is None:
+        seconds = 2 ** attempt
+
+    return min(max(seconds, 0), MAX_WAIT)
+
+
+def install(retries=DEF_RETRIES):
+    """Governs every request made with `requests` (and so every ckan api
+    call). Throttled requests (429, or 503 with a `Retry-After` header) are
+    retried once the server says so, and meanwhile hold back every other
+    request to that remote.
+
+    The transport adapter (rather than the session) is governed, so that each
+    redirect hop takes its own slot, and a slot is only held until the
+    response's headers arrive (not while its body is read)."""
+    from requests.adapters import HTTPAdapter
+
+    send = HTTPAdapter.send
+
+    if getattr(send, 'governed', False):
+        return
+
+    @wraps(send)
+    def wrapper(adapter, request, *args, **kwargs):
+        governor = get(urlparse(request.url).netloc)
+
+        for attempt in it.count():
+            governor.acquire()
+
+            try:
+                r = send(adapter, request, *args, **kwargs)
+            finally:
+                governor.release()
+
+            throttled = r.status_code == 429 or (
+                r.status_code in THROTTLED and 'retry-after' in r.headers)
+
+            if not throttled or attempt >= retries:
+                return r
+
+            wait = get_retry_after(r, attempt)
+            governor.bucket.pause(wait)
+            stats.add('throttled', seconds=wait)
+            r.close()
+
+    wrapper.governed = True
+    HTTPAdapter.send = wrapper
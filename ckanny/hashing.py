@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" File hashes for datastore change detection """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import hashlib
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from os import environ
+
+from . import utils
+
+HASH_ALGO_ENV = 'CKANNY_HASH_ALGO'
+DEF_ALGO = 'sha1'
+CHUNKSIZE = 2 ** 20
+
+# tree hashes digest each block separately (in parallel, since `hashlib`
+# releases the GIL) and then digest the list of block digests. Changing the
+# block size changes every tree hash.
+BLOCKSIZE = 2 ** 23
+TREE_PREFIX = 'tree-'
+DIGESTS = {'md5', 'sha1', 'sha256'}
+ALGOS = DIGESTS | {TREE_PREFIX + d for d in DIGESTS}
+
+
+def parse(value):
+    """Splits a hash table value into its algorithm and hex digest. Values
+    without an algorithm predate them and are sha1 digests.
+
+    >>> parse('tree-sha1:ab12') == ('tree-sha1', 'ab12')
+    True
+    >>> parse('ab12') == ('sha1', 'ab12')
+    True
+    """
+    algo, _, digest = value.rpartition(':')
+    return (algo or DEF_ALGO, digest)
+
+
+def get_algo(algo=None):
+    algo = algo or environ.get(HASH_ALGO_ENV) or DEF_ALGO
+
+    if algo not in ALGOS:
+        raise ValueError(
+            'Unknown hash algorithm `%s`. Use one of: %s.' % (
+                algo, ', '.join(sorted(ALGOS))))
+
+    return algo
+
+
+def digest(block, name=DEF_ALGO):
+    return hashlib.new(str(name), block).digest()
+
+
+def hash_tree(f, name, workers=utils.DEF_WORKERS):
+    """Hashes `f` a block at a time on `workers` threads. Only `workers`
+    blocks are read into memory at once."""
+    pool, digests = ThreadPool(workers), []
+    read = partial(f.read, BLOCKSIZE)
+    func = partial(digest, name=name)
+
+    try:
+        while True:
+            blocks = filter(None, [read() for _ in range(workers)])
+            digests.extend(pool.map(func, blocks))
+
+            if len(blocks) < workers:
+                break
+    finally:
+        pool.terminate()
+
+    return hashlib.new(str(name), b''.join(digests)).hexdigest()
+
+
+def hash_file(f, algo=DEF_ALGO, chunksize=CHUNKSIZE, **kwargs):
+    """Hashes a file object. Returns the hex digest prefixed with the
+    algorithm, e.g., `tree-sha1:0beec7b5...`."""
+    f.seek(0)
+
+    try:
+        if algo.startswith(TREE_PREFIX):
+            hexdigest = hash_tree(f, algo[len(TREE_PREFIX):], **kwargs)
+        else:
+            hasher = hashlib.new(str(algo))
+
+            for chunk in iter(lambda: f.read(chunksize), b''):
+                hasher.update(chunk)
+
+            hexdigest = hasher.hexdigest()
+    finally:
+        f.seek(0)
+
+    return '%s:%s' % (algo, hexdigest)
+
+
+def compare(f, new_hash, old_hash, **kwargs):
+    """Whether the file `f` (whose hash is `new_hash`) differs from the one
+    `old_hash` was taken from. If `old_hash` used another algorithm, `f` is
+    hashed again with that algorithm. If it's one this module doesn't know
+    (e.g., the hash was set by another tool), `f` counts as changed.
+
+    >>> compare(None, 'sha1:ab12', 'crc32:ab12')
+    True
+    """
+    algo = parse(old_hash)[0]
+
+    if algo not in ALGOS:
+        return True
+    elif parse(new_hash)[0] != algo:
+        new_hash = hash_file(f, algo, **kwargs)
+
+    return parse(new_hash) != parse(old_hash)
@@ -8,38 +8,383 @@ from __future__ import (
     absolute_import, division, print_function, with_statement,
     unicode_literals)
 
+import re
 import sys
+import csv
+import json
 import ckanutils as api
 
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import closing
 from pprint import pprint
+from threading import Lock
 from os import environ
 from time import time
+from urlparse import urlparse
 
 from manager import Manager
-from ckanutils import CKAN
 from tabutils import process as tup
 
-from . import datastorer as ds
+from . import blobs, datastorer as ds, hashing, spool, stats, utils
 
 manager = Manager()
+decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
 
+GEOJSON_PACK = 'json-repository'
+RESOURCE_KEYS = ['id', 'name', 'state', 'last_modified', 'created']
+SEARCH_ROWS = 1000
+SNIFF_BYTES = 2 ** 14
+WHITESPACE = re.compile(br'[ \t\n\r]*')
+ARRAYS = re.compile(br'\[[^\[\]{}"]*\]')
+TOKENS = re.compile(br'"(?:[^"\\]|\\.)*(?:"|\\?$)|[\[\]{}]')
 
-def find_field(fields, ftype='who', default=None, **kwargs):
-    possibilities = {
-        'who': ['org', 'partner'],
-        'what': ['sector', 'cluster'],
-        'where': ['code', 'state', 'region', 'province', 'township'],
-    }
 
+possibilities = {
+    'who': ('org', 'partner'),
+    'what': ('sector', 'cluster'),
+    'where': ('code', 'state', 'region', 'province', 'township'),
+}
+
+# the most recently used indexes are kept since many organizations share the
+# same sheet templates
+MAX_INDEXES = 64
+field_indexes = OrderedDict()
+index_lock = Lock()
+
+
+def tokenize(content):
+    return [t for t in re.split(r'[^a-z0-9]+', content) if t]
+
+
+class FieldIndex(object):
+    """A case insensitive lookup index over a list of field names.
+
+    Examples:
+        >>> index = FieldIndex(['Org Name', 'Sector', 'Admin1 PCode'])
+        >>> index.fuzzy(possibilities['where'])
+        u'Admin1 PCode'
+        >>> index.deref('org_name'), index.deref('SECTOR')
+        (u'Org Name', u'Sector')
+    """
+    def __init__(self, fields):
+        self.fields = [f for f in fields if f]
+        self.lowered = [f.lower() for f in self.fields]
+        self.lower = dict(reversed(zip(self.lowered, self.fields)))
+        self.underscored, self.token_sets = None, None
+        self.matches = {}
+
+        # a single string lets `fuzzy` scan every field in one C level call
+        self.haystack = '\0'.join(self.lowered)
+        self.offsets, end = [], 0
+
+        for low in self.lowered:
+            end += len(low) + 1
+            self.offsets.append(end)
+
+    def normalize(self):
+        """Builds the underscorified and token set lookups. These are only
+        needed when a field isn't found by its lowercase name."""
+        self.underscored, self.token_sets = {}, {}
+
+        for low, field in reversed(zip(self.lowered, self.fields)):
+            tokens = tokenize(low)
+            self.underscored['_'.join(tokens)] = field
+            self.token_sets[frozenset(tokens)] = field
+
+    def fuzzy(self, possibilities, default=''):
+        """Finds the first field containing any of the `possibilities`"""
+        if possibilities not in self.matches:
+            self.matches[possibilities] = self.find(possibilities)
+
+        return self.matches[possibilities] or default
+
+    def find(self, possibilities):
+        for possibility in possibilities:
+            pos = self.haystack.find(possibility.lower())
+
+            if pos > -1:
+                return self.fields[bisect_right(self.offsets, pos)]
+
+    def exact(self, possibilities, default=''):
+        """Finds the first of the `possibilities` that is a field"""
+        found = (p for p in possibilities if p and p.lower() in self.lower)
+        return next(found, default)
+
+    def deref(self, field):
+        """Gets the original name of a (lowercased or underscorified) field"""
+        if not field:
+            return ''
+
+        low = field.lower()
+
+        if low in self.lower:
+            return self.lower[low]
+
+        if self.underscored is None:
+            self.normalize()
+
+        try:
+            return self.underscored[low]
+        except KeyError:
+            return self.token_sets[frozenset(tokenize(low))]
+
+
+def get_index(fields):
+    key = tuple(fields)
+
+    with index_lock:
+        index = field_indexes.pop(key, None) or FieldIndex(fields)
+        field_indexes[key] = index
+
+        if len(field_indexes) > MAX_INDEXES:
+            field_indexes.popitem(last=False)
+
+    return index
+
+
+def find_field(fields, ftype='who', default=None, **kwargs):
     field = kwargs.get(ftype) or default
-    return field or tup.find(fields, possibilities[ftype], method='fuzzy')
+
+    return field or get_index(fields).fuzzy(possibilities[ftype])
 
 
 def deref_field(fields, field):
-    if field:
-        return {f.lower(): f for f in fields if f}[field.lower()]
+    return get_index(fields).deref(field)
+
+
+def get_org_packages(ckan, org_id):
+    """Searches for the (public and private) packages of a single
+    organization, a page of `SEARCH_ROWS` at a time"""
+    package_search = utils.get_action(ckan, 'package_search')
+    skwargs = {
+        'fq': 'organization:%s' % org_id, 'rows': SEARCH_ROWS,
+        'include_private': True}
+
+    packages = []
+
+    while True:
+        result = package_search(start=len(packages), **skwargs)
+        packages.extend(result['results'])
+
+        # the server may cap `rows` below `SEARCH_ROWS`
+        if not result['results'] or len(packages) >= result['count']:
+            return packages
+
+
+def get_geojson_index(ckan, ttl=utils.DEF_CACHE_TTL):
+    """Gets the (locally cached) HDX json repository resource index"""
+    name = 'geojson-index-%s.json' % urlparse(ckan.address).netloc
+    index = utils.read_cache(name, ttl)
+
+    if index is None:
+        package = ckan.package_show(id=GEOJSON_PACK)
+        resources = [
+            {k: r.get(k) for k in RESOURCE_KEYS} for r in package['resources']]
+
+        index = {'pname': package['name'], 'resources': resources}
+        utils.write_cache(name, index)
+
+    return index
+
+
+def modified(resource):
+    return resource.get('last_modified') or resource.get('created') or ''
+
+
+def find_geojson(index, country):
+    """Finds the most recently updated resource matching a country"""
+    named = country.lower()
+    resources = (
+        r for r in index['resources']
+        if r.get('state', 'active') == 'active' and named in r['name'].lower())
+
+    try:
+        resource = sorted(resources, key=modified, reverse=True)[0]
+    except IndexError:
+        return {'rid': '', 'pname': ''}
     else:
-        return ''
+        return {'rid': resource['id'], 'pname': index['pname']}
+
+
+class Incomplete(Exception):
+    """More of the document is needed to parse it. `pos` is where the value
+    that's cut off starts (if known)."""
+    def __init__(self, pos=None):
+        super(Incomplete, self).__init__(pos)
+        self.pos = pos
+
+
+class Closer(object):
+    """Tracks whether the json value that starts at `pos` is complete, so
+    that it's only parsed once"""
+    def __init__(self, pos):
+        self.pos = pos
+        self.depth = 0
+
+    def feed(self, buf):
+        """Returns whether the value is complete"""
+        segment, depth = buf[self.pos:], self.depth
+
+        # once inside the value, complete innermost arrays (e.g., coordinate
+        # pairs) can't close it, so they are dropped at C speed
+        while depth:
+            segment, dropped = ARRAYS.subn(b'', segment)
+
+            if not dropped:
+                break
+
+        for match in TOKENS.finditer(segment):
+            token = match.group()
+
+            if token[:1] == b'"' and (len(token) < 2 or token[-1:] != b'"'):
+                # a string that's cut off, so wait for the rest
+                return False
+            elif token in {b'[', b'{'}:
+                depth += 1
+            elif token in {b']', b'}'}:
+                depth -= 1
+
+            if depth == 0:
+                return True
+
+        self.pos, self.depth = len(buf), depth
+        return False
+
+
+def skip(buf, pos):
+    """Returns the position of the first non whitespace character from `pos`
+    """
+    pos = WHITESPACE.match(buf, pos).end()
+
+    if pos >= len(buf):
+        raise Incomplete()
+
+    return pos
+
+
+def expect(buf, pos, char):
+    pos = skip(buf, pos)
+
+    if buf[pos:pos + 1] != char:
+        raise ValueError('Expected `%s` at %i.' % (char, pos))
+
+    return pos + 1
+
+
+def read_value(buf, pos):
+    """Parses the json value at `pos` (with the C scanner). Returns the value
+    and the position after it."""
+    pos = skip(buf, pos)
+
+    try:
+        return decoder.raw_decode(buf, pos)
+    except ValueError:
+        # the value may just be cut off at the end of `buf`
+        raise Incomplete(pos)
+
+
+def find_member(buf, pos, name):
+    """Returns the position of the value of the member `name` of the object
+    that `pos` is in (just after its `{`). Other members' values are skipped
+    without looking inside them."""
+    if buf[skip(buf, pos):][:1] == b'}':
+        raise KeyError(name)
+
+    while True:
+        key, pos = read_value(buf, pos)
+        pos = expect(buf, pos, b':')
+
+        if key == name:
+            return pos
+
+        pos = skip(buf, read_value(buf, pos)[1])
+
+        if buf[pos:pos + 1] == b'}':
+            raise KeyError(name)
+
+        pos = expect(buf, pos, b',')
+
+
+def parse_properties(buf):
+    pos = find_member(buf, expect(buf, 0, b'{'), 'features')
+    pos = expect(buf, pos, b'[')
+    pos = find_member(buf, expect(buf, pos, b'{'), 'properties')
+    return read_value(buf, pos)[0]
+
+
+def find_properties(chunks):
+    """Incrementally parses GeoJSON, stopping as soon as the first feature's
+    properties are read. Each attempt starts over, so after an attempt that
+    is cut off by the end of the buffer, the next one waits until the value
+    it stopped at is complete.
+
+    Examples:
+        >>> chunks = [b'{"crs": {"properties": {"a": 1}}, "featu', \
+b'res": [{"properties": {"b": "}", "c": 2}}, {"properties": {"d": 3}}]}']
+        >>> find_properties(iter(chunks)).keys() == ['b', 'c']
+        True
+    """
+    buf, closer = b'', None
+
+    for chunk in chunks:
+        buf += chunk
+
+        if closer and not closer.feed(buf):
+            continue
+
+        try:
+            return parse_properties(buf)
+        except Incomplete as err:
+            closer = None if err.pos is None else Closer(err.pos)
+        except (KeyError, ValueError):
+            # no features, or no properties
+            return {}
+
+    return {}
+
+
+def iter_resource(ckan, resource_id, chunksize=SNIFF_BYTES, store=None):
+    """Yields the chunks of a resource, reading them from the blob store if
+    it has a copy"""
+    resource = ckan.resource_show(id=resource_id) if store else {}
+    f = store.open(resource) if store else None
+
+    if f:
+        with f:
+            for chunk in iter(lambda: f.read(chunksize), b''):
+                yield chunk
+    else:
+        r = ckan.fetch_resource(resource_id)
+
+        try:
+            for chunk in r.iter_content(chunksize):
+                yield chunk
+        finally:
+            r.close()
+
+
+def fetch_header(ckan, resource_id, chunksize=SNIFF_BYTES, store=None):
+    """Reads the header row of a csv resource, closing the connection
+    before the rest of the file is downloaded"""
+    header = b''
+
+    with closing(iter_resource(ckan, resource_id, chunksize, store)) as chunks:
+        for chunk in chunks:
+            header += chunk
+
+            if b'\n' in header:
+                break
+
+    return header.split(b'\n')[0].rstrip(b'\r').split(b',')
+
+
+def fetch_properties(ckan, resource_id, chunksize=SNIFF_BYTES, store=None):
+    """Reads the first feature's properties of a geojson resource, closing
+    the connection before the rest of the file is downloaded"""
+    with closing(iter_resource(ckan, resource_id, chunksize, store)) as chunks:
+        return find_properties(chunks)
+
 
 control_sheet_keys = [
     'highlight_color', 'image_rect', 'image_sq', 'dataset_id_1',
@@ -50,50 +395,9 @@ control_sheet_keys = [
     'viz_data_link_url', 'viz_title', 'what_column', 'who_column']
 
 
-@manager.arg(
-    'org_id', help='the organization id', nargs='?', default=sys.stdin)
-@manager.arg(
-    'remote', 'r', help='the remote ckan url (uses `%s` ENV if available)' %
-    api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
-@manager.arg(
-    'api_key', 'k', help='the api key (uses `%s` ENV if available)' %
-    api.API_KEY_ENV, default=environ.get(api.API_KEY_ENV))
-@manager.arg(
-    'ua', 'u', help='the user agent (uses `%s` ENV if available)' % api.UA_ENV,
-    default=environ.get(api.UA_ENV))
-@manager.arg(
-    'image_sq', 'S', help='logo 75x75 (url or google doc id)',
-    default='0B01Bdplw4VkCNG5HLXowNzV4WGM')
-@manager.arg(
-    'image_rect', 'R', help='logo 300x125 (url or google doc id)',
-    default='0B01Bdplw4VkCZC1vQWxJVlVGZWM')
-@manager.arg('color', 'c', help='the base color', default='#026bb5')
-@manager.arg(
-    'topline', 't', help=(
-        'topline figures resource id (default: most recently updated resource'
-        ' containing `topline`)'))
-@manager.arg(
-    '3w', 'w', help=(
-        '3w data resource id (default: most recently updated resource tagged'
-        ' `3w`)'))
-@manager.arg(
-    'geojson', 'g', help=(
-        'the map boundaries geojson resource id (default: most recently '
-        'updated resource matching the org country)'))
-@manager.arg(
-    'where', 'W', help=(
-        'The `where` field (case insensitive) (default: first column name'
-        ' found matching a `3w` field).'))
-@manager.arg(
-    'sanitize', 's', help='underscorify and lowercase field names', type=bool,
-    default=False)
-@manager.arg(
-    'quiet', 'q', help='suppress debug statements', type=bool, default=False)
-@manager.command
-def customize(org_id, **kwargs):
-    """Introspects custom organization values"""
-    verbose = not kwargs['quiet']
-    ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
+def introspect(ckan, org_id, index=None, **kwargs):
+    """Introspects the custom values of a single organization"""
+    verbose = not kwargs.get('quiet')
     image_sq = kwargs.get('image_sq')
     image_rect = kwargs.get('image_rect')
     sanitize = kwargs.get('sanitize')
@@ -101,10 +405,8 @@ def customize(org_id, **kwargs):
     geojson_id = kwargs.get('geojson')
     topline_id = kwargs.get('topline')
 
-    ckan = CKAN(**ckan_kwargs)
-    organization = ckan.organization_show(id=org_id, include_datasets=True)
-    org_packages = organization['packages']
-    hdx = ckan.organization_show(id='hdx', include_datasets=True)
+    organization = ckan.organization_show(id=org_id, include_datasets=False)
+    org_packages = get_org_packages(ckan, org_id)
     extras = {e['key']: e['value'] for e in organization['extras']}
 
     if three_dub_id:
@@ -115,7 +417,8 @@ def customize(org_id, **kwargs):
         three_dub_id = ids['rid']
 
     if not three_dub_id:
-        sys.exit(1)
+        message = 'No 3w resource found for organization `%s`.' % org_id
+        raise api.NotFound(message)
 
     if not topline_id:
         topline_id = ckan.find_ids(org_packages, pnamed='topline')['rid']
@@ -124,21 +427,27 @@ def customize(org_id, **kwargs):
         geojson_set_id = ckan.get_package_id(geojson_id)
     else:
         country = org_id.split('-')[1]
-        hkwargs = {'pnamed': 'json-repository', 'rnamed': country}
-        ids = ckan.find_ids(hdx['packages'], **hkwargs)
+        ttl = kwargs.get('cache_ttl', utils.DEF_CACHE_TTL)
+        index = index or get_geojson_index(ckan, ttl)
+        ids = find_geojson(index, country)
         geojson_set_id = ids['pname']
         geojson_id = ids['rid']
 
     viz_url = '%s/dataset/%s' % (kwargs['remote'], three_dub_set_id)
-    three_dub_r = ckan.fetch_resource(three_dub_id)
-    _fields = three_dub_r.iter_lines().next().split(',')
+
+    store = blobs.get_store(kwargs.get('blob_dir'))
+
+    with stats.timer('sniff 3w header'):
+        _fields = fetch_header(ckan, three_dub_id, store=store)
+
     three_dub_fields = tup.underscorify(_fields) if sanitize else _fields
 
-    if geojson_id:
-        geojson_r = ckan.fetch_resource(geojson_id)
-        geojson_fields = geojson_r.json()['features'][0]['properties'].keys()
-    else:
-        geojson_fields = []
+    with stats.timer('sniff geojson properties'):
+        if geojson_id:
+            geojson_fields = fetch_properties(
+                ckan, geojson_id, store=store).keys()
+        else:
+            geojson_fields = []
 
     if verbose:
         print('3w fields:')
@@ -146,12 +455,15 @@ def customize(org_id, **kwargs):
         print('geojson fields:')
         pprint(geojson_fields)
 
-    def_where = tup.find(three_dub_fields, geojson_fields) or ''
-    who_column = find_field(three_dub_fields, 'who', **kwargs)
-    what_column = find_field(three_dub_fields, 'what', **kwargs)
-    where_column = find_field(three_dub_fields, 'where', def_where, **kwargs)
+    with stats.timer('match fields'):
+        def_where = get_index(three_dub_fields).exact(geojson_fields)
+        who_column = find_field(three_dub_fields, 'who', **kwargs)
+        what_column = find_field(three_dub_fields, 'what', **kwargs)
+        where_column = find_field(
+            three_dub_fields, 'where', def_where, **kwargs)
 
-    where_column_2 = find_field(geojson_fields, 'where', def_where, **kwargs)
+        where_column_2 = find_field(
+            geojson_fields, 'where', def_where, **kwargs)
     name_column = kwargs.get('where') or def_where
 
     if 'http' not in image_sq:
@@ -192,6 +504,67 @@ def customize(org_id, **kwargs):
         'modified_at': int(time()),
     }
 
+    return data
+
+
+@manager.arg(
+    'org_id', help='the organization id', nargs='?', default=sys.stdin)
+@manager.arg(
+    'remote', 'r', help='the remote ckan url (uses `%s` ENV if available)' %
+    api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
+@manager.arg(
+    'api_key', 'k', help='the api key (uses `%s` ENV if available)' %
+    api.API_KEY_ENV, default=environ.get(api.API_KEY_ENV))
+@manager.arg(
+    'ua', 'u', help='the user agent (uses `%s` ENV if available)' % api.UA_ENV,
+    default=environ.get(api.UA_ENV))
+@manager.arg(
+    'image_sq', 'S', help='logo 75x75 (url or google doc id)',
+    default='0B01Bdplw4VkCNG5HLXowNzV4WGM')
+@manager.arg(
+    'image_rect', 'R', help='logo 300x125 (url or google doc id)',
+    default='0B01Bdplw4VkCZC1vQWxJVlVGZWM')
+@manager.arg('color', 'c', help='the base color', default='#026bb5')
+@manager.arg(
+    'topline', 't', help=(
+        'topline figures resource id (default: most recently updated resource'
+        ' containing `topline`)'))
+@manager.arg(
+    '3w', 'w', help=(
+        '3w data resource id (default: most recently updated resource tagged'
+        ' `3w`)'))
+@manager.arg(
+    'geojson', 'g', help=(
+        'the map boundaries geojson resource id (default: most recently '
+        'updated resource matching the org country)'))
+@manager.arg(
+    'where', 'W', help=(
+        'The `where` field (case insensitive) (default: first column name'
+        ' found matching a `3w` field).'))
+@manager.arg(
+    'sanitize', 's', help='underscorify and lowercase field names', type=bool,
+    default=False)
+@manager.arg(
+    'cache_ttl', 'T', help='seconds to cache the HDX geojson resource index',
+    type=int, default=utils.DEF_CACHE_TTL)
+@manager.arg(
+    'blob_dir', 'b', help=('the blob store directory, to reuse earlier'
+    ' downloads (uses `%s` ENV if available)') % blobs.BLOB_DIR_ENV,
+    default=environ.get(blobs.BLOB_DIR_ENV))
+@manager.arg(
+    'quiet', 'q', help='suppress debug statements', type=bool, default=False)
+@manager.command
+def customize(org_id, **kwargs):
+    """Introspects custom organization values"""
+    verbose = not kwargs['quiet']
+    ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
+    ckan = utils.get_ckan(**ckan_kwargs)
+
+    try:
+        data = introspect(ckan, org_id, **kwargs)
+    except api.NotFound as err:
+        sys.exit('ERROR: %s\n' % str(err))
+
     control_sheet_data = [data[k] for k in control_sheet_keys]
 
     if verbose:
@@ -201,11 +574,176 @@ def customize(org_id, **kwargs):
     return control_sheet_data
 
 
-def update(three_dub_id, topline_id=None, **kwargs):
+@manager.arg(
+    'org_ids', help='comma separated list of organization ids', nargs='?',
+    default=sys.stdin)
+@manager.arg(
+    'remote', 'r', help='the remote ckan url (uses `%s` ENV if available)' %
+    api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
+@manager.arg(
+    'api_key', 'k', help='the api key (uses `%s` ENV if available)' %
+    api.API_KEY_ENV, default=environ.get(api.API_KEY_ENV))
+@manager.arg(
+    'ua', 'u', help='the user agent (uses `%s` ENV if available)' % api.UA_ENV,
+    default=environ.get(api.UA_ENV))
+@manager.arg(
+    'image_sq', 'S', help='logo 75x75 (url or google doc id)',
+    default='0B01Bdplw4VkCNG5HLXowNzV4WGM')
+@manager.arg(
+    'image_rect', 'R', help='logo 300x125 (url or google doc id)',
+    default='0B01Bdplw4VkCZC1vQWxJVlVGZWM')
+@manager.arg('color', 'c', help='the base color', default='#026bb5')
+@manager.arg(
+    'sanitize', 's', help='underscorify and lowercase field names', type=bool,
+    default=False)
+@manager.arg(
+    'cache_ttl', 'T', help='seconds to cache the HDX geojson resource index',
+    type=int, default=utils.DEF_CACHE_TTL)
+@manager.arg(
+    'output', 'o', help='the output file path (default: stdout)')
+@manager.arg(
+    'format', 'f', help='the output format (one of `csv` or `json`)',
+    default='csv')
+@manager.arg(
+    'workers', 'n', help='number of organizations to introspect at a time',
+    type=int, default=utils.DEF_WORKERS)
+@manager.arg(
+    'blob_dir', 'b', help=('the blob store directory, to reuse earlier'
+    ' downloads (uses `%s` ENV if available)') % blobs.BLOB_DIR_ENV,
+    default=environ.get(blobs.BLOB_DIR_ENV))
+@manager.arg(
+    'quiet', 'q', help='suppress debug statements', type=bool, default=False)
+@manager.command(name='customize-many')
+def customize_many(org_ids, **kwargs):
+    """Introspects custom values of many organizations at once"""
+    verbose = not kwargs['quiet']
+    ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
+    ckan = utils.get_ckan(**ckan_kwargs)
+    index = get_geojson_index(ckan, kwargs['cache_ttl'])
+    ikwargs = dict(kwargs, quiet=True)
+
+    def func(org_id):
+        try:
+            return org_id, introspect(ckan, org_id, index, **ikwargs), None
+        except Exception as err:
+            return org_id, None, err
+
+    rows, failed = [], []
+    org_ids = utils.parse_ids(org_ids)
+
+    for org_id, data, err in utils.pmap(func, org_ids, kwargs['workers']):
+        if err:
+            failed.append(org_id)
+            print('ERROR: %s: %s' % (org_id, err), file=sys.stderr)
+        else:
+            rows.append([data[k] for k in control_sheet_keys])
+
+            if verbose:
+                print('Introspected organization %s.' % org_id)
+
+    f = open(kwargs['output'], 'wb') if kwargs['output'] else sys.stdout
+
+    try:
+        if kwargs['format'] == 'json':
+            json.dump([dict(zip(control_sheet_keys, r)) for r in rows], f)
+        else:
+            writer = csv.writer(f)
+            writer.writerow(control_sheet_keys)
+            writer.writerows(
+                [[unicode(v).encode('utf-8') for v in r] for r in rows])
+    finally:
+        f.close() if kwargs['output'] else None
+
+    if failed:
+        sys.exit('ERROR: %i organization(s) not customized.' % len(failed))
+
+
+def find_dashboard_resources(ckan, org_ids):
+    """Yields the ids of the 3w and topline resources of organizations"""
+    for org_id in utils.parse_ids(org_ids):
+        org_packages = get_org_packages(ckan, org_id)
+        three_dub_id = ckan.find_ids(org_packages, pnamed='3w', ptagged='3w')
+        topline_id = ckan.find_ids(org_packages, pnamed='topline')
+        rids = filter(None, [three_dub_id['rid'], topline_id['rid']])
+
+        if not rids:
+            print('WARNING: no 3w resources found for %s' % org_id)
+
+        for rid in rids:
+            yield rid
+
+
+@manager.arg(
+    'org_ids', help='comma separated list of organization ids', nargs='?',
+    default=sys.stdin)
+@manager.arg(
+    'remote', 'r', help='the remote ckan url (uses `%s` ENV if available)' %
+    api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
+@manager.arg(
+    'api_key', 'k', help='the api key (uses `%s` ENV if available)' %
+    api.API_KEY_ENV, default=environ.get(api.API_KEY_ENV))
+@manager.arg(
+    'hash_table', 'H', help='the hash table package id',
+    default=api.DEF_HASH_PACK)
+@manager.arg(
+    'hash_group', 'g', help="the hash table's owning organization",
+    default='HDX')
+@manager.arg(
+    'ua', 'u', help='the user agent (uses `%s` ENV if available)' % api.UA_ENV,
+    default=environ.get(api.UA_ENV, api.DEF_USER_AGENT))
+@manager.arg(
+    'chunksize_rows', 'c', help='number of rows to write at a time',
+    type=int, default=api.CHUNKSIZE_ROWS)
+@manager.arg(
+    'chunksize_bytes', 'C', help='number of bytes to read/write at a time',
+    type=int, default=api.CHUNKSIZE_BYTES)
+@manager.arg(
+    'workers', 'n', help='number of resources to update at a time',
+    type=int, default=utils.DEF_WORKERS)
+@manager.arg(
+    'blob_dir', 'b', help=('the blob store directory, to reuse earlier'
+    ' downloads (uses `%s` ENV if available)') % blobs.BLOB_DIR_ENV,
+    default=environ.get(blobs.BLOB_DIR_ENV))
+@manager.arg(
+    'quiet', 'q', help='suppress debug statements', type=bool, default=False)
+@manager.arg(
+    'spool_max_bytes', 'S', help=('number of bytes of each download to keep'
+    ' in memory before spilling to disk (all concurrent downloads share the'
+    ' `%s` ENV budget, default: %i)') % (
+        spool.SPOOL_BUDGET_ENV, spool.DEF_SPOOL_BUDGET),
+    type=int, default=spool.DEF_SPOOL_BYTES)
+@manager.arg(
+    'tmpdir', 'T', help=('the directory to spill downloads to (default: the'
+    ' system temp directory)'))
+@manager.arg(
+    'hash_algo', 'a', help=('the hash algorithm used to detect changes (one'
+    ' of %s, uses `%s` ENV if available)') % (
+        ', '.join(sorted(hashing.ALGOS)), hashing.HASH_ALGO_ENV),
+    default=environ.get(hashing.HASH_ALGO_ENV, hashing.DEF_ALGO))
+@manager.arg(
+    'force', 'f', help="update resources even if they haven't changed.",
+    type=bool, default=False)
+@manager.command
+def update(org_ids, force=None, **kwargs):
+    """Updates the 3w and topline datastore tables of organizations"""
+    verbose = not kwargs['quiet']
+
+    try:
+        hashing.get_algo(kwargs['hash_algo'])
+    except ValueError as err:
+        sys.exit('ERROR: %s' % err)
+
     ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
-    ckan = CKAN(**ckan_kwargs)
-    ds.update(topline_id, ckan=ckan) if topline_id else None
-    ds.update(three_dub_id, ckan=ckan)
+    ckan = utils.get_ckan(**ckan_kwargs)
+    resource_ids = list(find_dashboard_resources(ckan, org_ids))
+
+    def func(resource_id):
+        return ds.update_resource(ckan, resource_id, force, **kwargs)
+
+    failed = ds.run_many(func, resource_ids, kwargs['workers'], verbose)
+
+    if failed:
+        sys.exit('ERROR: %i resource(s) not updated.' % len(failed))
 
 
 if __name__ == '__main__':
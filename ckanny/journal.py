@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Retries and resumable journals for datastore loads """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import sys
+
+from contextlib import contextmanager
+from functools import wraps
+from os import remove, path as p
+from threading import local
+
+from . import utils
+
+DEF_JOURNAL_TTL = 7 * 24 * 60 * 60
+
+# the load (if any) running on the current thread
+current = local()
+
+
+def get_retry_check(kwargs):
+    """Returns whether to retry a failed `datastore_upsert` call. Inserts
+    aren't idempotent (the chunk may have been committed before a read
+    timeout or 5xx), so they are only retried if they were never sent."""
+    idempotent = kwargs.get('method', 'upsert') != 'insert'
+    return utils.is_transient if idempotent else utils.is_unsent
+
+
+class Journal(object):
+    """Records how many rows of a source have been committed to a datastore
+    table. `source_id` identifies the source, e.g., its hash, so that a
+    journal is never resumed with a different file."""
+    def __init__(self, resource_id, source_id, cache_dir=utils.CACHE_DIR):
+        self.resource_id = resource_id
+        self.source_id = source_id
+        self.cache_dir = cache_dir
+        self.name = 'journal-%s.json' % resource_id
+        self.rows = 0
+
+    def read(self):
+        args = (self.name, DEF_JOURNAL_TTL, self.cache_dir)
+        content = utils.read_cache(*args) or {}
+
+        if content.get('source') == self.source_id:
+            self.rows = content.get('rows', 0)
+
+        return self.rows
+
+    def commit(self, rows):
+        self.rows = rows
+        content = {'source': self.source_id, 'rows': rows}
+        utils.write_cache(self.name, content, self.cache_dir)
+
+    def remove(self):
+        try:
+            remove(p.join(self.cache_dir, self.name))
+        except OSError:
+            pass
+
+
+class Load(object):
+    """The state of a datastore load on one thread"""
+    def __init__(self, journal, resume=False, retries=utils.DEF_RETRIES):
+        self.journal = journal
+        self.resume = resume and journal.read() > 0
+        self.retries = retries
+        self.offset = 0
+
+
+def install(ckan):
+    """Makes a `CKAN` client retry failed upserts and honor the load (if any)
+    running on the current thread"""
+    if getattr(ckan, 'journaled', False):
+        return ckan
+
+    upsert, delete = ckan.datastore_upsert, ckan.datastore_delete
+
+    @wraps(upsert)
+    def datastore_upsert(**kwargs):
+        load = getattr(current, 'load', None)
+        records = kwargs.get('records') or []
+
+        when = get_retry_check(kwargs)
+
+        if not load or kwargs['resource_id'] != load.journal.resource_id:
+            return utils.retry(upsert, when=when)(**kwargs)
+
+        start, load.offset = load.offset, load.offset + len(records)
+        committed = load.journal.rows - start
+
+        if committed >= len(records):
+            # this chunk made it in the last time around
+            return None
+        elif committed > 0:
+            kwargs['records'] = records[committed:]
+
+        func = utils.retry(upsert, load.retries, when)
+        result = func(**kwargs)
+        load.journal.commit(load.offset)
+        return result
+
+    @wraps(delete)
+    def datastore_delete(**kwargs):
+        load = getattr(current, 'load', None)
+        resuming = load and load.resume and not kwargs.get('filters')
+
+        if resuming and kwargs['resource_id'] == load.journal.resource_id:
+            # keep the rows we are resuming from
+            return None
+
+        return delete(**kwargs)
+
+    ckan.datastore_upsert = datastore_upsert
+    ckan.datastore_delete = datastore_delete
+    ckan.journaled = True
+    return ckan
+
+
+@contextmanager
+def load(ckan, resource_id, source_id, resume=False, **kwargs):
+    """Journals the datastore load of `resource_id` that runs within the
+    block. With `resume`, the chunks committed by an earlier (failed) load of
+    the same source are skipped."""
+    verbose = not kwargs.get('quiet')
+    retries = kwargs.get('retries')
+    cache_dir = kwargs.get('cache_dir') or utils.CACHE_DIR
+    journal = Journal(resource_id, source_id, cache_dir)
+    retries = utils.DEF_RETRIES if retries is None else retries
+    current.load = Load(journal, resume, retries)
+    install(ckan)
+
+    if current.load.resume and verbose:
+        print('Resuming load of resource %s at row %i...' % (
+            resource_id, journal.rows))
+
+    try:
+        yield current.load
+    except Exception:
+        if journal.rows:
+            msg = 'Load of resource %s stopped after row %i. Rerun with '
+            msg += '`--resume` to continue from there.'
+            print(msg % (resource_id, journal.rows), file=sys.stderr)
+
+        raise
+    else:
+        journal.remove()
+    finally:
+        del current.load
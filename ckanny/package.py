@@ -22,9 +22,10 @@ from os import path as p
 from pprint import pprint
 from slugify import slugify
 from manager import Manager
-from ckanutils import CKAN
 from tabutils import fntools as ft, process as pr
 
+from . import utils
+
 manager = Manager()
 
 methods = {
@@ -80,96 +81,52 @@ def make_rkwargs(path, name=None, **kwargs):
     return resource
 
 
-@manager.arg(
-    'org_id', help='the organization id', nargs='?', default=sys.stdin)
-@manager.arg('license_id', 'l', help='Data license', default='cc-by-igo')
-@manager.arg('source', 's', help='Data source', default='Multiple sources')
-@manager.arg(
-    'files', 'f', help='Comma separated list of file paths to add',
-    default='')
-@manager.arg(
-    'names', 'n', help='Comma separated list of file names (requires `files`)',
-    default='')
-@manager.arg(
-    'description', 'd', help='Dataset description (default: same as `title`)')
-@manager.arg(
-    'methodology', 'm', help='Data collection methodology', default='observed')
-@manager.arg(
-    'title', 't', help='Package title', default='Untitled %s' % dt.utcnow())
-@manager.arg('tags', 'T', help='Comma separated list of tags', default='')
-@manager.arg('type', 'y', help='Package type', default='dataset')
-@manager.arg('caveats', 'c', help='Package caveats')
-@manager.arg(
-    'location', 'L', help='Location the data represents', default='world')
-@manager.arg(
-    'start', 'S', help='Data start date',
-    default=dt.utcnow().strftime('%m/%d/%Y'))
-@manager.arg('end', 'e', help='Data end date')
-@manager.arg(
-    'remote', 'r', help='The remote ckan url (uses `%s` ENV if available)' %
-    api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
-@manager.arg(
-    'api_key', 'k', help='The api key (uses `%s` ENV if available)' %
-    api.API_KEY_ENV, default=environ.get(api.API_KEY_ENV))
-@manager.arg(
-    'ua', 'u', help='The user agent (uses `%s` ENV if available)' % api.UA_ENV,
-    default=environ.get(api.UA_ENV, api.DEF_USER_AGENT))
-@manager.arg(
-    'private', 'p', help='Make package private', type=bool, default=False)
-@manager.arg(
-    'quiet', 'q', help='Suppress debug statements', type=bool, default=False)
-@manager.command
-def create(org_id, **kwargs):
-    """Creates a package (aka dataset)"""
+def create_package(ckan, org_id, **kwargs):
+    """Creates a package (aka dataset) from the `pk.create` options. Raises a
+    `ValueError` if the organization, license, or group doesn't exist."""
     kw = ft.Objectify(kwargs, type='dataset')
     verbose = not kw.quiet
-    ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
-    ckan = CKAN(**ckan_kwargs)
 
     licenses = it.imap(itemgetter('id'), ckan.license_list())
     orgs = ckan.organization_list()
     org_ids = it.imap(itemgetter('id'), orgs)
     org_names = it.imap(itemgetter('name'), orgs)
     groups = ckan.group_list()
-    name = kw.name or slugify(kw.title)
+    title = kw.title or 'Untitled %s' % dt.utcnow()
+    name = kw.name or slugify(title)
 
     raw_tags = filter(None, kw.tags.split(','))
     tags = [{'state': 'active', 'name': t} for t in raw_tags]
+    start = parse(str(kw.start)) if kw.start else dt.utcnow()
+    date = start.strftime('%m/%d/%Y')
 
-    if kw.start:
-        start = parse(str(kw.start)).strftime('%m/%d/%Y')
-    else:
-        date = None
-
-    if kw.start and kw.end:
-        date = '%s-%s' % (start, parse(str(kw.end)).strftime('%m/%d/%Y'))
-    elif kw.start:
-        date = start
+    if kw.end:
+        date = '%s-%s' % (date, parse(str(kw.end)).strftime('%m/%d/%Y'))
 
     if kw.location in set(groups):
         group_list = [{'name': kw.location}]
     elif kw.location:
-        sys.exit('group name: %s not found!' % kw.location)
+        raise ValueError('group name: %s not found!' % kw.location)
     else:
         group_list = []
 
     if org_id not in set(it.chain(org_ids, org_names)):
-        sys.exit('organization id: %s not found!' % org_id)
+        raise ValueError('organization id: %s not found!' % org_id)
 
     if kw.license_id not in set(licenses):
-        sys.exit('license id: %s not found!' % kw.license_id)
+        raise ValueError('license id: %s not found!' % kw.license_id)
 
     files = filter(None, kw.files.split(','))
     names = filter(None, kw.names.split(','))
     resource_list = list(it.starmap(make_rkwargs, zip(files, names))) or []
 
     package_kwargs = {
-        'title': kw.title,
+        'title': title,
         'name': name,
         'license_id': kw.license_id,
         'owner_org': org_id,
         'dataset_source': kw.source,
-        'notes': kw.description or kw.title,
+        'notes': kw.description or title,
         'type': kw.type,
         'tags': tags,
         'resources': resource_list,
@@ -186,15 +143,65 @@ def create(org_id, **kwargs):
         pprint(package_kwargs)
         print('\n')
 
-    try:
-        package = ckan.package_create(**package_kwargs)
-    except api.ValidationError as e:
-        exit(e)
+    package = ckan.package_create(**package_kwargs)
 
     if kw.private:
         org = package['organization']
         ckan.package_privatize(org_id=org['id'], datasets=[package['id']])
 
+    return package
+
+
+@manager.arg(
+    'org_id', help='the organization id', nargs='?', default=sys.stdin)
+@manager.arg('license_id', 'l', help='Data license', default='cc-by-igo')
+@manager.arg('source', 's', help='Data source', default='Multiple sources')
+@manager.arg(
+    'files', 'f', help='Comma separated list of file paths to add',
+    default='')
+@manager.arg(
+    'names', 'n', help='Comma separated list of file names (requires `files`)',
+    default='')
+@manager.arg(
+    'description', 'd', help='Dataset description (default: same as `title`)')
+@manager.arg(
+    'methodology', 'm', help='Data collection methodology', default='observed')
+@manager.arg(
+    'title', 't', help='Package title (default: Untitled <current time>)')
+@manager.arg('tags', 'T', help='Comma separated list of tags', default='')
+@manager.arg('type', 'y', help='Package type', default='dataset')
+@manager.arg('caveats', 'c', help='Package caveats')
+@manager.arg(
+    'location', 'L', help='Location the data represents', default='world')
+@manager.arg('start', 'S', help='Data start date (default: today)')
+@manager.arg('end', 'e', help='Data end date')
+@manager.arg(
+    'remote', 'r', help='The remote ckan url (uses `%s` ENV if available)' %
+    api.REMOTE_ENV, default=environ.get(api.REMOTE_ENV))
+@manager.arg(
+    'api_key', 'k', help='The api key (uses `%s` ENV if available)' %
+    api.API_KEY_ENV, default=environ.get(api.API_KEY_ENV))
+@manager.arg(
+    'ua', 'u', help='The user agent (uses `%s` ENV if available)' % api.UA_ENV,
+    default=environ.get(api.UA_ENV, api.DEF_USER_AGENT))
+@manager.arg(
+    'private', 'p', help='Make package private', type=bool, default=False)
+@manager.arg(
+    'quiet', 'q', help='Suppress debug statements', type=bool, default=False)
+@manager.command
+def create(org_id, **kwargs):
+    """Creates a package (aka dataset)"""
+    verbose = not kwargs['quiet']
+    ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
+    ckan = utils.get_ckan(**ckan_kwargs)
+
+    try:
+        package = create_package(ckan, org_id, **kwargs)
+    except ValueError as err:
+        sys.exit(str(err))
+    except api.ValidationError as e:
+        exit(e)
+
     if verbose:
         print('Your package response.')
         pprint(package)
@@ -235,7 +242,7 @@ def update(pid, **kwargs):
     kw = ft.Objectify(kwargs, type='dataset')
     verbose = not kw.quiet
     ckan_kwargs = {k: v for k, v in kwargs.items() if k in api.CKAN_KEYS}
-    ckan = CKAN(**ckan_kwargs)
+    ckan = utils.get_ckan(**ckan_kwargs)
 
     licenses = it.imap(itemgetter('id'), ckan.license_list())
     groups = ckan.group_list()
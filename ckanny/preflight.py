@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Pre-flight checks of a csv file before it's loaded into the datastore """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import re
+import csv
+import codecs
+import itertools as it
+
+from collections import namedtuple
+from datetime import datetime as dt
+from functools import partial
+from hashlib import sha1
+from multiprocessing import Pool
+
+from dateutil.parser import parse
+
+DEF_SAMPLE_ROWS = 1000
+BATCH_ROWS = 10000
+
+# bytes of each primary key's digest that are kept to find duplicates. 8
+# bytes make a false duplicate unlikely until billions of rows.
+KEY_BYTES = 8
+
+BOOLS = {'true', 'false', 't', 'f', 'yes', 'no', 'y', 'n', '1', '0'}
+ISO_DATE = re.compile(
+    r'\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?'
+    r'(Z|[+-]\d{2}:?\d{2})?$')
+
+# the types to try (in order) when inferring a field's type
+TYPES = ['int', 'numeric', 'timestamp']
+
+# datastore (postgres) types and the cast that checks them
+ALIASES = {
+    'int': 'int', 'int2': 'int', 'int4': 'int', 'int8': 'int',
+    'integer': 'int', 'smallint': 'int', 'bigint': 'int',
+    'numeric': 'numeric', 'float': 'numeric', 'float4': 'numeric',
+    'float8': 'numeric', 'real': 'numeric', 'double precision': 'numeric',
+    'timestamp': 'timestamp', 'date': 'timestamp',
+    'bool': 'bool', 'boolean': 'bool',
+}
+
+Problem = namedtuple('Problem', ['line', 'message'])
+
+
+def to_bool(value):
+    if value.lower() not in BOOLS:
+        raise ValueError('Invalid boolean `%s`.' % value)
+
+    return value.lower() in {'true', 't', 'yes', 'y', '1'}
+
+
+def to_timestamp(value):
+    """Parses a date or timestamp. `dateutil` is slow, so iso dates are
+    checked with `strptime`.
+
+    >>> to_timestamp('2015-02-30')
+    Traceback (most recent call last):
+    ValueError: day is out of range for month
+    """
+    if ISO_DATE.match(value):
+        return dt.strptime(value[:10], '%Y-%m-%d')
+    else:
+        return parse(value)
+
+
+CASTS = {
+    'int': int, 'numeric': float, 'timestamp': to_timestamp, 'bool': to_bool}
+
+
+def decode(row, encoding):
+    return [cell.decode(encoding) for cell in row]
+
+
+def sanitize(name):
+    """Underscorifies and lowercases a field name
+
+    >>> sanitize(' Total Pop. ') == 'total_pop'
+    True
+    """
+    return re.sub(r'\W+', '_', name.strip()).strip('_').lower()
+
+
+def is_castable(value, _type):
+    """Whether a (non empty) value can be cast to a datastore type
+
+    >>> is_castable('1.5', 'int')
+    False
+    >>> is_castable('1.5', 'numeric')
+    True
+    """
+    try:
+        CASTS[_type](value)
+    except (ValueError, TypeError, OverflowError):
+        return False
+    else:
+        return True
+
+
+def infer_types(sample, width, encoding='utf-8'):
+    """Infers each field's type from a sample of rows (`None` means text)"""
+    rows, types = [], []
+
+    for _, row in sample:
+        try:
+            rows.append(decode(row, encoding))
+        except UnicodeDecodeError:
+            # the row is reported when it's checked
+            pass
+
+    for column in range(width):
+        values = [r[column] for r in rows if len(r) > column and r[column]]
+        types.append(infer_type(values))
+
+    return types
+
+
+def infer_type(values):
+    """The first type all of the values can be cast to
+
+    >>> infer_type(['1', '2.5']) == 'numeric'
+    True
+    >>> infer_type([]) is None
+    True
+    """
+    castable = (
+        t for t in TYPES if values and all(is_castable(v, t) for v in values))
+
+    return next(castable, None)
+
+
+def read_rows(f, first_row=0):
+    """Yields each (non blank) row of a csv file along with the line it
+    starts on"""
+    reader = csv.reader(f)
+    line = 1
+
+    for num, row in enumerate(reader):
+        if num >= first_row and row:
+            yield line, row
+
+        line = reader.line_num + 1
+
+
+def find_keys(names, primary_key=None):
+    """Returns the column of each primary key field (matching either the
+    field name or its sanitized form), and the fields that weren't found"""
+    sanitized = map(sanitize, names)
+    lookup = dict(it.chain(zip(sanitized, it.count()), zip(names, it.count())))
+    keys, missing = [], []
+
+    for name in filter(None, (primary_key or '').split(',')):
+        if name.strip() in lookup:
+            keys.append(lookup[name.strip()])
+        else:
+            missing.append(name.strip())
+
+    return keys, missing
+
+
+def check_batch(context, batch):
+    """Checks a batch of rows. Returns the problems found, and the primary
+    key digest of each row (to be checked for duplicates across batches)."""
+    width, types, keys, encoding = context
+    problems, digests = [], []
+
+    for line, row in batch:
+        if len(row) != width:
+            message = 'expected %i fields, found %i' % (width, len(row))
+            problems.append(Problem(line, message))
+            continue
+
+        try:
+            values = decode(row, encoding)
+        except UnicodeDecodeError as err:
+            message = "can't decode the row as %s: %s" % (encoding, err)
+            problems.append(Problem(line, message))
+            continue
+
+        for value, (name, _type) in zip(values, types):
+            if value and _type and not is_castable(value, _type):
+                message = "can't cast `%s` value %r to %s" % (
+                    name, value, _type)
+
+                problems.append(Problem(line, message))
+
+        if keys:
+            key = [row[i] for i in keys]
+
+            if not all(key):
+                problems.append(Problem(line, 'empty primary key'))
+            else:
+                digest = sha1(b'\0'.join(key)).digest()[:KEY_BYTES]
+                digests.append((digest, line))
+
+    return problems, digests
+
+
+def recode(f, encoding):
+    """`csv` can't read files with null bytes, so utf-16 and utf-32 files are
+    re-encoded as utf-8 as they are read. Returns the file and its (new)
+    encoding."""
+    if encoding.lower().replace('-', '').startswith(('utf16', 'utf32')):
+        f = (line.encode('utf-8') for line in codecs.getreader(encoding)(f))
+        encoding = 'utf-8'
+
+    return f, encoding
+
+
+def get_types(names, fields=None, sample=None, encoding='utf-8'):
+    """Returns the type of each field (from the datastore table's `fields` if
+    given, otherwise inferred from the `sample` rows if given), and the
+    problems found"""
+    if fields:
+        table = {field['id']: ALIASES.get(field['type']) for field in fields}
+        types = [table.get(name) for name in names]
+        missing = [name for name in names if name not in table]
+        messages = [
+            "field `%s` isn't in the datastore table" % name
+            for name in missing]
+    elif sample is not None:
+        types = infer_types(sample, len(names), encoding)
+        messages = []
+    else:
+        types, messages = [None] * len(names), []
+
+    return types, messages
+
+
+def check_rows(rows, context, workers=1):
+    """Checks the rows a batch at a time on `workers` processes. Yields each
+    problem (in line order)."""
+    batches = iter(lambda: list(it.islice(rows, BATCH_ROWS)), [])
+    func = partial(check_batch, context)
+    pool = Pool(workers) if workers > 1 else None
+    seen = set()
+
+    try:
+        results = pool.imap(func, batches) if pool else it.imap(func, batches)
+
+        for found, digests in results:
+            for digest, line in digests:
+                if digest in seen:
+                    found.append(Problem(line, 'duplicate primary key'))
+                else:
+                    seen.add(digest)
+
+            for problem in sorted(found):
+                yield problem
+    finally:
+        pool.terminate() if pool else None
+
+
+def validate(f, encoding='utf-8', primary_key=None, fields=None, **kwargs):
+    """Streams a csv file once, checking that each row has as many fields as
+    the header, can be decoded and cast to the field types, and has a unique
+    primary key. Types come from `fields` (the datastore table's) if given,
+    otherwise they are inferred from a sample of rows if `type_cast` is set.
+    Yields each problem (in line order). Batches of rows are checked on
+    `workers` processes.
+    """
+    f, encoding = recode(f, encoding)
+    rows = read_rows(f, kwargs.get('first_row') or 0)
+
+    try:
+        line, header = next(rows)
+    except StopIteration:
+        yield Problem(1, 'the file is empty')
+        return
+
+    try:
+        names = decode(header, encoding)
+    except UnicodeDecodeError as err:
+        message = "can't decode the header as %s: %s" % (encoding, err)
+        yield Problem(line, message)
+        return
+
+    keys, missing = find_keys(names, primary_key)
+
+    for name in missing:
+        yield Problem(line, 'primary key field `%s` not found' % name)
+
+    if kwargs.get('sanitize'):
+        names = map(sanitize, names)
+
+    if kwargs.get('type_cast') and not fields:
+        size = kwargs.get('sample_rows') or DEF_SAMPLE_ROWS
+        sample = list(it.islice(rows, size))
+        rows = it.chain(sample, rows)
+    else:
+        sample = None
+
+    types, messages = get_types(names, fields, sample, encoding)
+
+    for message in messages:
+        yield Problem(line, message)
+
+    context = (len(names), zip(names, types), keys, encoding)
+
+    for problem in check_rows(rows, context, kwargs.get('workers') or 1):
+        yield problem
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" A warm ckanny process that runs commands sent over a Unix socket """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import gc
+import os
+import sys
+import json
+import signal
+import socket
+import traceback
+
+from os import chdir, getcwd, environ, umask, unlink, path as p
+from tempfile import TemporaryFile
+from SocketServer import ForkingMixIn, StreamRequestHandler, UnixStreamServer
+
+from . import utils
+
+SOCKET_ENV = 'CKANNY_SOCKET'
+DEF_SOCKET = environ.get(SOCKET_ENV, p.join(utils.CACHE_DIR, 'ckanny.sock'))
+
+# argument defaults are read from these ENVs when ckanny is imported, so a
+# command is only forwarded if the caller's match the server's
+DEFAULT_ENV_PREFIX = 'CKAN'
+
+
+class Connection(object):
+    """A client connection. If the client goes away, the command keeps running
+    (as it would have under `nohup`) but its output is dropped."""
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.connected = True
+
+    def send(self, message):
+        if not self.connected:
+            return
+
+        try:
+            send(self.wfile, message)
+        except socket.error:
+            self.connected = False
+
+
+class Stream(object):
+    """A file like object that forwards writes to a client"""
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def write(self, content):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+
+        self.connection.send({self.name: content})
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class Server(ForkingMixIn, UnixStreamServer):
+    """Runs each command in a forked child, so commands run concurrently and
+    can't see each other's output, working directory, or state"""
+    def __init__(self, *args, **kwargs):
+        UnixStreamServer.__init__(self, *args, **kwargs)
+        self.env = get_default_env()
+
+    def reap(self, *args):
+        """Reaps the children that exited (as soon as they do, rather than
+        when the next command arrives)"""
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+
+            if not pid:
+                return
+
+            self.active_children.discard(pid) if self.active_children else None
+
+    def finish_request(self, request, client_address):
+        # in the child, commands (e.g., pre-flight checks) wait on their own
+        # children
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        UnixStreamServer.finish_request(self, request, client_address)
+
+
+class Handler(StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+
+        if request.get('env') != self.server.env:
+            send(self.wfile, {'refused': "the caller's environment differs"})
+            return
+
+        # commands read the (server's) stdin when no ids are given, so swap in
+        # the caller's
+        send(self.wfile, {'ready': True})
+        stdin = json.loads(self.rfile.readline())['stdin']
+        set_stdin(stdin.encode('latin-1'))
+        connection = Connection(self.wfile)
+        stdout = Stream(connection, 'stdout')
+        stderr = Stream(connection, 'stderr')
+        code = run(request['argv'], request['cwd'], stdout, stderr)
+        connection.send({'exit': code})
+
+    def finish(self):
+        try:
+            StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+
+def get_default_env():
+    return {
+        k: v for k, v in environ.items()
+        if k.startswith(DEFAULT_ENV_PREFIX) and k != SOCKET_ENV}
+
+
+def set_stdin(content):
+    """Points this process's stdin file descriptor at `content`"""
+    with TemporaryFile() as f:
+        f.write(content)
+        f.seek(0)
+        os.dup2(f.fileno(), sys.stdin.fileno())
+
+
+def send(wfile, message):
+    wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+    wfile.flush()
+
+
+def run(argv, cwd, stdout, stderr):
+    """Runs a command in this process with its output redirected. Returns the
+    exit code."""
+    from . import manager
+
+    streams, old_cwd = (sys.stdout, sys.stderr), getcwd()
+    sys.stdout, sys.stderr = stdout, stderr
+
+    try:
+        chdir(cwd)
+        manager.main(argv)
+    except SystemExit as err:
+        code = err.code
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    else:
+        code = 0
+    finally:
+        sys.stdout, sys.stderr = streams
+        chdir(old_cwd)
+
+    if code is not None and not isinstance(code, int):
+        # mimic the interpreter's handling of `sys.exit('message')`
+        print(code, file=stderr)
+        code = 1
+
+    return code or 0
+
+
+def close_sessions():
+    """Closes the pooled connections of every `requests` session, so forked
+    children don't share (and garble) a socket"""
+    import requests
+
+    for obj in gc.get_objects():
+        if isinstance(obj, requests.Session):
+            obj.close()
+
+
+def warm(verbose=True):
+    """Imports every command's module, and creates the clients that commands
+    use by default, so that forked children start with them"""
+    import ckanutils as api
+
+    from . import manager
+
+    for namespace in list(manager.modules):
+        manager.load(namespace)
+
+    utils.clients = {}
+    remote = environ.get(api.REMOTE_ENV)
+    api_key = environ.get(api.API_KEY_ENV)
+    ua = environ.get(api.UA_ENV, api.DEF_USER_AGENT)
+
+    for quiet in (False, True) if remote else ():
+        try:
+            utils.get_ckan(remote=remote, api_key=api_key, ua=ua, quiet=quiet)
+        except Exception as err:
+            # commands will report it themselves
+            if verbose:
+                print("Couldn't connect to %s: %s" % (remote, err))
+
+            break
+
+    close_sessions()
+
+
+def serve(socket_path=DEF_SOCKET, verbose=True):
+    """Serves commands until interrupted"""
+    warm(verbose)
+
+    if p.exists(socket_path):
+        unlink(socket_path)
+
+    # only the current user may connect
+    old_umask = umask(0o177)
+
+    try:
+        server = Server(socket_path, Handler)
+    finally:
+        umask(old_umask)
+
+    signal.signal(signal.SIGCHLD, server.reap)
+    signal.siginterrupt(signal.SIGCHLD, False)
+
+    if verbose:
+        print('Serving ckanny commands on %s...' % socket_path)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        unlink(socket_path)
+
+
+def forward(argv, socket_path=DEF_SOCKET):
+    """Runs a command on a `ckanny serve` process (along with this process's
+    stdin, unless it's a terminal). Returns the exit code, or `None` if no
+    server is listening or it refused the command."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+
+    f = sock.makefile('rwb')
+    send(f, {'argv': argv, 'cwd': getcwd(), 'env': get_default_env()})
+
+    try:
+        for line in f:
+            message = json.loads(line)
+
+            if 'exit' in message:
+                return message['exit']
+            elif 'refused' in message:
+                return None
+            elif 'ready' in message:
+                isatty = sys.stdin.isatty()
+                stdin = '' if isatty else sys.stdin.read().decode('latin-1')
+                send(f, {'stdin': stdin})
+            else:
+                stream = sys.stdout if 'stdout' in message else sys.stderr
+                content = message.get('stdout', message.get('stderr'))
+                stream.write(content.encode('utf-8'))
+                stream.flush()
+    finally:
+        f.close()
+        sock.close()
+
+    return 1
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Temporary files that share a process wide memory budget """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+from os import environ
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+
+from . import stats
+
+SPOOL_BUDGET_ENV = 'CKANNY_SPOOL_BUDGET'
+DEF_SPOOL_BYTES = 32 * 2 ** 20
+DEF_SPOOL_BUDGET = 256 * 2 ** 20
+
+
+class Budget(object):
+    """The bytes of memory that all spools (on every thread) may use"""
+    def __init__(self, size=DEF_SPOOL_BUDGET):
+        self.size = size
+        self.available = size
+        self.lock = Lock()
+
+    def reserve(self, size):
+        """Reserves up to `size` bytes. Returns the bytes reserved."""
+        with self.lock:
+            reserved = max(min(size, self.available), 0)
+            self.available -= reserved
+            return reserved
+
+    def release(self, size):
+        with self.lock:
+            self.available += size
+
+
+budget = Budget(int(environ.get(SPOOL_BUDGET_ENV) or DEF_SPOOL_BUDGET))
+
+
+class Spool(SpooledTemporaryFile):
+    """A temporary file that stays in memory until it outgrows `max_size`
+    bytes (or its share of the budget), then rolls over to a file in `dir`.
+    """
+    def __init__(self, max_size=DEF_SPOOL_BYTES, dir=None, **kwargs):
+        self.reserved = budget.reserve(max_size)
+
+        # a `max_size` of 0 would never roll over
+        size = max(self.reserved, 1)
+        SpooledTemporaryFile.__init__(self, size, dir=dir, **kwargs)
+
+    def free(self):
+        budget.release(self.reserved)
+        self.reserved = 0
+
+    def rollover(self):
+        if not self._rolled:
+            stats.add('spool rollover', bytes=self._file.tell())
+
+        SpooledTemporaryFile.rollover(self)
+        self.free()
+
+    def close(self):
+        SpooledTemporaryFile.close(self)
+        self.free()
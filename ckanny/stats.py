@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Per stage timing and profiling instrumentation for ckanny commands """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import sys
+import json
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial, wraps
+from threading import Lock
+from time import time
+
+COUNTERS = ['seconds', 'bytes', 'rows', 'calls']
+FLAGS = {'--stats': False, '--stats-json': True, '--profile': True}
+
+# only set when a command is run with one of the `FLAGS` so that the api
+# calls and requests aren't wrapped unless somebody is looking
+enabled = False
+
+
+class Stats(object):
+    """Collects the wall time, bytes, rows, and calls of each stage"""
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.lock = Lock()
+        self.start = time()
+
+    def add(self, stage, seconds=0, bytes=0, rows=0, calls=1):
+        with self.lock:
+            counts = self.stages.setdefault(stage, dict.fromkeys(COUNTERS, 0))
+            counts['seconds'] += seconds
+            counts['bytes'] += bytes or 0
+            counts['rows'] += rows or 0
+            counts['calls'] += calls
+
+    def to_dict(self):
+        return {'seconds': time() - self.start, 'stages': self.stages}
+
+    def summary(self):
+        row = '%-24s %10s %14s %10s %8s'
+        lines = [row % ('stage', 'seconds', 'bytes', 'rows', 'calls')]
+
+        for stage, counts in self.stages.items():
+            values = [counts[c] for c in COUNTERS]
+            values[0] = '%.3f' % values[0]
+            lines.append(row % tuple([stage] + values))
+
+        lines.append('total: %.3f seconds' % (time() - self.start))
+        return '\n'.join(lines)
+
+
+collector = Stats()
+
+
+def add(stage, **kwargs):
+    collector.add(stage, **kwargs)
+
+
+@contextmanager
+def timer(stage, **kwargs):
+    """Times a stage. Yields a dict for counts only known once it's done,
+    e.g., `bytes`."""
+    start, counts = time(), dict(kwargs)
+
+    try:
+        yield counts
+    finally:
+        collector.add(stage, time() - start, **counts)
+
+
+def timed(stage, func, count=None):
+    """Wraps `func` so each call is timed as `stage`. `count` is called
+    with the same args and returns the counts, e.g., `{'rows': 10}`."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        counts = count(*args, **kwargs) if count else {}
+
+        with timer(stage, **counts):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def count_records(*args, **kwargs):
+    return {'rows': len(kwargs.get('records') or [])}
+
+
+def instrument(ckan):
+    """Times every api call made by a `CKAN` client"""
+    if getattr(ckan, 'instrumented', False):
+        return ckan
+
+    for name, value in vars(ckan).items():
+        if callable(value):
+            count = count_records if name == 'datastore_upsert' else None
+            setattr(ckan, name, timed('api: %s' % name, value, count))
+
+    ckan.instrumented = True
+    return ckan
+
+
+def instrument_requests():
+    """Counts every http request (and the size of its response body)"""
+    import requests
+
+    send = requests.Session.send
+
+    if getattr(send, 'instrumented', False):
+        return
+
+    @wraps(send)
+    def wrapper(session, request, **kwargs):
+        with timer('http requests') as counts:
+            r = send(session, request, **kwargs)
+            counts['bytes'] = int(r.headers.get('content-length') or 0)
+            return r
+
+    wrapper.instrumented = True
+    requests.Session.send = wrapper
+
+
+def extract_flags(args, known=None):
+    """Removes the instrumentation (or other `known`) flags from a list of cli
+    args"""
+    known = FLAGS if known is None else known
+    flags, rest, args = {}, [], iter(args)
+
+    for arg in args:
+        flag, _, value = arg.partition('=')
+
+        if flag in known and known[flag]:
+            flags[flag] = value or next(args, None)
+        elif flag in known:
+            flags[flag] = True
+        else:
+            rest.append(arg)
+
+    return flags, rest
+
+
+def run(func, flags):
+    """Runs `func` and reports on it as requested by the `flags`"""
+    global enabled, collector
+
+    enabled, collector = True, Stats()
+    instrument_requests()
+    profile = flags.get('--profile')
+
+    if profile:
+        from cProfile import Profile
+
+        profiler = Profile()
+        target = partial(profiler.runcall, func)
+    else:
+        target = func
+
+    try:
+        return target()
+    finally:
+        enabled = False
+
+        if profile:
+            profiler.dump_stats(profile)
+
+        if flags.get('--stats'):
+            print(collector.summary(), file=sys.stderr)
+
+        if flags.get('--stats-json'):
+            with open(flags['--stats-json'], 'w') as f:
+                json.dump(collector.to_dict(), f, indent=2)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" A threaded transfer engine for filestore commands """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+from math import ceil
+from multiprocessing.pool import ThreadPool
+from os import remove, rename, path as p
+from Queue import Queue
+from StringIO import StringIO
+from threading import BoundedSemaphore, Event, Lock, Thread
+from urlparse import urlparse
+
+from tabutils import process as tup
+
+from . import blobs, hashing, stats, utils
+
+CHUNKSIZE = 2 ** 16
+DEF_HOST_LIMIT = 4
+
+# number of chunks that may wait on the writer thread before reads block
+QUEUE_SIZE = 16
+
+# the resource fields an upload may set (multipart uploads set them after)
+RESOURCE_KEYS = ['name', 'description', 'hash']
+
+
+class Cancelled(Exception):
+    pass
+
+
+def drain(filepath, queue, errors):
+    """Writes the chunks put on `queue` to `filepath` until it gets `None`"""
+    try:
+        with open(filepath, 'wb') as f:
+            for chunk in iter(queue.get, None):
+                f.write(chunk)
+    except Exception as err:
+        errors.append(err)
+
+        # keep consuming so the reader never blocks on a full queue
+        for _ in iter(queue.get, None):
+            pass
+
+
+def abort(ckan, resource_id):
+    """Aborts a resource's multipart upload (so that the parts sent so far
+    don't linger), ignoring any error"""
+    try:
+        utils.get_action(ckan, 'cloudstorage_abort_multipart')(id=resource_id)
+    except Exception:
+        pass
+
+
+def delete(ckan, resource_id):
+    """Deletes a resource (e.g., one created for an upload that failed),
+    ignoring any error"""
+    try:
+        utils.get_action(ckan, 'resource_delete')(id=resource_id)
+    except Exception:
+        pass
+
+
+class Engine(object):
+    """Runs many downloads and uploads at once while limiting how many are in
+    flight per host. Each download writes to a `.part` file from a separate
+    thread (so disk writes overlap network reads) which is only renamed once
+    complete. Failed or cancelled downloads remove their `.part` file.
+    """
+    def __init__(self, workers=utils.DEF_WORKERS, host_limit=DEF_HOST_LIMIT,
+            chunksize=CHUNKSIZE, store=None):
+        self.workers = workers
+        self.store = store
+        self.host_limit = host_limit
+        self.chunksize = chunksize or CHUNKSIZE
+        self.cancelled = Event()
+        self.semaphores = {}
+        self.lock = Lock()
+
+    def limit(self, url):
+        """Returns the semaphore that bounds the transfers to a url's host"""
+        host = urlparse(url).netloc
+
+        with self.lock:
+            semaphore = BoundedSemaphore(self.host_limit)
+            return self.semaphores.setdefault(host, semaphore)
+
+    def cancel(self):
+        """Stops all transfers at their next chunk"""
+        self.cancelled.set()
+
+    def check(self, item):
+        if self.cancelled.is_set():
+            raise Cancelled('Transfer of %s cancelled.' % item)
+
+    def write(self, filepath, chunks):
+        """Writes `chunks` to `filepath`. Returns the number of bytes
+        written."""
+        partial = '%s.part' % filepath
+        queue, errors, size, completed = Queue(QUEUE_SIZE), [], 0, False
+        writer = Thread(target=drain, args=(partial, queue, errors))
+        writer.daemon = True
+        writer.start()
+
+        try:
+            for chunk in chunks:
+                self.check(filepath)
+
+                if errors:
+                    break
+                elif chunk:
+                    queue.put(chunk)
+                    size += len(chunk)
+
+            completed = not errors
+        finally:
+            queue.put(None)
+            writer.join()
+
+            if not completed and p.exists(partial):
+                remove(partial)
+
+        if errors:
+            raise errors[0]
+
+        rename(partial, filepath)
+        return size
+
+    def download(self, ckan, resource_id, destination='.', **kwargs):
+        """Downloads a filestore resource (or copies it from the blob store).
+        Returns the file path and the encoding."""
+        with self.limit(ckan.address):
+            self.check(resource_id)
+            resource = ckan.resource_show(id=resource_id) if self.store else {}
+            ref = self.store.lookup(resource) if self.store else None
+            fkwargs = {
+                'name_from_id': kwargs.get('name_from_id'),
+                'resource_id': resource_id}
+
+            if ref:
+                filepath = tup.make_filepath(
+                    destination, headers=ref['headers'], **fkwargs)
+
+                size = p.getsize(ref['path'])
+
+                with stats.timer('blob store hit', bytes=size):
+                    blobs.place(ref['path'], filepath)
+
+                return filepath, ref['encoding']
+
+            r = ckan.fetch_resource(resource_id)
+
+            try:
+                headers = r.headers
+                filepath = tup.make_filepath(
+                    destination, headers=headers, **fkwargs)
+
+                with stats.timer('download') as counts:
+                    chunks = r.iter_content(self.chunksize)
+                    counts['bytes'] = self.write(filepath, chunks)
+            finally:
+                r.close()
+
+        if self.store:
+            with open(filepath, 'rb') as f:
+                digest = hashing.hash_file(f, hashing.get_algo())
+
+            skwargs = {'headers': headers, 'encoding': r.encoding}
+            self.store.put(filepath, digest, resource, **skwargs)
+
+        return filepath, r.encoding
+
+    def upload_parts(self, ckan, resource_id=None, package_id=None, **kwargs):
+        """Uploads a file in `part_size` parts (`workers` at a time) with the
+        multipart api of ckanext-cloudstorage. Failed parts are retried. If a
+        part still fails, the upload is aborted (and the resource deleted if
+        it was created for it)."""
+        filepath, part_size = kwargs['filepath'], kwargs['part_size']
+        size = p.getsize(filepath)
+        name = kwargs.get('name') or p.basename(filepath)
+        fields = {k: kwargs[k] for k in RESOURCE_KEYS if kwargs.get(k)}
+
+        def action(verb):
+            return utils.get_action(ckan, 'cloudstorage_%s' % verb)
+
+        if package_id:
+            rkwargs = dict(fields, package_id=package_id, name=name, url='')
+            resource_id = ckan.resource_create(**rkwargs)['id']
+
+        ikwargs = {'id': resource_id, 'name': name, 'size': size}
+        send = action('upload_multipart')
+
+        def send_part(number):
+            self.check(filepath)
+
+            with open(filepath, 'rb') as f:
+                f.seek((number - 1) * part_size)
+                part = f.read(part_size)
+
+            # multipart form fields must be strings
+            pkwargs = {'uploadId': upload_id, 'partNumber': unicode(number)}
+            send(upload=(name, StringIO(part)), **pkwargs)
+            return len(part)
+
+        func = utils.retry(send_part, when=utils.is_transient)
+        numbers = range(1, int(ceil(size / part_size)) + 1) or [1]
+        pool, completed = ThreadPool(self.workers), False
+
+        try:
+            upload_id = action('initiate_multipart')(**ikwargs)['id']
+            pool.map(func, numbers)
+            action('finish_multipart')(uploadId=upload_id)
+            completed = True
+        finally:
+            pool.terminate()
+
+            if not completed:
+                abort(ckan, resource_id)
+
+            if not completed and package_id:
+                delete(ckan, resource_id)
+
+        # like a regular upload, the resource points at the uploaded file
+        fields.update({'url': name, 'url_type': 'upload'})
+        utils.get_action(ckan, 'resource_patch')(id=resource_id, **fields)
+        return {'id': resource_id}
+
+    def upload(self, ckan, resource_id=None, package_id=None, **kwargs):
+        """Updates the filestore of an existing resource or creates a new one
+        (in the package `package_id`). Files larger than `part_size` (if
+        given) are sent in parallel parts. An upload that has already started
+        can't be cancelled."""
+        filepath = kwargs.get('filepath')
+        size = p.getsize(filepath) if filepath else 0
+        part_size = kwargs.pop('part_size', None)
+
+        with self.limit(ckan.address), stats.timer('upload', bytes=size):
+            self.check(resource_id or package_id)
+
+            if part_size and size > part_size:
+                ukwargs = dict(kwargs, part_size=part_size)
+                return self.upload_parts(
+                    ckan, resource_id, package_id, **ukwargs)
+            elif package_id:
+                return ckan.create_resource(package_id, **kwargs)
+            else:
+                return ckan.update_filestore(resource_id, **kwargs)
+
+    def map(self, func, items):
+        """Lazily maps `func` over `items` (in completion order). Cancels the
+        remaining transfers if interrupted."""
+        pool = ThreadPool(self.workers)
+
+        try:
+            for result in pool.imap_unordered(func, items):
+                yield result
+        except BaseException:
+            # `KeyboardInterrupt`, or the caller stopped iterating
+            self.cancel()
+            raise
+        finally:
+            pool.terminate()
+
+            # wait for the cancelled transfers to remove their partial files
+            pool.join()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Miscellaneous ckanny helpers """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import json
+import random
+import itertools as it
+
+from functools import wraps
+from multiprocessing.pool import ThreadPool
+from os import environ, makedirs, rename, path as p
+from tempfile import NamedTemporaryFile
+from time import sleep, time
+
+from . import governor, stats
+
+CACHE_DIR_ENV = 'CKANNY_CACHE_DIR'
+CACHE_DIR = environ.get(CACHE_DIR_ENV, p.join(p.expanduser('~'), '.ckanny'))
+DEF_CACHE_TTL = 24 * 60 * 60
+DEF_WORKERS = 4
+DEF_RETRIES = 5
+DEF_BACKOFF = 1
+DEF_BACKOFF_CAP = 60
+
+# `ckanny serve` sets this to a dict so that clients (and their sessions)
+# are reused across commands
+clients = None
+
+
+def get_ckan(**kwargs):
+    """Creates a `CKAN` client (or reuses a cached one)"""
+    # imported here so that this module stays cheap to import for the cli
+    from ckanutils import CKAN
+
+    governor.install()
+
+    if clients is None:
+        ckan = CKAN(**kwargs)
+    else:
+        key = tuple(sorted(kwargs.items()))
+        ckan = clients.setdefault(key, None) or CKAN(**kwargs)
+        clients[key] = ckan
+
+    return stats.instrument(ckan) if stats.enabled else ckan
+
+
+def get_action(ckan, name):
+    """Returns a ckan api action. Falls back to a `ckanapi` client for the
+    actions `CKAN` doesn't provide a shortcut for."""
+    try:
+        return getattr(ckan, name)
+    except AttributeError:
+        pass
+
+    if not hasattr(ckan, 'remote_api'):
+        import ckanapi
+
+        kwargs = {'apikey': ckan.api_key, 'user_agent': ckan.user_agent}
+        ckan.remote_api = ckanapi.RemoteCKAN(ckan.address, **kwargs)
+
+    return getattr(ckan.remote_api.action, name)
+
+
+def read_cache(name, ttl=DEF_CACHE_TTL, cache_dir=CACHE_DIR):
+    """Reads a json cache entry. Returns `None` if the entry is missing or
+    older than `ttl` seconds."""
+    filepath = p.join(cache_dir, name)
+
+    try:
+        age = time() - p.getmtime(filepath)
+    except OSError:
+        return None
+
+    if age > ttl:
+        return None
+
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_cache(name, content, cache_dir=CACHE_DIR):
+    """Atomically writes a json cache entry"""
+    if not p.isdir(cache_dir):
+        try:
+            makedirs(cache_dir)
+        except OSError:
+            # another process beat us to it
+            pass
+
+    kwargs = {'dir': cache_dir, 'delete': False, 'mode': 'w'}
+
+    with NamedTemporaryFile(**kwargs) as f:
+        json.dump(content, f)
+
+    rename(f.name, p.join(cache_dir, name))
+
+
+def filesize(f):
+    """Gets the size of a file object without moving its position"""
+    position = f.tell()
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(position)
+    return size
+
+
+def parse_ids(ids):
+    """Splits a comma (or whitespace) separated string or file of ids"""
+    content = ids.read() if hasattr(ids, 'read') else ids
+    return [i for i in content.replace(',', ' ').split() if i]
+
+
+def pmap(func, items, workers=DEF_WORKERS, ordered=True):
+    """Lazily maps `func` over `items` using a pool of threads"""
+    pool = ThreadPool(workers)
+    mapper = pool.imap if ordered else pool.imap_unordered
+
+    try:
+        for result in mapper(func, items):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def is_transient(err):
+    """Whether a failed api call is worth retrying, e.g., after a timeout or a
+    502 (which ckanapi can't parse, so it raises a bare `CKANAPIError`)"""
+    import ckanapi
+    import requests
+
+    exceptions = requests.exceptions
+    transient = (exceptions.ConnectionError, exceptions.Timeout)
+    return isinstance(err, transient) or type(err) is ckanapi.CKANAPIError
+
+
+def is_unsent(err):
+    """Whether a failed api call never reached the server, so retrying it
+    can't apply it twice"""
+    import requests
+
+    return isinstance(err, requests.exceptions.ConnectionError)
+
+
+def retry(func, retries=DEF_RETRIES, when=None, backoff=DEF_BACKOFF):
+    """Wraps `func` so that failed calls are retried with exponential backoff
+    (and full jitter). `when` is called with the exception and decides
+    whether it's worth retrying (default: always)."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in it.count():
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                if attempt >= retries or (when and not when(err)):
+                    raise
+
+                delay = min(DEF_BACKOFF_CAP, backoff * 2 ** attempt)
+                sleep(random.uniform(0, delay))
+
+    return wrapper
@@ -32,7 +32,7 @@ setup(
     author_email=ckanny.__email__,
     url='%s/%s' % (gh, title),
     download_url='%s/%s/downloads/%s*.tgz' % (gh, title, title),
-    packages=find_packages(exclude=['docs', 'tests']),
+    packages=find_packages(exclude=['benchmarks', 'docs', 'tests']),
     include_package_data=True,
     install_requires=requirements,
     dependency_links=dependencies,
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" A minimal in-memory stand-in for the CKAN action api """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import cgi
+import json
+import shutil
+import zlib
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from os import path as p
+from threading import Lock, Thread
+from time import sleep
+from uuid import uuid4
+
+CHUNKSIZE = 2 ** 16
+HASH_PACK = 'hash-table'
+HASH_RES = 'hash-table-resource'
+ORG = {'id': 'hdx', 'name': 'hdx', 'display_name': 'HDX'}
+USER = {'id': 'benchmark', 'name': 'benchmark'}
+
+
+class CKANError(Exception):
+    def __init__(self, etype, message, status=409):
+        super(CKANError, self).__init__(message)
+        self.error = {'__type': etype, 'message': message}
+        self.status = status
+
+
+def not_found(kind, item_id):
+    message = 'Not found: %s `%s` was not found' % (kind, item_id)
+    return CKANError('Not Found Error', message, 404)
+
+
+class Store(object):
+    """The packages, resources, and datastore tables of the fake site.
+
+    Only tables with a primary key keep their records (the hash table does),
+    all others just count rows so that multi GB upserts don't fill the
+    benchmark's memory.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.lock = Lock()
+        self.packages = {}
+        self.resources = {}
+        self.files = {}
+        self.tables = {}
+        self.multipart = {}
+        self.uploaded = 0
+        self.package_create(name=HASH_PACK, owner_org=ORG['id'])
+        self.resource_create(package_id=HASH_PACK, id=HASH_RES)
+
+    def _url_for(self, resource_id):
+        return '%s/download/%s' % (self.address, resource_id)
+
+    def add_file(self, filepath, resource_id=None, package_id=HASH_PACK):
+        """Registers a local file as a downloadable filestore resource"""
+        resource = self.resource_create(
+            package_id=package_id, id=resource_id,
+            name=p.basename(filepath))
+
+        self.files[resource['id']] = filepath
+        return resource
+
+    def package_show(self, id, **kwargs):
+        try:
+            return self.packages[id]
+        except KeyError:
+            raise not_found('Package', id)
+
+    def package_create(self, **kwargs):
+        name = kwargs.get('name') or str(uuid4())
+        org = dict(ORG, id=kwargs.get('owner_org', ORG['id']))
+        package = dict(kwargs, id=name, name=name, organization=org)
+        package['resources'] = []
+        self.packages[name] = package
+        return package
+
+    def package_update(self, **kwargs):
+        package = self.package_show(kwargs.get('id') or kwargs['name'])
+        package.update(kwargs)
+        return package
+
+    def package_privatize(self, **kwargs):
+        return None
+
+    def resource_show(self, id, **kwargs):
+        try:
+            return self.resources[id]
+        except KeyError:
+            raise not_found('Resource', id)
+
+    def resource_create(self, upload=None, **kwargs):
+        package = self.package_show(kwargs.get('package_id'))
+        resource_id = kwargs.get('id') or str(uuid4())
+
+        resource = dict(kwargs, id=resource_id, revision_id=resource_id)
+        resource['url'] = self._url_for(resource_id)
+
+        self.resources[resource_id] = resource
+        resources = [r for r in package['resources'] if r['id'] != resource_id]
+        package['resources'] = resources + [resource]
+        return resource
+
+    def resource_update(self, **kwargs):
+        return self.resource_create(**kwargs)
+
+    def resource_patch(self, id, **kwargs):
+        resource = self.resource_show(id)
+        resource.update(kwargs)
+        return resource
+
+    # a stand-in for ckanext-cloudstorage's multipart api
+    def cloudstorage_initiate_multipart(self, id, name=None, size=None,
+            **kwargs):
+        self.resource_show(id)
+        upload_id = str(uuid4())
+        self.multipart[upload_id] = {'resource_id': id, 'parts': set()}
+        return {'id': upload_id, 'name': name, 'size': size}
+
+    def cloudstorage_upload_multipart(self, uploadId, partNumber, **kwargs):
+        try:
+            self.multipart[uploadId]['parts'].add(int(partNumber))
+        except KeyError:
+            raise not_found('Upload', uploadId)
+
+        return {'partNumber': int(partNumber), 'ETag': uuid4().hex}
+
+    def cloudstorage_finish_multipart(self, uploadId, **kwargs):
+        try:
+            upload = self.multipart.pop(uploadId)
+        except KeyError:
+            raise not_found('Upload', uploadId)
+
+        resource = self.resource_show(upload['resource_id'])
+        resource['url_type'] = 'upload'
+        return {'commited': True, 'parts': len(upload['parts'])}
+
+    def cloudstorage_abort_multipart(self, id, **kwargs):
+        for upload_id, upload in list(self.multipart.items()):
+            if upload['resource_id'] == id:
+                del self.multipart[upload_id]
+
+        return True
+
+    def revision_show(self, id, **kwargs):
+        return {'id': id, 'packages': [self.resource_show(id)['package_id']]}
+
+    def organization_list_for_user(self, **kwargs):
+        return [ORG]
+
+    def organization_list(self, **kwargs):
+        return [ORG['name']]
+
+    def organization_show(self, id, **kwargs):
+        return dict(ORG, packages=list(self.packages.values()))
+
+    def license_list(self, **kwargs):
+        return [{'id': 'cc-by-igo', 'title': 'Creative Commons Attribution'}]
+
+    def group_list(self, **kwargs):
+        return ['world']
+
+    def user_show(self, **kwargs):
+        return USER
+
+    def get_site_user(self, **kwargs):
+        return USER
+
+    def datastore_create(self, resource_id, fields=None, **kwargs):
+        self.resource_show(resource_id)
+        key = kwargs.get('primary_key')
+        table = {'fields': fields or [], 'primary_key': key, 'count': 0}
+        table['records'] = {} if key else None
+        self.tables.setdefault(resource_id, table)
+        return {'resource_id': resource_id, 'fields': table['fields']}
+
+    def datastore_delete(self, resource_id, **kwargs):
+        try:
+            del self.tables[resource_id]
+        except KeyError:
+            raise not_found('Resource', resource_id)
+
+        return {'resource_id': resource_id}
+
+    def datastore_upsert(self, resource_id, records=None, **kwargs):
+        try:
+            table = self.tables[resource_id]
+        except KeyError:
+            raise not_found('Resource', resource_id)
+
+        records = records or []
+        key = table['primary_key']
+
+        if key:
+            for record in records:
+                found = table['records'].get(record[key])
+                _id = found['_id'] if found else len(table['records']) + 1
+                table['records'][record[key]] = dict(record, _id=_id)
+
+            table['count'] = len(table['records'])
+        else:
+            table['count'] += len(records)
+
+        return {'resource_id': resource_id}
+
+    def datastore_search(self, resource_id, filters=None, **kwargs):
+        try:
+            table = self.tables[resource_id]
+        except KeyError:
+            raise not_found('Resource', resource_id)
+
+        filters, key = filters or {}, table['primary_key']
+        records = table['records'] or {}
+
+        if key in filters:
+            found = records.get(filters[key])
+            records = [found] if found else []
+        else:
+            offset = kwargs.get('offset', 0)
+            records = sorted(records.values(), key=lambda r: r['_id'])
+            records = records[offset:offset + kwargs.get('limit', 100)]
+
+        fields = [{'id': '_id', 'type': 'int'}] + table['fields']
+        return {'fields': fields, 'records': records, 'total': table['count']}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, content, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        resource_id = self.path.rsplit('/', 1)[-1]
+
+        try:
+            filepath = self.server.store.files[resource_id]
+        except KeyError:
+            return self.reply(404, b'Not found', 'text/plain')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('Content-Length', str(p.getsize(filepath)))
+        self.end_headers()
+
+        with open(filepath, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, CHUNKSIZE)
+
+    def do_POST(self):
+        action = self.path.rsplit('/', 1)[-1]
+        store = self.server.store
+
+        try:
+            data = self.read_data()
+        except (ValueError, zlib.error):
+            return self.reply(400, b'Bad request - JSON Error', 'text/plain')
+
+        try:
+            if action.startswith('_') or action == 'add_file':
+                raise AttributeError(action)
+
+            func = getattr(store, action)
+        except AttributeError:
+            message = 'Action name not known: %s' % action
+            body = {'success': False, 'error': {'message': message}}
+            status = 400
+        else:
+            try:
+                with store.lock:
+                    body = {'success': True, 'result': func(**data)}
+
+                status = 200
+            except CKANError as err:
+                status, error = err.status, err.error
+                body = {'success': False, 'error': error}
+            except TypeError as err:
+                status = 409
+                error = {'__type': 'Validation Error', 'message': str(err)}
+                body = {'success': False, 'error': error}
+
+        self.reply(status, json.dumps(body).encode('utf-8'))
+
+    def read_data(self):
+        length = int(self.headers.get('content-length') or 0)
+        ctype = self.headers.get('content-type', '')
+
+        if not ctype.startswith('multipart/form-data'):
+            content = self.rfile.read(length) if length else b''
+
+            if self.headers.get('content-encoding') == 'gzip':
+                # like a CKAN site behind nginx's gunzip module
+                content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+
+            return {str(k): v for k, v in json.loads(content or '{}').items()}
+
+        environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': ctype}
+        form = cgi.FieldStorage(self.rfile, self.headers, environ=environ)
+        data = {}
+
+        for field in form.list:
+            if field.filename:
+                # uploads are counted, not kept
+                size = 0
+
+                for chunk in iter(lambda: field.file.read(CHUNKSIZE), b''):
+                    size += len(chunk)
+
+                self.server.store.uploaded += size
+                data[str(field.name)] = field.filename
+            else:
+                data[str(field.name)] = field.value.decode('utf-8')
+
+        return data
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start(port=0):
+    """Starts a fake CKAN site in a background thread and returns its server.
+    The site's url is `server.store.address`."""
+    server = Server(('127.0.0.1', port), Handler)
+    server.store = Store('http://127.0.0.1:%i' % server.server_address[1])
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    server = start(5000)
+    print('Serving a fake CKAN site on %s...' % server.store.address)
+
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
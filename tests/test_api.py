@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests of the Python api against a fake CKAN site """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import shutil
+
+from os import path as p
+from tempfile import mkdtemp
+
+from ckanny import api, utils
+from tests import fakeckan
+
+CONTENT = b'id,name\n1,alice\n2,bob\n'
+
+
+def setup():
+    global server, tmpdir, kwargs
+
+    server = fakeckan.start()
+    tmpdir = mkdtemp()
+    kwargs = {'remote': server.store.address, 'api_key': 'test'}
+
+
+def teardown():
+    server.shutdown()
+    shutil.rmtree(tmpdir)
+
+
+def add_file(name):
+    filepath = p.join(tmpdir, name)
+
+    with open(filepath, 'wb') as f:
+        f.write(CONTENT)
+
+    return server.store.add_file(filepath)['id']
+
+
+def test_clients():
+    ckan = api.get_ckan(**kwargs)
+    assert api.get_ckan(**kwargs) is ckan
+    assert api.get_ckan(ckan=ckan) is ckan
+
+    # the cli's client cache isn't touched
+    assert utils.clients is None
+
+
+def test_update_datastore():
+    resource_id = add_file('update.csv')
+    result = api.update_datastore(resource_id, **kwargs)
+    assert result == api.Updated(resource_id, 'updated')
+
+    result = api.update_datastore(resource_id, **kwargs)
+    assert result == api.Updated(resource_id, 'unchanged')
+
+
+def test_fetch():
+    resource_id = add_file('fetch.csv')
+    destination = mkdtemp(dir=tmpdir)
+    result = api.fetch(resource_id, destination, **kwargs)
+
+    with open(result.filepath, 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_fetch_many():
+    resource_id = add_file('many.csv')
+    destination = mkdtemp(dir=tmpdir)
+    ids = [resource_id, 'missing']
+    outcomes = {o.id: o for o in api.fetch_many(ids, destination, **kwargs)}
+
+    assert outcomes[resource_id].result.resource_id == resource_id
+    assert not outcomes[resource_id].error
+    assert isinstance(outcomes['missing'].error, api.NotFound)
+
+
+def test_errors():
+    try:
+        api.fetch('missing', tmpdir, **kwargs)
+    except api.NotFound:
+        pass
+    else:
+        assert False, 'NotFound not raised'
+
+    try:
+        api.fetch('any', tmpdir, remote='http://127.0.0.1:1', api_key='test')
+    except api.Unavailable:
+        pass
+    else:
+        assert False, 'Unavailable not raised'
+
+    try:
+        api.update_datastore('any', hash_algo='crc', **kwargs)
+    except api.InvalidArgument:
+        pass
+    else:
+        assert False, 'InvalidArgument not raised'
+
+
+def test_create_package():
+    result = api.create_package(fakeckan.ORG['id'], name='test', **kwargs)
+    assert result.package_id == 'test'
+    assert server.store.package_show('test')['title']
+
+    try:
+        api.create_package('missing-org', name='other', **kwargs)
+    except api.InvalidArgument:
+        pass
+    else:
+        assert False, 'InvalidArgument not raised'
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests of the blob store """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import os
+import shutil
+
+from io import BytesIO
+from os import path as p
+from tempfile import mkdtemp
+
+from ckanny import blobs
+
+RESOURCE = {
+    'id': 'rid', 'url': 'http://example.com/data.csv',
+    'last_modified': '2016-01-01T00:00:00', 'size': 11}
+
+HEADERS = {'content-type': 'text/csv', 'server': 'nginx'}
+
+
+def setup():
+    global tmpdir, store
+
+    tmpdir = mkdtemp()
+    store = blobs.BlobStore(p.join(tmpdir, 'blobs'))
+
+
+def teardown():
+    shutil.rmtree(tmpdir)
+
+
+def write(name, content):
+    filepath = p.join(tmpdir, name)
+
+    with open(filepath, 'wb') as f:
+        f.write(content)
+
+    return filepath
+
+
+def test_put_and_get():
+    filepath = write('data.csv', b'hello,world')
+    kwargs = {'headers': HEADERS, 'encoding': 'utf-8'}
+    blob = store.put(filepath, 'sha1:abc', RESOURCE, **kwargs)
+    ref = store.lookup(RESOURCE)
+
+    assert ref['path'] == blob
+    assert ref['headers'] == {'content-type': 'text/csv'}
+    assert ref['encoding'] == 'utf-8'
+
+    with store.open(RESOURCE) as f:
+        assert f.read() == b'hello,world'
+
+    # a new revision isn't found
+    assert store.lookup(dict(RESOURCE, last_modified='2016-02-01')) is None
+
+
+def test_user_files_stay_writable():
+    filepath = write('mine.csv', b'hello,world')
+    blob = store.put(filepath, 'sha1:def', RESOURCE)
+    assert os.access(filepath, os.W_OK)
+    assert not os.access(blob, os.W_OK) or os.geteuid() == 0
+
+    with open(filepath, 'ab') as f:
+        f.write(b'!')
+
+    with open(blob, 'rb') as f:
+        assert f.read() == b'hello,world'
+
+
+def test_place():
+    blob = store.put(BytesIO(b'placed'), 'sha1:789', RESOURCE)
+    destination = write('placed.csv', b'old')
+    blobs.place(blob, destination)
+
+    with open(destination, 'rb') as f:
+        assert f.read() == b'placed'
+
+    # a clone or copy is independent of the blob, a hardlink is read only
+    if p.samefile(blob, destination):
+        assert not os.stat(destination).st_mode & 0o222
+
+
+def test_dedup():
+    store.put(BytesIO(b'same'), 'sha1:123', dict(RESOURCE, id='a'))
+    count = len(os.listdir(store.objects))
+    store.put(BytesIO(b'same'), 'sha1:123', dict(RESOURCE, id='b'))
+    assert len(os.listdir(store.objects)) == count
+
+    paths = {store.lookup(dict(RESOURCE, id=i))['path'] for i in 'ab'}
+    assert paths == {store.path('sha1:123')}
+
+
+def test_new_revision():
+    # updating the datastore table bumps the revision, not the file
+    store.put(BytesIO(b'hello,world'), 'sha1:abc', RESOURCE)
+    resource = dict(RESOURCE, revision_id='r2')
+    assert store.lookup(resource)['path'] == store.path('sha1:abc')
+
+
+def test_no_ref_without_a_modification_date():
+    store.put(BytesIO(b'new'), 'sha1:456', {'id': 'c'})
+    assert store.lookup({'id': 'c'}) is None
+    assert p.exists(store.path('sha1:456'))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests of sampled encoding detection """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import codecs
+import shutil
+
+from io import BytesIO
+from os import path as p
+from tempfile import mkdtemp
+
+from ckanny import charset
+
+TEXT = 'id,name\n1,café\n2,Zürich\n3,naïve\n' * 20
+
+
+def setup():
+    global tmpdir
+    tmpdir = mkdtemp()
+
+
+def teardown():
+    shutil.rmtree(tmpdir)
+
+
+def write(name, content):
+    filepath = p.join(tmpdir, name)
+
+    with open(filepath, 'wb') as f:
+        f.write(content)
+
+    return filepath
+
+
+def test_bom_first():
+    content = codecs.BOM_UTF16_LE + TEXT.encode('utf-16-le')
+    assert charset.detect(BytesIO(content)) == 'utf-16'
+
+    # a utf-8 bom wins over plain utf-8
+    content = codecs.BOM_UTF8 + TEXT.encode('utf-8')
+    assert charset.detect(BytesIO(content)) == 'utf-8-sig'
+
+
+def test_utf8_before_chardet():
+    assert charset.detect(BytesIO(TEXT.encode('utf-8'))) == 'utf-8'
+    assert charset.detect(BytesIO(b'id,name\n1,bob\n')) == 'utf-8'
+
+
+def test_chardet_fallback():
+    encoding = charset.detect(BytesIO(TEXT.encode('latin-1')))
+    assert encoding in {'iso-8859-1', 'windows-1252'}
+
+
+def test_tail():
+    # the only non utf-8 bytes are near the end of the file
+    head = b'id,name\n' + b'1,bob\n' * (charset.HEAD_BYTES // 6 + 1)
+    content = head + b'\n' * charset.TAIL_BYTES + TEXT.encode('latin-1')
+    f, size = BytesIO(content), len(content)
+    assert charset.detect(f, size) != 'utf-8'
+    assert charset.detect(BytesIO(content)) == 'utf-8'
+
+
+def test_stamp_invalidation():
+    filepath = write('data.csv', TEXT.encode('utf-8'))
+
+    if not charset.save(filepath, 'latin-1'):
+        # the file system doesn't support extended attributes
+        return
+
+    assert charset.get_encoding(filepath) == ('latin-1', False)
+
+    with open(filepath, 'ab') as f:
+        f.write(b'4,z\n')
+
+    assert charset.get_encoding(filepath) == ('utf-8', True)
+    assert charset.get_encoding(filepath) == ('utf-8', False)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests of gzipped datastore requests """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import json
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+import requests
+
+from ckanny import compression
+
+RECORDS = [{'id': i, 'name': 'row %i' % i} for i in range(100)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Records the encoding of each request, and rejects gzipped ones if the
+    server is `strict`"""
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        encoding = self.headers.get('Content-Encoding')
+        self.server.encodings.append(encoding)
+        rejected = encoding and self.server.strict
+        self.send_response(415 if rejected else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def start(strict):
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.strict, server.encodings = strict, []
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.address = 'http://127.0.0.1:%i' % server.server_address[1]
+    return server
+
+
+def upsert(address):
+    url = '%s/api/action/datastore_upsert' % address
+    body = json.dumps({'resource_id': 'rid', 'records': RECORDS})
+    headers = {'Content-Type': 'application/json'}
+    return requests.post(url, data=body, headers=headers)
+
+
+def test_gzip():
+    server = start(False)
+
+    try:
+        with compression.gzip_requests(server.address):
+            assert upsert(server.address).status_code == 200
+
+        upsert(server.address)
+        assert server.encodings == ['gzip', None]
+        assert not compression.gzip_hosts
+    finally:
+        server.shutdown()
+
+
+def test_fallback():
+    server = start(True)
+
+    try:
+        with compression.gzip_requests(server.address):
+            assert upsert(server.address).status_code == 200
+
+            # the host isn't sent gzipped bodies again
+            assert upsert(server.address).status_code == 200
+
+        assert server.encodings == ['gzip', None, None]
+        assert not compression.rejected_hosts
+    finally:
+        server.shutdown()
+
+
+def test_disabled():
+    server = start(False)
+
+    try:
+        with compression.gzip_requests(server.address, False):
+            upsert(server.address)
+
+        assert server.encodings == [None]
+    finally:
+        server.shutdown()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests of datastore loads """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import ckanapi
+
+from ckanny import datastorer as ds
+
+
+class CKAN(object):
+    """Records the datastore calls of a bulk load, and rejects a primary key
+    over duplicate rows"""
+    def __init__(self, duplicates=False):
+        self.duplicates = duplicates
+        self.calls = []
+
+    def update_datastore(self, resource_id, source, **kwargs):
+        self.calls.append(('update_datastore', kwargs.get('primary_key')))
+        return True
+
+    def datastore_create(self, resource_id, **kwargs):
+        key = 'primary_key' if 'primary_key' in kwargs else 'indexes'
+        self.calls.append(('datastore_create', key))
+
+        if key == 'primary_key' and self.duplicates:
+            raise ckanapi.ValidationError({'primary_key': 'duplicate keys'})
+
+
+def load(ckan):
+    kwargs = {'bulk_load': True, 'primary_key': 'id', 'indexes': 'name'}
+    return ds.update_datastore(ckan, 'rid', 'data.csv', **kwargs)
+
+
+def test_bulk_load():
+    ckan = CKAN()
+    assert load(ckan)
+
+    # the rows are inserted before the primary key and indexes are created
+    expected = [
+        ('update_datastore', None), ('datastore_create', 'primary_key'),
+        ('datastore_create', 'indexes')]
+
+    assert ckan.calls == expected
+
+
+def test_bulk_load_duplicates():
+    # the load fails, but the table keeps its rows and indexes
+    ckan = CKAN(duplicates=True)
+    assert not load(ckan)
+    assert ckan.calls[-1] == ('datastore_create', 'indexes')
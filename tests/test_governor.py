@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests of the per remote request limits """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+
+import requests
+
+from ckanny import governor
+
+TIMEOUT = 5
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Redirects `/redirect` to `/`, which answers with a small body"""
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+
+def setup():
+    global server, address
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    address = 'http://127.0.0.1:%i' % server.server_address[1]
+    governor.install()
+    governor.configure(None, 1)
+
+
+def teardown():
+    server.shutdown()
+    governor.configure()
+
+
+def finishes(func):
+    """Whether `func` returns within the timeout (rather than deadlocking)"""
+    results = []
+    thread = Thread(target=lambda: results.append(func()))
+    thread.daemon = True
+    thread.start()
+    thread.join(TIMEOUT)
+    return bool(results) and results[0]
+
+
+def test_redirect():
+    def func():
+        r = requests.get('%s/redirect' % address, timeout=TIMEOUT)
+        return r.status_code == 200 and r.content == b'ok' and r.history
+
+    assert finishes(func)
+
+
+def test_stream():
+    # a request made while a streamed body is still open mustn't wait for it
+    def func():
+        streamed = requests.get(address, stream=True, timeout=TIMEOUT)
+
+        try:
+            r = requests.get('%s/redirect' % address, timeout=TIMEOUT)
+            return r.content == b'ok' and streamed.raw.read() == b'ok'
+        finally:
+            streamed.close()
+
+    assert finishes(func)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests of the hashes used to detect changed resources """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import hashlib
+
+from io import BytesIO
+
+from ckanny import hashing
+
+CONTENT = b'a,b,c\n1,2,3\n' * 1000
+
+
+def test_prefix():
+    f = BytesIO(CONTENT)
+    hexdigest = hashlib.sha1(CONTENT).hexdigest()
+    assert hashing.hash_file(f) == 'sha1:%s' % hexdigest
+    assert hashing.hash_file(f, 'md5').startswith('md5:')
+
+    # unprefixed (legacy) values are sha1 digests
+    assert hashing.parse(hexdigest) == ('sha1', hexdigest)
+    assert not hashing.compare(f, 'sha1:%s' % hexdigest, hexdigest)
+    assert hashing.compare(f, 'sha1:%s' % hexdigest, 'sha1:0')
+
+
+def test_tree_equivalence():
+    blocksize = hashing.BLOCKSIZE
+    hashing.BLOCKSIZE = 1000
+
+    try:
+        # the number of workers doesn't change the hash
+        hashes = {
+            hashing.hash_file(BytesIO(CONTENT), 'tree-sha1', workers=n)
+            for n in [1, 3, 4]}
+
+        blocks = [CONTENT[i:i + 1000] for i in range(0, len(CONTENT), 1000)]
+        digests = b''.join(hashlib.sha1(b).digest() for b in blocks)
+        expected = 'tree-sha1:%s' % hashlib.sha1(digests).hexdigest()
+    finally:
+        hashing.BLOCKSIZE = blocksize
+
+    assert hashes == {expected}
+
+
+def test_compare_across_algorithms():
+    f = BytesIO(CONTENT)
+    old_hash = hashing.hash_file(f, 'sha1')
+    new_hash = hashing.hash_file(f, 'tree-sha256')
+
+    # `f` is hashed again with the old hash's algorithm
+    assert not hashing.compare(f, new_hash, old_hash)
+    assert hashing.compare(BytesIO(b'changed'), new_hash, old_hash)
+    assert f.tell() == 0
+
+
+def test_compare_unknown_algorithm():
+    # e.g., a resource hash set by another tool
+    f = BytesIO(CONTENT)
+    new_hash = hashing.hash_file(f)
+    assert hashing.compare(f, new_hash, 'crc32:%s' % new_hash.split(':')[1])
+    assert hashing.compare(f, new_hash, 'http://example.com/data.csv')
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests of reading the properties of a geojson file """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import json
+
+from collections import OrderedDict
+
+from ckanny import hdx
+
+PROPERTIES = OrderedDict([('name', 'Kabul'), ('code', 'AF01'), ('pop', 4.6)])
+GEOMETRY = {
+    'type': 'Polygon',
+    'coordinates': [[[i / 7, -i / 3] for i in range(5000)]]}
+
+
+def chunked(*members, **kwargs):
+    """Splits a feature collection (whose features have the given members in
+    order) into chunks of `size` bytes"""
+    size = kwargs.get('size', 64)
+    feature = OrderedDict([('type', 'Feature')] + list(members))
+    content = OrderedDict([
+        ('type', 'FeatureCollection'), ('features', [feature, feature])])
+
+    text = json.dumps(content).encode('utf-8')
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def test_geometry_first():
+    members = [('geometry', GEOMETRY), ('properties', PROPERTIES)]
+    assert hdx.find_properties(chunked(*members)) == PROPERTIES
+
+
+def test_properties_first():
+    members = [('properties', PROPERTIES), ('geometry', GEOMETRY)]
+    chunks = chunked(*members)
+    assert hdx.find_properties(chunks) == PROPERTIES
+
+    # the rest of the file isn't read
+    assert next(chunks, None) is not None
+
+
+def test_whole_file():
+    members = [('geometry', GEOMETRY), ('properties', PROPERTIES)]
+    chunks = chunked(*members, size=2 ** 20)
+    assert hdx.find_properties(chunks) == PROPERTIES
+
+
+def test_no_properties():
+    assert hdx.find_properties(chunked(('geometry', GEOMETRY))) == {}
+    assert hdx.find_properties([b'{"type": "FeatureCollection"}']) == {}
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests of retrying and resuming datastore loads """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import shutil
+
+from tempfile import mkdtemp
+
+from requests.exceptions import ConnectionError, ReadTimeout
+
+from ckanny import journal, utils
+
+
+class Datastore(object):
+    """A datastore table whose upserts fail as given by `failures` (a list of
+    `(committed, exception)`, one for each failing call)"""
+    def __init__(self, failures=None):
+        self.rows = []
+        self.failures = failures or []
+
+    def datastore_upsert(self, **kwargs):
+        committed, err = self.failures.pop(0) if self.failures else (0, None)
+
+        if committed or not err:
+            self.rows.extend(kwargs['records'])
+
+        if err:
+            raise err
+
+    def datastore_delete(self, **kwargs):
+        self.rows = []
+
+
+def setup():
+    global cache_dir, sleep
+
+    # don't wait between retries
+    cache_dir, sleep = mkdtemp(), utils.sleep
+    utils.sleep = lambda seconds: None
+
+
+def teardown():
+    utils.sleep = sleep
+    shutil.rmtree(cache_dir)
+
+
+def load(datastore, chunks, resume=False):
+    """Deletes the table and inserts each chunk of records as a journaled
+    load (like `ckanutils` does)"""
+    kwargs = {'cache_dir': cache_dir, 'quiet': True, 'retries': 2}
+
+    with journal.load(datastore, 'rid', 'source', resume, **kwargs):
+        datastore.datastore_delete(resource_id='rid')
+
+        for chunk in chunks:
+            datastore.datastore_upsert(
+                resource_id='rid', records=chunk, method='insert')
+
+
+def test_unsent_insert_is_retried():
+    datastore = Datastore([(0, ConnectionError())])
+    load(datastore, [[1, 2], [3]])
+    assert datastore.rows == [1, 2, 3]
+
+
+def test_timed_out_insert_is_not_duplicated():
+    datastore = Datastore([(0, None), (1, ReadTimeout())])
+
+    try:
+        load(datastore, [[1, 2], [3]])
+    except ReadTimeout:
+        pass
+    else:
+        assert False, 'the timed out insert was retried'
+
+    assert datastore.rows == [1, 2, 3]
+
+
+def test_resume():
+    datastore = Datastore([(0, None), (0, ReadTimeout())])
+
+    try:
+        load(datastore, [[1, 2], [3, 4], [5]])
+    except ReadTimeout:
+        pass
+
+    assert datastore.rows == [1, 2]
+
+    # the first chunk is neither deleted nor inserted again
+    load(datastore, [[1, 2], [3, 4], [5]], resume=True)
+    assert datastore.rows == [1, 2, 3, 4, 5]
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests of the pre-flight checks """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+from io import BytesIO
+
+from ckanny import preflight
+
+TEXT = (
+    'id,name,count\n'
+    '1,café,10\n'
+    '2,Zürich\n'
+    '3,%s,30\n'
+    '4,naïve,many\n'
+    '1,again,50\n'
+    ',empty,60\n')
+
+# utf-8 with an undecodable row
+CSV = TEXT.encode('utf-8') % b'\xff\xfe'
+
+FIELDS = [
+    {'id': 'id', 'type': 'int'},
+    {'id': 'name', 'type': 'text'},
+    {'id': 'count', 'type': 'int4'}]
+
+EXPECTED = [
+    (3, 'expected 3 fields, found 2'),
+    (5, "can't cast `count` value u'many' to int"),
+    (6, 'duplicate primary key'),
+    (7, 'empty primary key')]
+
+
+def validate(content, **kwargs):
+    return list(preflight.validate(BytesIO(content), **kwargs))
+
+
+def test_valid():
+    content = 'id,name\n1,café\n2,Zürich\n'.encode('utf-8')
+    assert validate(content, primary_key='id', type_cast=True) == []
+
+
+def test_problems():
+    problems = validate(CSV, primary_key='id', fields=FIELDS)
+    lines = [line for line, _ in problems]
+    assert lines == [3, 4, 5, 6, 7]
+    assert problems[1].message.startswith("can't decode the row as utf-8")
+    assert [p for p in problems if p.line != 4] == EXPECTED
+
+
+def test_inferred_types():
+    content = b'id,count\n1,10\n2,2.5\n3,x\n'
+    problems = validate(content, type_cast=True, sample_rows=2)
+    expected = [(4, "can't cast `count` value u'x' to numeric")]
+    assert problems == expected
+
+
+def test_header():
+    problems = validate(b'id,name\n1,a\n', primary_key='id,code')
+    assert problems == [(1, 'primary key field `code` not found')]
+
+    fields = [{'id': 'id', 'type': 'int'}]
+    problems = validate(b'id,name\n1,a\n', fields=fields)
+    assert problems == [(1, "field `name` isn't in the datastore table")]
+
+    assert validate(b'') == [(1, 'the file is empty')]
+
+
+def test_sanitized_key():
+    content = b'Site ID,name\n1,a\n1,b\n'
+    problems = validate(content, primary_key='site_id', sanitize=True)
+    assert problems == [(3, 'duplicate primary key')]
+
+
+def test_utf16():
+    content = (TEXT % '').encode('utf-16')
+    kwargs = {'encoding': 'utf-16', 'primary_key': 'id', 'fields': FIELDS}
+    problems = validate(content, **kwargs)
+    assert problems == EXPECTED
+
+
+def test_workers():
+    # duplicates must be found across batches (and processes)
+    batch_rows = preflight.BATCH_ROWS
+    preflight.BATCH_ROWS = 2
+
+    try:
+        kwargs = {'primary_key': 'id', 'fields': FIELDS}
+        expected = validate(CSV, **kwargs)
+        assert validate(CSV, workers=2, **kwargs) == expected
+        assert validate(CSV * 2, workers=2, **kwargs)[-1] == (
+            14, 'empty primary key')
+    finally:
+        preflight.BATCH_ROWS = batch_rows
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# vim: sw=4:ts=4:expandtab
+
+""" Tests that ckanny starts up without importing its heavy dependencies """
+
+from __future__ import (
+    absolute_import, division, print_function, with_statement,
+    unicode_literals)
+
+import sys
+
+from os import path as p
+from subprocess import check_output
+
+parent_dir = p.abspath(p.dirname(p.dirname(__file__)))
+heavy = {
+    'ckanapi', 'ckanutils', 'dateutil', 'requests', 'slugify', 'tabutils',
+    'xattr'}
+
+
+def loaded_modules(*args):
+    """Runs a ckanny command in a fresh interpreter and returns the names of
+    the modules it imported"""
+    argv = ['ckanny'] + list(args)
+    code = (
+        'import sys\nsys.argv = %r\nfrom ckanny import manager\n'
+        'if len(sys.argv) > 1:\n    manager.main()\n'
+        'print("\\n" + ",".join(sys.modules))' % argv)
+
+    output = check_output([sys.executable, '-c', code], cwd=parent_dir)
+    return set(output.decode('utf-8').strip().split('\n')[-1].split(','))
+
+
+def test_import():
+    assert not heavy.intersection(loaded_modules())
+
+
+def test_ver():
+    assert not heavy.intersection(loaded_modules('ver'))
+
+
+def test_help():
+    assert not heavy.intersection(loaded_modules('--help'))